@@ -0,0 +1,375 @@
+"""## Historical backfill from the archive/ prefix
+
+Recomputes the KPIs of past drops from the snapshots ``archive_data`` moved
+under ``archive/<timestamp>/``, e.g. after a fix to the KPI computation. Nothing
+is moved back to ``raw-data/``, so the Lambda trigger does not fire, and
+nothing is archived again:
+
+1. The snapshots are listed and selected by the date of their timestamp. The
+   folder of an unfinished archive is left out.
+2. The snapshots are read and validated on ``BACKFILL_WORKERS`` threads, and
+   the valid rows of each one are staged under ``backfill/<backfill_id>/``.
+   Orders of a day can be sent again in any later drop, so the selection is
+   then widened to every snapshot taken on or after the first order date of
+   the selected ones, and those are staged too.
+3. The staged rows are merged. Orders, order items and products that appear
+   in several snapshots, e.g. an order sent again once it was returned, are
+   kept once, from the latest snapshot. The order items are then checked
+   against the merged orders and products.
+4. The KPIs of the merged rows are computed once, on ``TRANSFORM_WORKERS``
+   processes (see ``sharded``), and written in bulk to DynamoDB and the
+   processed folder, as a Task 2 run writes them, and so are the rolling-window
+   KPIs of their categories (see ``rolling``).
+
+The backfill is recorded in ``status/backfill_checkpoint.json``. When it stops
+part-way, running it again with the same dates continues it: the snapshots
+already staged are loaded instead of validated again. The checkpoint and the
+staged rows are removed once the KPIs are written.
+
+Only the order dates from the first order date of the selected snapshots on
+are written, since every snapshot that can hold their orders was read. The
+earlier dates that the added snapshots hold orders of are skipped and logged,
+so no KPI or rolling total is overwritten with a partial sum. The incremental
+state (see ``common.incremental``) is not rebuilt.
+
+Usage:
+    python backfill.py [--since YYYY-MM-DD] [--until YYYY-MM-DD] [--restart]
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import task_1
+import task_2
+from archiver import DELETE_BATCH_SIZE, iter_objects, load_journal
+from common.handoff import load_frame, save_frame
+from common.lazy import lazy_import, preload
+from common.metrics import RunMetrics, stage
+from common.rules import IdSet, ValidationReport, validate
+from common.schemas import RAW_SCHEMAS
+from ingest import list_keys
+from kpi_engine import compute_category_counts
+
+pd = lazy_import('pandas')
+
+S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME')
+
+# Number of snapshots validated at once
+BACKFILL_WORKERS = int(os.environ.get('BACKFILL_WORKERS', '4'))
+
+ARCHIVE_PREFIX = 'archive/'
+BACKFILL_PREFIX = 'backfill/'
+CHECKPOINT_KEY = 'status/backfill_checkpoint.json'
+
+# How archive_data names its folders, and how it named them before dropping the colons
+SNAPSHOT_FORMAT = task_2.ARCHIVE_FORMAT
+LEGACY_SNAPSHOT_FORMAT = '%Y-%m-%d-T-%H:%M:%S'
+
+# The key that identifies a row of each dataset across snapshots
+DATASET_KEYS = {'products': 'id', 'orders': 'order_id', 'order_items': 'id'}
+
+
+def list_snapshots(s3, bucket, since=None, until=None):
+    """List the archive snapshots taken between two dates, inclusive, oldest first.
+
+    Args:
+        s3: A boto3 S3 client.
+        bucket (str): The bucket holding the archive.
+        since (str): The first date, in ISO 8601. Defaults to the first snapshot.
+        until (str): The last date, likewise. Defaults to the last snapshot.
+
+    Returns:
+        list: The snapshot folder names, without the archive prefix.
+    """
+    journal = load_journal(s3, bucket)
+    unfinished = journal['destination'] if journal else None
+
+    taken = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=ARCHIVE_PREFIX, Delimiter='/'):
+        for common in page.get('CommonPrefixes', []):
+            if common['Prefix'] == unfinished:
+                print(f"Skipping {common['Prefix']}: its archive is unfinished")
+                continue
+            name = common['Prefix'][len(ARCHIVE_PREFIX):].rstrip('/')
+            try:
+                taken[name] = snapshot_time(name)
+            except ValueError:
+                print(f"Skipping {common['Prefix']}: not an archive snapshot")
+    return sorted(
+        (name for name, at in taken.items()
+         if (since is None or at.date().isoformat() >= since) and (until is None or at.date().isoformat() <= until)),
+        key=taken.get,
+    )
+
+
+def snapshot_time(name):
+    """Parse the time a snapshot was taken from its folder name, in either format."""
+    try:
+        return datetime.strptime(name, SNAPSHOT_FORMAT)
+    except ValueError:
+        return datetime.strptime(name, LEGACY_SNAPSHOT_FORMAT)
+
+
+def load_checkpoint(s3, bucket):
+    """Load the checkpoint of an unfinished backfill, or None if there is none."""
+    try:
+        response = s3.get_object(Bucket=bucket, Key=CHECKPOINT_KEY)
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(response['Body'].read())
+
+
+def save_checkpoint(s3, bucket, checkpoint):
+    s3.put_object(Bucket=bucket, Key=CHECKPOINT_KEY, Body=json.dumps(checkpoint, indent=2).encode('utf-8'))
+
+
+def staging_prefix(checkpoint, snapshot):
+    return f"{BACKFILL_PREFIX}{checkpoint['backfill_id']}/{snapshot}/"
+
+
+def validate_snapshot(snapshot):
+    """Read and validate one snapshot on its own.
+
+    The order items are only checked against the orders and products once every
+    snapshot is merged, since their order may be in an earlier snapshot.
+
+    Returns:
+        tuple: The valid products, orders and order items, by dataset name, and
+        the ``ValidationReport`` of the snapshot.
+    """
+    prefix = f"{ARCHIVE_PREFIX}{snapshot}/"
+    s3 = task_1.get_s3()
+    report = ValidationReport()
+
+    products_key = f"{prefix}products.csv"
+    if products_key in list_keys(s3, S3_BUCKET_NAME, products_key):
+        results = {'products': task_1.get_products_cache().load(products_key).result}
+    else:
+        results = {'products': validate(RAW_SCHEMAS['products'].empty('validation'), 'products')}
+    for name in ('orders', 'order_items'):
+        keys = list_keys(s3, S3_BUCKET_NAME, f"{prefix}{name}/")
+        results[name] = validate(task_1.read_csv_parts(f"{prefix}{name}/", keys, name, allow_empty=True), name)
+    for name, result in results.items():
+        report.add(name, result)
+
+    orders = results['orders'].valid
+    frames = {
+        'products': results['products'].valid,
+        'orders': orders.assign(
+            order_date=pd.to_datetime(orders['created_at']).dt.date,
+            return_date=pd.to_datetime(orders['returned_at']).dt.date,
+        ),
+        'order_items': results['order_items'].valid,
+    }
+    return frames, report
+
+
+def merge_snapshots(staged, report):
+    """Merge the valid rows of the snapshots, keeping the latest version of each row.
+
+    Args:
+        staged (list): The valid rows of each snapshot, by dataset name, oldest first.
+        report (ValidationReport): Receives the reject counts of the merged order items.
+
+    Returns:
+        tuple: The merged products, orders and order items.
+    """
+    merged = {}
+    for name, key in DATASET_KEYS.items():
+        rows = pd.concat([frames[name] for frames in staged], ignore_index=True)
+        merged[name] = rows.drop_duplicates(key, keep='last', ignore_index=True)
+        print(f"Merged {name}: {len(merged[name])} row(s), {len(rows) - len(merged[name])} duplicate(s) dropped")
+
+    references = {'orders': IdSet(merged['orders']['order_id']), 'products': IdSet(merged['products']['id'])}
+    result = validate(merged['order_items'], 'order_items', references)
+    report.add('merged_order_items', result)
+    return merged['products'], merged['orders'], result.valid
+
+
+def combined_report(reports):
+    """Sum the ``ValidationReport`` counts of the snapshots, given as their ``datasets``."""
+    report = ValidationReport()
+    for datasets in reports:
+        for name, counts in datasets.items():
+            totals = report.datasets.setdefault(name, {'rows': 0, 'rejected': 0, 'parked': 0, 'reasons': {}})
+            for field in ('rows', 'rejected', 'parked'):
+                totals[field] += counts[field]
+            for code, count in counts['reasons'].items():
+                totals['reasons'][code] = totals['reasons'].get(code, 0) + count
+    return report
+
+
+def delete_prefix(s3, bucket, prefix):
+    """Delete every object under a prefix."""
+    keys = [obj['Key'] for obj in iter_objects(s3, bucket, prefix, suffix='')]
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        s3.delete_objects(
+            Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys[start:start + DELETE_BATCH_SIZE]], 'Quiet': True},
+        )
+
+
+def run_backfill(since=None, until=None, restart=False):
+    """
+    Recompute and write the KPIs of the archive snapshots taken between two dates.
+
+    Parameters:
+        since (str): The first snapshot date, in ISO 8601. Defaults to the first snapshot.
+        until (str): The last snapshot date, likewise. Defaults to the last snapshot.
+        restart (bool): Discard an unfinished backfill instead of continuing it.
+
+    Returns:
+        tuple: The category-level and order-level KPIs written.
+    """
+    s3 = task_1.get_s3()
+    checkpoint = load_checkpoint(s3, S3_BUCKET_NAME)
+    if checkpoint is not None and restart:
+        print(f"Discarding the unfinished backfill {checkpoint['backfill_id']}")
+        delete_prefix(s3, S3_BUCKET_NAME, f"{BACKFILL_PREFIX}{checkpoint['backfill_id']}/")
+        checkpoint = None
+    if checkpoint is not None and (checkpoint['since'], checkpoint['until']) != (since, until):
+        raise RuntimeError(
+            f"An unfinished backfill of {checkpoint['since']} .. {checkpoint['until']} exists: "
+            f"run it again with the same dates to continue it, or with --restart to discard it"
+        )
+
+    if checkpoint is None:
+        with stage('list_snapshots') as s:
+            snapshots = list_snapshots(s3, S3_BUCKET_NAME, since, until)
+            s.rows_out = len(snapshots)
+        if not snapshots:
+            print("No archive snapshots in the selected dates")
+            return None
+        backfill_id = datetime.utcnow().strftime('%Y-%m-%d-T-%H-%M-%S') + '-' + uuid.uuid4().hex[:8]
+        checkpoint = {
+            'backfill_id': backfill_id, 'since': since, 'until': until,
+            'selected': snapshots, 'snapshots': snapshots, 'staged': {},
+        }
+        save_checkpoint(s3, S3_BUCKET_NAME, checkpoint)
+    else:
+        print(f"Continuing the backfill {checkpoint['backfill_id']}: "
+              f"{len(checkpoint['staged'])} of {len(checkpoint['snapshots'])} snapshot(s) already staged")
+    print(f"Backfilling {len(checkpoint['snapshots'])} snapshot(s): "
+          f"{checkpoint['snapshots'][0]} .. {checkpoint['snapshots'][-1]}")
+
+    staged = {}
+    lock = threading.Lock()
+
+    def stage_snapshot(snapshot):
+        frames, report = validate_snapshot(snapshot)
+        for name, df in frames.items():
+            save_frame(s3, S3_BUCKET_NAME, staging_prefix(checkpoint, snapshot), name, df)
+        with lock:
+            staged[snapshot] = frames
+            checkpoint['staged'][snapshot] = report.datasets
+            save_checkpoint(s3, S3_BUCKET_NAME, checkpoint)
+        rows = sum(len(df) for df in frames.values())
+        print(f"Staged snapshot {snapshot}: {rows} valid row(s)")
+
+    def load_staged(snapshot):
+        staged[snapshot] = {
+            name: load_frame(s3, S3_BUCKET_NAME, staging_prefix(checkpoint, snapshot), name) for name in DATASET_KEYS
+        }
+
+    def stage_all(pool, snapshots):
+        futures = [
+            pool.submit(load_staged if snapshot in checkpoint['staged'] else stage_snapshot, snapshot)
+            for snapshot in snapshots if snapshot not in staged
+        ]
+        for future in as_completed(futures):
+            future.result()
+
+    with stage('validate') as s, ThreadPoolExecutor(max_workers=max(1, BACKFILL_WORKERS)) as pool:
+        selected = checkpoint.get('selected', checkpoint['snapshots'])
+        stage_all(pool, selected)
+        first_date = min(
+            (staged[snapshot]['orders']['order_date'].min() for snapshot in selected
+             if len(staged[snapshot]['orders'])),
+            default=None,
+        )
+        if first_date is not None:
+            first_date = pd.Timestamp(first_date).date()
+            # Any snapshot taken from the first order date on can hold orders of the selected days
+            wider = [
+                snapshot for snapshot in list_snapshots(s3, S3_BUCKET_NAME, since=first_date.isoformat())
+                if snapshot not in checkpoint['snapshots']
+            ]
+            if wider:
+                print(f"Adding {len(wider)} snapshot(s) that can hold orders from {first_date} on: "
+                      f"{wider[0]} .. {wider[-1]}")
+                checkpoint['snapshots'] = sorted(checkpoint['snapshots'] + wider, key=snapshot_time)
+                save_checkpoint(s3, S3_BUCKET_NAME, checkpoint)
+            stage_all(pool, checkpoint['snapshots'])
+        s.rows_out = sum(len(df) for frames in staged.values() for df in frames.values())
+
+    report = combined_report(checkpoint['staged'][snapshot] for snapshot in checkpoint['snapshots'])
+    with stage('merge') as s:
+        products, orders, order_items = merge_snapshots([staged[snapshot] for snapshot in checkpoint['snapshots']], report)
+        s.rows_out = len(products) + len(orders) + len(order_items)
+    report.report()
+    staged.clear()
+
+    # The earlier dates the added snapshots hold orders of were not read in full
+    if first_date is not None:
+        covered = orders['order_date'] >= first_date
+        skipped = sorted(set(orders.loc[~covered, 'order_date']))
+        if skipped:
+            print(f"Skipping {len(skipped)} order date(s) before {first_date}, whose orders may be in "
+                  f"snapshots before the selection: {skipped[0]} .. {skipped[-1]}")
+        orders = orders[covered]
+        order_items = order_items[order_items['order_id'].isin(orders['order_id'])]
+
+    print("Running Transformation...")
+    with stage('transform') as s:
+        s.rows_in = len(products) + len(orders) + len(order_items)
+        cat_kpi, order_kpi = task_2.run_transformation(products, orders, order_items)
+        s.rows_out = len(cat_kpi) + len(order_kpi)
+    if len(order_kpi):
+        print(f"Recomputed the KPIs of {len(order_kpi)} order date(s): "
+              f"{order_kpi['order_date'].min()} .. {order_kpi['order_date'].max()}")
+
+    with stage('write_dynamodb') as s:
+        s.rows_in = len(cat_kpi) + len(order_kpi)
+        task_2.write_to_dynamodb(cat_kpi, order_kpi)
+    with stage('write_s3') as s:
+        s.rows_in = len(cat_kpi) + len(order_kpi)
+        task_2.write_to_s3(cat_kpi, order_kpi)
+    if task_2.ROLLING_KPIS:
+        with stage('rolling_kpis') as s:
+            counts = compute_category_counts(products, orders, order_items)
+            s.rows_in = len(counts)
+            s.rows_out = len(task_2.write_rolling_kpis(counts))
+
+    with stage('cleanup'):
+        delete_prefix(s3, S3_BUCKET_NAME, f"{BACKFILL_PREFIX}{checkpoint['backfill_id']}/")
+        s3.delete_object(Bucket=S3_BUCKET_NAME, Key=CHECKPOINT_KEY)
+    return cat_kpi, order_kpi
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute the KPIs of archived drops.")
+    parser.add_argument('--since', help="The first snapshot date to backfill, YYYY-MM-DD")
+    parser.add_argument('--until', help="The last snapshot date to backfill, YYYY-MM-DD")
+    parser.add_argument('--restart', action='store_true', help="Discard an unfinished backfill instead of continuing it")
+    args = parser.parse_args()
+
+    try:
+        print("Starting Backfill Job")
+        with RunMetrics('backfill', [task_1.get_s3(), task_2.get_s3(), task_2.get_ddb().meta.client]):
+            # Import pandas and pyarrow while the first S3 requests are in flight
+            preload('pandas', 'pyarrow.parquet')
+            run_backfill(args.since, args.until, args.restart)
+    except Exception as e:
+        print("Error during backfill:", e)
+        sys.exit(1)
+
+    print("Backfill Completed Successfully.")
+
+if __name__ == "__main__":
+    main()
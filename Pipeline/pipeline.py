@@ -0,0 +1,73 @@
+"""## Fused Validation and Transformation Task
+
+Runs the validation task and the transformation task in one process, handing
+the validated DataFrames over in memory instead of through the S3 "validated"
+folder. The validated data is still written to S3 in the background, for
+auditability, while the transformation runs.
+"""
+
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import task_1
+import task_2
+from common.lazy import preload
+from common.metrics import RunMetrics, stage
+
+
+def run_pipeline():
+    """
+    Validate the raw data and transform it in the same process.
+
+    In streaming mode the validated data is never held in memory, so it is
+    written by the validation step and loaded back for the transformation.
+    """
+    print("Checking for required files...")
+    with stage('check_required_files'):
+        task_1.check_required_files()
+    print("All input files exist.")
+
+    print("Validating data...")
+    if task_1.STREAMING:
+        task_1.run_streaming_validation()
+        with stage('load_validated') as s:
+            products_df = task_2.load_validated('products')
+            orders_df = task_2.load_validated('orders')
+            order_items_df = task_2.load_validated('order_items')
+            s.rows_out = len(products_df) + len(orders_df) + len(order_items_df)
+        task_2.process_validated(products_df, orders_df, order_items_df)
+        return
+
+    products_df, orders_df, order_items_df = task_1.run_validation()
+
+    with ThreadPoolExecutor(max_workers=3) as audit:
+        saves = [
+            audit.submit(task_1.save_to_s3, df, name)
+            for df, name in ((products_df, "products"), (orders_df, "orders"), (order_items_df, "order_items"))
+        ]
+
+        # The transformation does not modify its inputs, so the background writers
+        # can serialize the same frames while it runs
+        task_2.process_validated(products_df, orders_df, order_items_df)
+
+        with stage('save_validated'):
+            for save in saves:
+                save.result()
+    print("Validated data saved to S3.")
+
+
+def main():
+    try:
+        print("Starting ECS Task: Fused Validation and Transformation Job")
+        with RunMetrics('pipeline', [task_1.get_s3(), task_2.get_s3(), task_2.get_ddb().meta.client]):
+            # Import pandas and pyarrow while the first S3 requests are in flight
+            preload('pandas', 'pyarrow.parquet')
+            run_pipeline()
+    except Exception as e:
+        print("Error during processing:", e)
+        sys.exit(1)
+
+    print("Pipeline Completed Successfully.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""## Ingestion helpers for the Validation Task"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from common.lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+
+def list_objects(s3, bucket, prefix, suffix='.csv'):
+    """List every object under an S3 prefix, following pagination.
+
+    A single ``list_objects_v2`` call returns at most 1000 keys, so the
+    paginator is used to walk the whole prefix.
+
+    Args:
+        s3: A boto3 S3 client.
+        bucket (str): The bucket to list.
+        prefix (str): The S3 prefix to list.
+        suffix (str): Only keys ending with this suffix are returned.
+
+    Returns:
+        list: The matching ``list_objects_v2`` entries (with ``Key``, ``ETag`` and
+        ``Size``), in the order S3 lists them.
+    """
+    objects = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith(suffix):
+                objects.append(obj)
+    return objects
+
+
+def list_keys(s3, bucket, prefix, suffix='.csv'):
+    """List every object key under an S3 prefix, following pagination.
+
+    Returns:
+        list: The matching keys, in the order S3 lists them.
+    """
+    return [obj['Key'] for obj in list_objects(s3, bucket, prefix, suffix)]
+
+
+def fetch_csv(s3, bucket, key, parse=None):
+    """Download a single CSV part from S3 and parse it.
+
+    Args:
+        s3: A boto3 S3 client.
+        bucket (str): The bucket holding the object.
+        key (str): The key of the CSV file to read.
+        parse: The function that parses the downloaded file object into a DataFrame.
+            Defaults to ``pd.read_csv``.
+
+    Returns:
+        tuple: The parsed pandas DataFrame and a dict with the timings for the file.
+    """
+    start = time.perf_counter()
+    body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    downloaded = time.perf_counter()
+    df = (parse or pd.read_csv)(BytesIO(body))
+    parsed = time.perf_counter()
+
+    stats = {
+        'key': key,
+        'bytes': len(body),
+        'rows': len(df),
+        'download_s': downloaded - start,
+        'parse_s': parsed - downloaded,
+    }
+    return df, stats
+
+
+def read_csvs_parallel(s3, bucket, keys, max_workers=8, parse=None):
+    """Fetch and parse CSV parts concurrently and concatenate them once.
+
+    The S3 client is shared by all workers, so it should be created with a
+    connection pool at least ``max_workers`` wide.
+
+    Args:
+        s3: A boto3 S3 client.
+        bucket (str): The bucket holding the objects.
+        keys (list): The keys of the CSV files to read.
+        max_workers (int): The maximum number of files fetched at once.
+        parse: The function that parses each downloaded file object into a DataFrame.
+            Defaults to ``pd.read_csv``.
+
+    Returns:
+        tuple: The concatenated pandas DataFrame and a list of per-file timing dicts,
+        both in the same order as ``keys``.
+    """
+    if not keys:
+        raise FileNotFoundError("No CSV files to read.")
+
+    workers = max(1, min(max_workers, len(keys)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda key: fetch_csv(s3, bucket, key, parse), keys))
+
+    dfs = [df for df, _ in results]
+    report = [stats for _, stats in results]
+    return pd.concat(dfs, ignore_index=True), report
+
+
+def print_timing_report(prefix, report, elapsed):
+    """Print a per-file timing report for one ingested prefix.
+
+    Args:
+        prefix (str): The S3 prefix that was read.
+        report (list): The per-file timing dicts returned by ``read_csvs_parallel``.
+        elapsed (float): The wall-clock seconds spent reading the whole prefix.
+    """
+    print(f"Read {len(report)} file(s) from {prefix} in {elapsed:.2f}s")
+    for stats in report:
+        print(
+            f"  {stats['key']}: {stats['bytes']} bytes, {stats['rows']} rows, "
+            f"download {stats['download_s']:.3f}s, parse {stats['parse_s']:.3f}s"
+        )
+    download = sum(stats['download_s'] for stats in report)
+    parse = sum(stats['parse_s'] for stats in report)
+    print(f"  total: download {download:.2f}s, parse {parse:.2f}s (summed across workers)")
@@ -0,0 +1,242 @@
+"""## Bounded-memory streaming helpers for the Validation Task
+
+Part files are read in fixed-size row chunks, cleaned chunk by chunk, and
+written to S3 through a multipart upload, so peak memory depends on the chunk
+size rather than on the size of the drop.
+"""
+
+from common.incremental import PARKED_ON, park_items
+from common.lazy import lazy_import
+from common.rules import validate
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+MIB = 1024 * 1024
+
+# S3 requires every part but the last to be at least 5 MiB
+MIN_PART_SIZE = 5 * MIB
+
+
+class MultipartUpload:
+    """A write-only binary file object that streams to S3 with a multipart upload.
+
+    Data is buffered until a part is full, then uploaded. The upload is
+    completed on ``close`` and aborted if the ``with`` block raises.
+    """
+
+    def __init__(self, s3, bucket, key, part_size=8 * MIB):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.buffer = bytearray()
+        self.parts = []
+        self.bytes_written = 0
+        self.closed = False
+        self.upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self.bytes_written
+
+    def _upload_part(self, body):
+        number = len(self.parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=body
+        )
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+
+    def close(self):
+        if self.closed:
+            return
+        if self.buffer or not self.parts:
+            self._upload_part(bytes(self.buffer))
+            self.buffer.clear()
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts},
+        )
+        self.closed = True
+
+    def abort(self):
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.closed = True
+
+
+class OrderIdIndex:
+    """A compact, sorted array of valid order ids for chunked referential checks."""
+
+    def __init__(self, ids=()):
+        self._pending = [np.asarray(list(ids), dtype='int64')]
+        self._ids = np.empty(0, dtype='int64')
+
+    def add(self, ids):
+        """Queue order ids to be added to the index."""
+        self._pending.append(np.asarray(ids, dtype='int64'))
+
+    def _merge(self):
+        if self._pending:
+            self._ids = np.unique(np.concatenate([self._ids, *self._pending]))
+            self._pending = []
+
+    def __len__(self):
+        self._merge()
+        return len(self._ids)
+
+    def contains(self, ids):
+        """Return a boolean mask of which ids are in the index. Missing ids never are."""
+        self._merge()
+        ids = pd.Series(ids)
+        present = ids.notna().to_numpy()
+        ids = ids.fillna(0).to_numpy(dtype='int64')
+        if not len(self._ids):
+            return np.zeros(len(ids), dtype=bool)
+        positions = np.searchsorted(self._ids, ids).clip(max=len(self._ids) - 1)
+        return (self._ids[positions] == ids) & present
+
+
+def iter_csv_chunks(s3, bucket, keys, chunk_rows, schema=None, stage=None):
+    """Yield each CSV part as DataFrames of at most ``chunk_rows`` rows.
+
+    The object bodies are parsed as they stream in, so at most one chunk per
+    file is held in memory. With a ``schema``, only the stage's columns are
+    parsed, into their declared dtypes.
+    """
+    for key in keys:
+        body = s3.get_object(Bucket=bucket, Key=key)['Body']
+        if schema is not None:
+            yield from schema.read_chunks(body, chunk_rows, stage)
+            continue
+        with pd.read_csv(body, chunksize=chunk_rows) as reader:
+            yield from reader
+
+
+def clean_orders(chunks, index, report, rejected=None):
+    """Validate order chunks with the declared rules, derive their dates, and record their ids in the index.
+
+    The rejected rows are counted in ``report`` and written to ``rejected``, if given.
+    """
+    for orders in chunks:
+        result = validate(orders, 'orders')
+        report.add('orders', result)
+        if rejected is not None:
+            rejected.write(result.rejected)
+        orders = result.valid.assign(
+            order_date=pd.to_datetime(result.valid['created_at']).dt.date,
+            return_date=pd.to_datetime(result.valid['returned_at']).dt.date,
+        )
+        index.add(orders['order_id'])
+        yield orders
+
+
+def clean_order_items(chunks, references, report, rejected=None, park_orphans=False):
+    """Validate order item chunks with the declared rules against the referenced order and product ids.
+
+    The rejected rows are counted in ``report`` and written to ``rejected``, if given.
+
+    Yields:
+        tuple: The valid order items, and, with ``park_orphans``, the items whose
+        only failure is an unknown order, which are not written to ``rejected``
+        since their order may still arrive in a later drop, unless they have been
+        parked for more than ``PENDING_MAX_DAYS`` days.
+    """
+    for order_items in chunks:
+        result = validate(order_items, 'order_items', references)
+        orphans, failed = order_items.iloc[:0], result.rejected
+        if park_orphans:
+            orphans, failed = result.failed_only('unknown_order')
+            orphans, expired = park_items(orphans)
+            failed = pd.concat([failed.drop(columns=PARKED_ON, errors='ignore'), expired], ignore_index=True)
+        report.add('order_items', result, parked=len(orphans))
+        if rejected is not None:
+            rejected.write(failed)
+        yield result.valid.drop(columns=PARKED_ON, errors='ignore'), orphans
+
+
+class DatasetWriter:
+    """Streams DataFrame chunks to a single S3 object in a hand-off format.
+
+    Small chunks, such as the tail of every part file, are buffered until at
+    least ``chunk_rows`` rows are pending, so the output is not split into many
+    tiny row groups. Use it as a context manager: the object is completed when
+    the block exits normally and the multipart upload is aborted if it raises.
+
+    Args:
+        s3: A boto3 S3 client.
+        bucket (str): The bucket to write to.
+        key (str): The key of the object to write.
+        fmt: The hand-off format object.
+        name (str): The dataset name, used for its declared schema.
+        columns (list): The columns written if no rows are written at all.
+        chunk_rows (int): The minimum number of rows written at once.
+    """
+
+    def __init__(self, s3, bucket, key, fmt, name, columns, chunk_rows=100000):
+        self.key = key
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.rows = 0
+        self.empty = None
+        self.buffer = []
+        self.buffered_rows = 0
+        self.sink = MultipartUpload(s3, bucket, key)
+        self.writer = fmt.open_writer(self.sink, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.sink.abort()
+
+    def write(self, chunk):
+        if not len(chunk):
+            if self.empty is None:
+                self.empty = chunk
+            return
+        self.buffer.append(chunk)
+        self.buffered_rows += len(chunk)
+        self.rows += len(chunk)
+        if self.buffered_rows >= self.chunk_rows:
+            self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            self.writer.write(pd.concat(self.buffer, ignore_index=True))
+            self.buffer = []
+            self.buffered_rows = 0
+
+    def close(self):
+        self._flush()
+        if not self.rows:
+            # Still write a valid, empty dataset with the expected columns
+            empty = self.empty if self.empty is not None else pd.DataFrame(columns=self.columns)
+            self.writer.write(empty)
+        self.writer.close()
+        self.sink.close()
+
+    @property
+    def bytes_written(self):
+        return self.sink.bytes_written
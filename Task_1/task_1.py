@@ -1,28 +1,66 @@
 """## Validation Task"""
 
-import boto3, os
-import pandas as pd
+import os
+import json
+import contextlib
+import itertools
 from datetime import datetime
-from io import StringIO
+from functools import lru_cache
+from io import BytesIO
 import sys
+import time
+
+from common import aws_io
+from common.handoff import frame_key, get_format, save_frame
+from common.incremental import (
+    INCREMENTAL, PARKED_ON, PART_COLUMN, IncrementalState, park_items, save_batch_files,
+)
+from common.lazy import lazy_import, preload
+from common.metrics import RunMetrics, stage
+from common.products_cache import ProductsCache
+from common.rules import REASONS_COLUMN, IdSet, ValidationReport, validate
+from common.schemas import RAW_SCHEMAS
+from ingest import list_objects, list_keys, read_csvs_parallel, print_timing_report
+from streaming import (
+    DatasetWriter, OrderIdIndex, clean_order_items, clean_orders, iter_csv_chunks,
+)
+
+pd = lazy_import('pandas')
+
 # import logging
 
 # logging.basicConfig(level=logging.INFO)
 # logger = logging.getLogger(__name__)
 
-# Set up AWS creds
-AWS_ACCESS_KEY = os.environ.get('AWS_ACCESS_KEY_ID')
-AWS_SECRET_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
-AWS_REGION = os.environ.get('AWS_REGION', 'eu-west-1')
+# AWS credentials and AWS_REGION are read from the environment by common.aws_io
 S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME')
 
+# Number of part files fetched and parsed concurrently
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '8'))
+
+# Bounded-memory mode: validate the parts in chunks of this many rows
+STREAMING = os.environ.get('STREAMING', 'false').lower() in ('1', 'true', 'yes')
+STREAM_CHUNK_ROWS = int(os.environ.get('STREAM_CHUNK_ROWS', '100000'))
+
 # S3_BUCKET_NAME = 'e-commerce-shop-a'
 ARCHIVE_PREFIX = 'archive/'
 RAW_PREFIX = 'raw-data/'
 VALIDATED_PREFIX = 'validated/'
+QUARANTINE_PREFIX = 'quarantine/'
 
 # s3 = boto3.client('s3')
-s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY, aws_secret_access_key=AWS_SECRET_KEY)
+@lru_cache(maxsize=None)
+def get_s3():
+    """Create the S3 client on first use.
+
+    One client is shared by all ingestion workers, with a connection pool sized to match.
+    """
+    return aws_io.client('s3', MAX_WORKERS)
+
+@lru_cache(maxsize=None)
+def get_products_cache():
+    """Create the cache of validated products on first use."""
+    return ProductsCache(get_s3(), S3_BUCKET_NAME)
 
 DATE = datetime.today().date().isoformat()
 
@@ -30,6 +68,10 @@ product_file = f"{RAW_PREFIX}products.csv"
 orders_prefix = f"{RAW_PREFIX}orders/"
 order_items_prefix = f"{RAW_PREFIX}order_items/"
 
+# Columns parsed from the raw part files, as declared in the schema registry
+ORDERS_COLUMNS = RAW_SCHEMAS['orders'].usecols('validation')
+ORDER_ITEMS_COLUMNS = RAW_SCHEMAS['order_items'].usecols('validation')
+
 
 def s3_files_exist(prefix):
   """Check if any files exist at the given S3 prefix.
@@ -41,7 +83,7 @@ def s3_files_exist(prefix):
     bool: True if any files exist at the given prefix, False otherwise.
   """
   prefix = prefix.replace('//', '/')
-  response = s3.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=prefix)
+  response = get_s3().list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=prefix)
   return 'Contents' in response and len(response['Contents']) > 0
 
 def check_required_files():
@@ -73,73 +115,303 @@ def check_required_files():
 
 # print("All input files exist.")
 
-def read_csv_s3(key):
+def read_csv_s3(key, name=None):
     """Read a CSV file from S3 and return a pandas DataFrame.
 
     Args:
         key (str): The key of the CSV file to read.
+        name (str): The raw dataset the file belongs to. If given, only the columns
+            validation needs are parsed, into the dtypes declared for it.
 
     Returns:
         pandas.DataFrame: The contents of the CSV file.
     """
-    response = s3.get_object(Bucket=S3_BUCKET_NAME, Key=key)
-    return pd.read_csv(response['Body'])
+    response = get_s3().get_object(Bucket=S3_BUCKET_NAME, Key=key)
+    if name is None:
+        return pd.read_csv(response['Body'])
+    return RAW_SCHEMAS[name].read(BytesIO(response['Body'].read()), stage='validation')
 
-def read_all_csvs(prefix):
+def load_products():
+    """Load and validate the products, from the products cache when products.csv is unchanged.
+
+    Returns:
+        ValidationResult: The valid products and the rejected ones.
+    """
+    cache = get_products_cache()
+    entry = cache.load(product_file)
+    print(f"Loaded products from the {'file' if entry.source == 'source' else entry.source + ' cache'}: "
+          f"{json.dumps(cache.stats.to_dict())}")
+    return entry.result
+
+def read_all_csvs(prefix, name):
     """Read all CSV files from S3 at the given prefix and return a pandas DataFrame
     concatenated from all the files.
 
+    The listing is paginated, and the files are fetched and parsed concurrently
+    on up to ``MAX_WORKERS`` threads. A per-file timing report is printed.
+
     Args:
         prefix (str): The S3 prefix at which to read the CSV files.
+        name (str): The raw dataset the files belong to, for their declared schema.
 
     Returns:
         pandas.DataFrame: The concatenated contents of all the CSV files.
     """
-    resp = s3.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=prefix)
-    dfs = []
-    for obj in resp.get('Contents', []):
-        if obj['Key'].endswith('.csv'):
-            df = read_csv_s3(obj['Key'])
-            dfs.append(df)
-    return pd.concat(dfs, ignore_index=True)
+    return read_csv_parts(prefix, list_keys(get_s3(), S3_BUCKET_NAME, prefix), name)
+
+def read_csv_parts(prefix, keys, name, allow_empty=False, part_column=None):
+    """Read the given CSV part files concurrently and concatenate them.
+
+    Only the columns validation needs are parsed, into the dtypes declared for
+    the dataset in the schema registry.
+
+    Args:
+        prefix (str): The S3 prefix the keys were listed from, for the timing report.
+        keys (list): The keys of the CSV files to read.
+        name (str): The raw dataset the files belong to.
+        allow_empty (bool): Return an empty DataFrame when there are no keys,
+            instead of raising an error.
+        part_column (str): If given, add a column of this name with the key each
+            row was read from.
+
+    Returns:
+        pandas.DataFrame: The concatenated contents of the CSV files.
+    """
+    schema = RAW_SCHEMAS[name]
+    if not keys and allow_empty:
+        print(f"No new files in {prefix}")
+        df = schema.empty('validation')
+        return df if part_column is None else df.assign(**{part_column: pd.Series(dtype=object)})
+
+    start = time.perf_counter()
+    parse = lambda body: schema.read(body, stage='validation')
+    df, report = read_csvs_parallel(get_s3(), S3_BUCKET_NAME, keys, max_workers=MAX_WORKERS, parse=parse)
+    print_timing_report(prefix, report, time.perf_counter() - start)
+    if part_column is not None:
+        # The parts are concatenated in the order of the keys
+        df[part_column] = pd.Series(keys, dtype=object).repeat([stats['rows'] for stats in report]).to_numpy()
+    return df
+
+def find_parts():
+    """Find the order and order item parts this run validates.
+
+    In incremental mode, only the parts that are not in the manifest are picked
+    up. The products file and the picked-up parts are recorded under
+    ``validated/`` with their ETags, so the transformation task archives exactly
+    the files that were processed and, in incremental mode, adds them to the
+    manifest once their KPIs are written.
+
+    Returns:
+        tuple: The loaded ``IncrementalState`` (None unless ``INCREMENTAL`` is set),
+        and the keys of the orders and order items parts.
+    """
+    s3 = get_s3()
+    products = [obj for obj in list_objects(s3, S3_BUCKET_NAME, product_file) if obj['Key'] == product_file]
+    orders = list_objects(s3, S3_BUCKET_NAME, orders_prefix)
+    order_items = list_objects(s3, S3_BUCKET_NAME, order_items_prefix)
+
+    state = None
+    if INCREMENTAL:
+        state = IncrementalState.load(s3, S3_BUCKET_NAME)
+        orders = state.new_files(orders)
+        order_items = state.new_files(order_items)
+        print(f"Incremental run: {len(orders)} new orders part(s), {len(order_items)} new order_items part(s)")
+    save_batch_files(s3, S3_BUCKET_NAME, products + orders + order_items)
+
+    return state, [obj['Key'] for obj in orders], [obj['Key'] for obj in order_items]
+
+def read_new_parts():
+    """Read only the order and order item parts that are not in the incremental manifest.
+
+    The order items are read with the part file each came from, which the
+    incremental state counts separately.
+
+    Returns:
+        tuple: The new orders, the new order items together with the items parked
+        by earlier runs, and the order ids already known from earlier runs.
+    """
+    state, orders_keys, order_items_keys = find_parts()
+    orders = read_csv_parts(orders_prefix, orders_keys, 'orders', allow_empty=True)
+    order_items = read_csv_parts(
+        order_items_prefix, order_items_keys, 'order_items', allow_empty=True, part_column=PART_COLUMN
+    )
+
+    parked = parked_items(state, order_items_keys)
+    if len(parked):
+        order_items = pd.concat([order_items, parked], ignore_index=True)
+
+    return orders, order_items, state.orders_index['order_id']
+
+def parked_items(state, order_items_keys):
+    """Return the order items parked by earlier runs, to check against the known orders again.
+
+    The parked items of a part that is read again are left out, since its new
+    version replaces them.
+    """
+    parked = state.pending_items
+    if PART_COLUMN in parked:
+        parked = parked[~parked[PART_COLUMN].isin(order_items_keys)]
+    if len(parked):
+        print(f"Retrying {len(parked)} order item(s) parked by earlier runs")
+    return parked
 
 def run_validation():
     """
     Validates and cleans the product, order, and order item data.
 
     This function reads product, order, and order item data from S3, 
-    performs data cleaning by dropping null and invalid entries, 
-    ensures referential integrity by filtering order items with valid orders, 
-    and extracts date information from timestamp fields.
+    checks every row against the rules declared for its dataset in ``common.rules``
+    (required fields, ranges, statuses, timestamp ordering, and order items
+    referencing known orders and products) in one vectorized pass per dataset,
+    and extracts date information from timestamp fields. Rejected rows are saved
+    to the S3 "quarantine" folder with the reason codes they failed.
+
+    When ``INCREMENTAL`` is set, only the order and order item parts that are not
+    in the manifest are read, and order items may also reference orders from
+    earlier runs. Order items whose order is not known yet are saved to
+    ``validated/pending_items`` instead of being quarantined, for up to
+    ``PENDING_MAX_DAYS`` days.
 
     Returns:
         tuple: A tuple containing three pandas DataFrames for products, orders, and order items,
         which have been validated and are ready for further processing.
     """
 
-    products = read_csv_s3(product_file)
-    orders = read_all_csvs(orders_prefix)
-    order_items = read_all_csvs(order_items_prefix)
-
-    # Drop nulls and invalids
-    orders = orders.dropna(subset=['order_id', 'user_id', 'created_at'])
-    order_items = order_items.dropna(subset=['id', 'product_id', 'sale_price'])
-    order_items = order_items[order_items['sale_price'] > 0]
-
-    # Filter by referential integrity
-    valid_order_ids = set(orders['order_id'])
-    order_items = order_items[order_items['order_id'].isin(valid_order_ids)]
-
-    # Extracting the date from created_at and returned_at
-    # Create order_date column from created_at
-    orders['order_date'] = pd.to_datetime(orders['created_at']).dt.date
-    orders['return_date'] = pd.to_datetime(orders['returned_at']).dt.date
+    with stage('read') as s:
+        products_result = load_products()
+        products = products_result.valid
+        if INCREMENTAL:
+            orders, order_items, known_order_ids = read_new_parts()
+        else:
+            _, orders_keys, order_items_keys = find_parts()
+            orders = read_csv_parts(orders_prefix, orders_keys, 'orders')
+            order_items = read_csv_parts(order_items_prefix, order_items_keys, 'order_items')
+            known_order_ids = []
+        s.rows_out = len(products) + len(orders) + len(order_items)
+
+    with stage('validate') as s:
+        s.rows_in = len(products) + len(orders) + len(order_items)
+        report = ValidationReport()
+        results = {
+            'products': products_result,
+            'orders': validate(orders, 'orders'),
+        }
+        orders = results['orders'].valid
+
+        # Order items must reference a valid order, from this run or an earlier one, and a valid product
+        references = {
+            'orders': IdSet(pd.concat([orders['order_id'], pd.Series(known_order_ids, dtype='Int64')])),
+            'products': IdSet(products['id']),
+        }
+        results['order_items'] = validate(order_items, 'order_items', references)
+        order_items = results['order_items'].valid
+
+        order_items = order_items.drop(columns=PARKED_ON, errors='ignore')
+
+        rejected = {name: result.rejected.drop(columns=PARKED_ON, errors='ignore') for name, result in results.items()}
+        pending_items = order_items.iloc[:0]
+        if INCREMENTAL:
+            # Park items whose order may still arrive in a later drop, and give up on the ones parked too long
+            orphans, failed = results['order_items'].failed_only('unknown_order')
+            pending_items, expired = park_items(orphans)
+            failed = failed.drop(columns=PARKED_ON, errors='ignore')
+            rejected['order_items'] = pd.concat([failed, expired], ignore_index=True)
+            save_to_s3(pending_items, "pending_items")
+        for name, result in results.items():
+            report.add(name, result, parked=len(pending_items) if name == 'order_items' else 0)
+        save_quarantine(rejected, report)
+
+        # Extracting the date from created_at and returned_at
+        # Create order_date column from created_at
+        orders = orders.assign(
+            order_date=pd.to_datetime(orders['created_at']).dt.date,
+            return_date=pd.to_datetime(orders['returned_at']).dt.date,
+        )
+        s.rows_out = len(products) + len(orders) + len(order_items)
 
     # # Creating an is-retunred column
     # orders['is_returned'] = orders['returned_at'].notna()
 
     return products, orders, order_items
 
+def run_streaming_validation():
+    """
+    Validates and cleans the data like ``run_validation``, in bounded memory.
+
+    The order parts are read and validated in chunks of ``STREAM_CHUNK_ROWS`` rows
+    while their ids are collected into a compact sorted index. The order item
+    parts are then validated against that index chunk by chunk. Each validated
+    dataset, and each dataset's rejected rows, is streamed to the S3 "validated"
+    and "quarantine" folders with a multipart upload instead of being built in
+    memory first.
+
+    Returns:
+        dict: The number of rows written per dataset.
+    """
+    fmt = get_format()
+    report = ValidationReport()
+    with stage('products') as s:
+        products_result = load_products()
+        report.add('products', products_result)
+        products = products_result.valid
+        save_to_s3(products, "products")
+        s.rows_out = len(products)
+
+    with stage('list_parts'):
+        state, orders_keys, order_items_keys = find_parts()
+        if INCREMENTAL:
+            index = OrderIdIndex(state.orders_index['order_id'])
+            parked = parked_items(state, order_items_keys)
+            parked = [parked] if len(parked) else []
+        else:
+            index = OrderIdIndex()
+            parked = []
+
+    def writer(name, columns, prefix=VALIDATED_PREFIX):
+        key = frame_key(prefix, name, fmt)
+        return DatasetWriter(get_s3(), S3_BUCKET_NAME, key, fmt, name, columns, chunk_rows=STREAM_CHUNK_ROWS)
+
+    with stage('orders') as s, contextlib.ExitStack() as stack:
+        orders_out = stack.enter_context(writer("orders", ORDERS_COLUMNS + ['order_date', 'return_date']))
+        rejected = stack.enter_context(writer("orders", ORDERS_COLUMNS + [REASONS_COLUMN], quarantine_prefix()))
+        chunks = iter_csv_chunks(get_s3(), S3_BUCKET_NAME, orders_keys, STREAM_CHUNK_ROWS, RAW_SCHEMAS['orders'], 'validation')
+        for orders in clean_orders(chunks, index, report, rejected):
+            orders_out.write(orders)
+        s.rows_out = orders_out.rows
+
+    with stage('order_items') as s, contextlib.ExitStack() as stack:
+        columns = ORDER_ITEMS_COLUMNS + ([PART_COLUMN] if INCREMENTAL else [])
+        items_out = stack.enter_context(writer("order_items", columns))
+        rejected = stack.enter_context(writer("order_items", columns + [REASONS_COLUMN], quarantine_prefix()))
+        pending_out = None
+        if INCREMENTAL:
+            pending_out = stack.enter_context(writer("pending_items", columns + [PARKED_ON]))
+
+        def read_chunks(keys):
+            return iter_csv_chunks(
+                get_s3(), S3_BUCKET_NAME, keys, STREAM_CHUNK_ROWS, RAW_SCHEMAS['order_items'], 'validation'
+            )
+
+        if INCREMENTAL:
+            # Tag the items with their part file, which the incremental state counts separately
+            chunks = (chunk.assign(**{PART_COLUMN: key}) for key in order_items_keys for chunk in read_chunks([key]))
+        else:
+            chunks = read_chunks(order_items_keys)
+        references = {'orders': index, 'products': IdSet(products['id'])}
+        for order_items, orphans in clean_order_items(
+            itertools.chain(chunks, parked), references, report, rejected, park_orphans=INCREMENTAL,
+        ):
+            items_out.write(order_items)
+            if pending_out is not None:
+                # Park items whose order may still arrive in a later drop
+                pending_out.write(orphans)
+        s.rows_out = items_out.rows
+
+    save_quarantine({'products': products_result.rejected}, report)
+    rows = {'products': len(products), 'orders': orders_out.rows, 'order_items': items_out.rows}
+    print(f"Streamed validated data to S3: {rows}, {len(index)} valid order ids")
+    return rows
+
 # products_df, orders_df, order_items_df = run_validation()
 # print("Validation complete.")
 
@@ -147,17 +419,40 @@ def run_validation():
 # Saving the data to s3 "validated" folder
 def save_to_s3(df, name):
     """
-    Save a pandas DataFrame to S3 as a CSV file.
+    Save a pandas DataFrame to the S3 "validated" folder in the hand-off format.
+
+    The format is compressed Parquet by default, or CSV when ``HANDOFF_FORMAT=csv``.
 
     Args:
         df (pandas.DataFrame): The DataFrame to save.
-        name (str): The name of the file to save the data to, without the .csv extension.
+        name (str): The dataset name, without a file extension.
+    """
+    key = save_frame(get_s3(), S3_BUCKET_NAME, VALIDATED_PREFIX, name, df)
+    print(f"Saved {name} to: s3://{S3_BUCKET_NAME}/{key}")
+
+@lru_cache(maxsize=None)
+def quarantine_prefix():
+    """Return this run's folder under quarantine/, named after the time it was first used."""
+    return f"{QUARANTINE_PREFIX}{datetime.utcnow().strftime('%Y-%m-%d-T-%H-%M-%S')}/"
+
+def save_quarantine(rejected, report):
     """
-    csv_buffer = StringIO()
-    df.to_csv(csv_buffer, index=False)
-    s3.put_object(Bucket=S3_BUCKET_NAME, Key=VALIDATED_PREFIX + name, Body=csv_buffer.getvalue())
+    Save the rejected rows and the reject counts to the S3 "quarantine" folder.
 
-print("Validation data saved to S3.")
+    Each dataset's rejected rows are saved in the hand-off format with a ``reasons``
+    column of the reason codes they failed, next to a ``summary.json`` with the
+    rows rejected per dataset and per rule. The reject rates are also printed.
+
+    Args:
+        rejected (dict): The rejected rows of each dataset, by dataset name.
+        report (ValidationReport): The reject counts of the run.
+    """
+    prefix = quarantine_prefix()
+    for name, df in rejected.items():
+        key = save_frame(get_s3(), S3_BUCKET_NAME, prefix, name, df)
+        print(f"Quarantined {len(df)} {name} row(s) to: s3://{S3_BUCKET_NAME}/{key}")
+    get_s3().put_object(Bucket=S3_BUCKET_NAME, Key=f"{prefix}summary.json", Body=report.to_json().encode('utf-8'))
+    report.report()
 
 def main():
     """
@@ -171,18 +466,28 @@ def main():
         int: The exit status of the script.
     """
     try:
-        print("Checking for required files...")
-        check_required_files()
-        print("All input files exist.")
-
-        print("Validating data...")
-        products_df, orders_df, order_items_df = run_validation()
-
-        save_to_s3(products_df, "products.csv")
-        save_to_s3(orders_df, "orders.csv")
-        save_to_s3(order_items_df, "order_items.csv")
-
-        print("Validation complete and saved to S3.")
+        with RunMetrics('validation', [get_s3()]):
+            # Import pandas and pyarrow while the first S3 requests are in flight
+            preload('pandas', 'pyarrow.parquet')
+
+            print("Checking for required files...")
+            with stage('check_required_files'):
+                check_required_files()
+            print("All input files exist.")
+
+            print("Validating data...")
+            if STREAMING:
+                run_streaming_validation()
+            else:
+                products_df, orders_df, order_items_df = run_validation()
+
+                with stage('save_validated') as s:
+                    s.rows_in = len(products_df) + len(orders_df) + len(order_items_df)
+                    save_to_s3(products_df, "products")
+                    save_to_s3(orders_df, "orders")
+                    save_to_s3(order_items_df, "order_items")
+
+            print("Validation complete and saved to S3.")
 
         sys.exit(0)
 
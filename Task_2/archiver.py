@@ -0,0 +1,272 @@
+"""## Parallel archiver for the raw input files
+
+Moves the raw files a run processed from ``raw-data/`` to a folder under
+``archive/``:
+
+- when no file list is given, the sources are listed lazily, page by page;
+- objects are copied server-side on a thread pool, and objects above
+  ``multipart_threshold`` with a multipart copy whose parts are copied in parallel;
+- every copy is checked against its source (size and source ETag) before the
+  source is deleted;
+- sources are deleted with ``delete_objects``, up to 1000 keys per call;
+- the files and the destination folder are recorded in a journal before the
+  first copy, so an archive that fails part-way resumes into the same folder
+  on the next run and skips the copies that were already made.
+"""
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from botocore.exceptions import ClientError
+
+MIB = 1024 * 1024
+
+# DeleteObjects accepts at most 1000 keys per call
+DELETE_BATCH_SIZE = 1000
+
+JOURNAL_KEY = 'status/archive_journal.json'
+
+# Copies are tagged with the ETag of their source, which is how they are verified
+SOURCE_ETAG = 'source-etag'
+
+MISSING_ERRORS = ('404', 'NoSuchKey', 'NotFound')
+CHANGED_ERRORS = ('412', 'PreconditionFailed')
+
+
+class ArchiveStats:
+    """Thread-safe counters for one archive run."""
+
+    def __init__(self):
+        self.files = 0
+        self.copied = 0
+        self.multipart = 0
+        self.resumed = 0
+        self.changed = 0
+        self.missing = 0
+        self.deleted = 0
+        self.delete_batches = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        # The source keys moved to the archive
+        self.archived = []
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def report(self):
+        """Print a one-line summary of the archive."""
+        print(
+            f"Archived {self.deleted} of {self.files} file(s), {self.bytes / MIB:.1f} MiB, in {self.elapsed:.2f}s "
+            f"({self.copied} copied, {self.multipart} by multipart copy, {self.resumed} already archived, "
+            f"{self.changed} changed since processing, {self.missing} missing, "
+            f"{self.delete_batches} delete batch(es))"
+        )
+
+
+def iter_objects(s3, bucket, prefix, suffix='.csv'):
+    """Yield the objects under an S3 prefix one listing page at a time.
+
+    Yields:
+        dict: The matching ``list_objects_v2`` entries, in the order S3 lists them.
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith(suffix):
+                yield obj
+
+
+def _error_code(error):
+    return error.response.get('Error', {}).get('Code')
+
+
+def _head(s3, bucket, key):
+    """Return the ``head_object`` response for a key, or None if it does not exist."""
+    try:
+        return s3.head_object(Bucket=bucket, Key=key)
+    except ClientError as error:
+        if _error_code(error) in MISSING_ERRORS:
+            return None
+        raise
+
+
+def _verified(copy, source):
+    """Whether a copy has the size of its source and was made from the source's current version."""
+    return (
+        copy is not None
+        and copy['ContentLength'] == source['ContentLength']
+        and copy.get('Metadata', {}).get(SOURCE_ETAG) == source['ETag'].strip('"')
+    )
+
+
+def _copy_attributes(source):
+    """The content type and user metadata of a copy, tagged with the source ETag."""
+    metadata = dict(source.get('Metadata', {}))
+    metadata[SOURCE_ETAG] = source['ETag'].strip('"')
+    return {'ContentType': source.get('ContentType', 'binary/octet-stream'), 'Metadata': metadata}
+
+
+def _multipart_copy(s3, bucket, key, archive_key, source, part_size, part_workers):
+    """Copy an object with ``upload_part_copy``, copying its byte ranges in parallel."""
+    upload = s3.create_multipart_upload(Bucket=bucket, Key=archive_key, **_copy_attributes(source))
+    size = source['ContentLength']
+    ranges = [(number, start, min(start + part_size, size) - 1)
+              for number, start in enumerate(range(0, size, part_size), start=1)]
+
+    def copy_part(part):
+        number, first, last = part
+        response = s3.upload_part_copy(
+            Bucket=bucket, Key=archive_key, UploadId=upload['UploadId'], PartNumber=number,
+            CopySource={'Bucket': bucket, 'Key': key}, CopySourceRange=f"bytes={first}-{last}",
+            CopySourceIfMatch=source['ETag'],
+        )
+        return {'PartNumber': number, 'ETag': response['CopyPartResult']['ETag']}
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(part_workers, len(ranges)))) as pool:
+            parts = list(pool.map(copy_part, ranges))
+        s3.complete_multipart_upload(
+            Bucket=bucket, Key=archive_key, UploadId=upload['UploadId'], MultipartUpload={'Parts': parts},
+        )
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket, Key=archive_key, UploadId=upload['UploadId'])
+        raise
+
+
+def _archive_one(s3, bucket, key, etag, archive_key, stats, resume, multipart_threshold, part_size, part_workers):
+    """Copy one file to the archive and verify the copy.
+
+    Returns:
+        str: The key, if the source can be deleted, or None.
+    """
+    source = _head(s3, bucket, key)
+    if source is None:
+        if resume and _head(s3, bucket, archive_key) is not None:
+            # Archived and deleted by the run being resumed
+            stats.add(resumed=1)
+        else:
+            print(f"Skipping {key}: it no longer exists")
+            stats.add(missing=1)
+        return None
+
+    if etag is not None and source['ETag'] != etag:
+        # Replaced after it was processed: leave it for the next run
+        print(f"Skipping {key}: it changed since it was processed")
+        stats.add(changed=1)
+        return None
+
+    if resume and _verified(_head(s3, bucket, archive_key), source):
+        stats.add(resumed=1, bytes=source['ContentLength'])
+        return key
+
+    try:
+        if source['ContentLength'] > multipart_threshold:
+            _multipart_copy(s3, bucket, key, archive_key, source, part_size, part_workers)
+            stats.add(multipart=1)
+        else:
+            s3.copy_object(
+                Bucket=bucket, Key=archive_key, CopySource={'Bucket': bucket, 'Key': key},
+                CopySourceIfMatch=source['ETag'], MetadataDirective='REPLACE', **_copy_attributes(source),
+            )
+    except ClientError as error:
+        if _error_code(error) not in CHANGED_ERRORS + MISSING_ERRORS:
+            raise
+        print(f"Skipping {key}: it changed while it was being copied")
+        stats.add(changed=1)
+        return None
+
+    if not _verified(_head(s3, bucket, archive_key), source):
+        raise RuntimeError(f"Archive copy s3://{bucket}/{archive_key} does not match its source {key}")
+    stats.add(copied=1, bytes=source['ContentLength'])
+    return key
+
+
+def _delete_batch(s3, bucket, keys, stats):
+    """Delete up to 1000 verified sources with one ``delete_objects`` call."""
+    response = s3.delete_objects(
+        Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True},
+    )
+    errors = response.get('Errors', [])
+    if errors:
+        first = errors[0]
+        raise RuntimeError(f"Failed to delete {len(errors)} archived file(s), e.g. {first['Key']}: {first['Message']}")
+    stats.add(deleted=len(keys), delete_batches=1, archived=list(keys))
+
+
+def load_journal(s3, bucket, journal_key=JOURNAL_KEY):
+    """Load the journal of an unfinished archive, or None if there is none."""
+    try:
+        response = s3.get_object(Bucket=bucket, Key=journal_key)
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(response['Body'].read())
+
+
+def archive(s3, bucket, files, destination, journal_key=JOURNAL_KEY, max_workers=16,
+            multipart_threshold=256 * MIB, part_size=128 * MIB, part_workers=4):
+    """Move files to an archive folder in the same bucket.
+
+    If the journal of an unfinished archive exists, that archive is resumed:
+    ``files`` are added to its files and archived into its destination, and
+    ``destination`` is ignored.
+
+    Args:
+        s3: A boto3 S3 client.
+        bucket (str): The bucket holding the files.
+        files: The keys to archive, either a dict mapping each key to the ETag it
+            was processed at or an iterable of keys. A file whose ETag no longer
+            matches is left in place.
+        destination (str): The archive folder, e.g. ``archive/<timestamp>/``. Each
+            key is archived under it without its first path segment.
+        journal_key (str): Where the unfinished archive is recorded.
+        max_workers (int): The number of files copied at once.
+        multipart_threshold (int): Files larger than this many bytes are copied
+            with a multipart copy. It must not exceed 5 GiB, the CopyObject limit.
+        part_size (int): The byte range copied per part, at least 5 MiB.
+        part_workers (int): The number of parts of one file copied at once.
+
+    Returns:
+        ArchiveStats: The counters of the archive.
+    """
+    stats = ArchiveStats()
+    start = time.perf_counter()
+
+    files = files if isinstance(files, dict) else dict.fromkeys(files)
+    journal = load_journal(s3, bucket, journal_key)
+    resume = journal is not None
+    if resume:
+        print(f"Resuming the unfinished archive to {journal['destination']}")
+        journal['files'].update(files)
+    else:
+        journal = {'destination': destination, 'files': files}
+    s3.put_object(Bucket=bucket, Key=journal_key, Body=json.dumps(journal).encode('utf-8'))
+    stats.files = len(journal['files'])
+
+    def archive_file(key, etag):
+        archive_key = journal['destination'] + key.split('/', 1)[1]
+        return _archive_one(
+            s3, bucket, key, etag, archive_key, stats, resume, multipart_threshold, part_size, part_workers,
+        )
+
+    # Sources are deleted in full batches as their copies are verified
+    verified = []
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = [pool.submit(archive_file, key, etag) for key, etag in journal['files'].items()]
+        for future in as_completed(futures):
+            key = future.result()
+            if key is not None:
+                verified.append(key)
+            if len(verified) == DELETE_BATCH_SIZE:
+                _delete_batch(s3, bucket, verified, stats)
+                verified = []
+    if verified:
+        _delete_batch(s3, bucket, verified, stats)
+
+    s3.delete_object(Bucket=bucket, Key=journal_key)
+    stats.elapsed = time.perf_counter() - start
+    return stats
@@ -0,0 +1,210 @@
+"""## Batched DynamoDB writer for the KPI tables"""
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+from common.aws_io import THROTTLE_ERRORS, record_throttle
+from common.lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+# BatchWriteItem accepts at most 25 put requests per call
+BATCH_SIZE = 25
+
+
+class WriteStats:
+    """Thread-safe throughput and throttle counters for one table write."""
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.items = 0
+        self.batches = 0
+        self.requests = 0
+        self.unprocessed_retries = 0
+        self.throttles = 0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def report(self):
+        """Print a one-line summary of the write."""
+        rate = self.items / self.elapsed if self.elapsed else 0.0
+        print(
+            f"{self.table_name}: wrote {self.items} items in {self.batches} batches "
+            f"({self.requests} requests, {self.unprocessed_retries} unprocessed retries, "
+            f"{self.throttles} throttles) in {self.elapsed:.2f}s, {rate:.0f} items/s"
+        )
+
+
+def _iso_dates(column):
+    """Convert an ``order_date`` column of dates or strings to ISO 8601 strings."""
+    return pd.to_datetime(column).dt.strftime('%Y-%m-%d').tolist()
+
+
+def _decimals(column, ndigits=None):
+    """Convert a float column to Decimals, optionally rounding first."""
+    values = column.tolist()
+    if ndigits is not None:
+        values = [round(value, ndigits) for value in values]
+    return [Decimal(str(value)) for value in values]
+
+
+def category_kpi_columns(cat_kpi):
+    """Build the CategoryKPI item attributes column-wise from the category-level KPIs.
+
+    Args:
+        cat_kpi (pd.DataFrame): The category-level KPIs.
+
+    Returns:
+        dict: One list of attribute values per attribute name, in row order.
+    """
+    return {
+        'category': cat_kpi['category'].tolist(),
+        'order_date': _iso_dates(cat_kpi['order_date']),
+        'daily_revenue': _decimals(cat_kpi['daily_revenue']),
+        'avg_order_value': _decimals(cat_kpi['avg_order_value']),
+        'avg_return_rate': _decimals(cat_kpi['avg_return_rate'], 2),
+    }
+
+
+def order_kpi_columns(order_kpi):
+    """Build the OrderKPI item attributes column-wise from the order-level KPIs.
+
+    Args:
+        order_kpi (pd.DataFrame): The order-level KPIs.
+
+    Returns:
+        dict: One list of attribute values per attribute name, in row order.
+    """
+    return {
+        'order_date': _iso_dates(order_kpi['order_date']),
+        'total_orders': order_kpi['total_orders'].tolist(),
+        'total_revenue': _decimals(order_kpi['total_revenue']),
+        'total_items_sold': order_kpi['total_items_sold'].tolist(),
+        'return_rate': _decimals(order_kpi['return_rate'], 2),
+        'unique_customers': order_kpi['unique_customers'].tolist(),
+    }
+
+
+def rolling_kpi_columns(rolling):
+    """Build the rolling KPI item attributes column-wise from the rolling-window KPIs.
+
+    Args:
+        rolling (pd.DataFrame): The rolling-window KPIs (see ``rolling``).
+
+    Returns:
+        dict: One list of attribute values per attribute name, in row order.
+    """
+    columns = {
+        'category': rolling['category'].tolist(),
+        'order_date': _iso_dates(rolling['order_date']),
+    }
+    for name in rolling.columns[2:]:
+        if name.startswith('orders_'):
+            columns[name] = rolling[name].tolist()
+        else:
+            columns[name] = _decimals(rolling[name], 2 if name.startswith('return_rate_') else None)
+    return columns
+
+
+def items_from_columns(columns, mask=None):
+    """Zip item attribute columns into item dicts, only for the rows where ``mask`` is True if given."""
+    rows = zip(*columns.values())
+    if mask is not None:
+        rows = (values for values, keep in zip(rows, mask) if keep)
+    return [dict(zip(columns, values)) for values in rows]
+
+
+def category_kpi_items(cat_kpi):
+    """Build CategoryKPI item payloads column-wise from the category-level KPIs.
+
+    Args:
+        cat_kpi (pd.DataFrame): The category-level KPIs.
+
+    Returns:
+        list: One item dict per KPI row.
+    """
+    return items_from_columns(category_kpi_columns(cat_kpi))
+
+
+def order_kpi_items(order_kpi):
+    """Build OrderKPI item payloads column-wise from the order-level KPIs.
+
+    Args:
+        order_kpi (pd.DataFrame): The order-level KPIs.
+
+    Returns:
+        list: One item dict per KPI row.
+    """
+    return items_from_columns(order_kpi_columns(order_kpi))
+
+
+def _write_batch(client, table_name, requests, stats, max_retries, base_delay):
+    """Send one BatchWriteItem call and retry its UnprocessedItems with backoff."""
+    pending = {table_name: requests}
+    for attempt in range(max_retries + 1):
+        started = time.monotonic()
+        try:
+            response = client.batch_write_item(RequestItems=pending)
+            stats.add(requests=1)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in THROTTLE_ERRORS:
+                raise
+            stats.add(requests=1, throttles=1)
+        else:
+            pending = response.get('UnprocessedItems') or {}
+            if not pending:
+                return
+            stats.add(unprocessed_retries=1)
+            # Unprocessed items mean the table is throttling, so fewer batches go in flight
+            record_throttle('dynamodb', started)
+
+        if attempt < max_retries:
+            # Full jitter exponential backoff, capped at a few seconds
+            time.sleep(random.uniform(0, min(5.0, base_delay * 2 ** attempt)))
+
+    raise RuntimeError(f"Failed to write batch to {table_name} after {max_retries} retries")
+
+
+def batch_write(client, table_name, items, max_workers=4, max_retries=8, base_delay=0.05):
+    """Write items to a DynamoDB table with parallel BatchWriteItem calls.
+
+    Args:
+        client: The client of a boto3 DynamoDB resource (``ddb.meta.client``), which
+            serializes plain Python values.
+        table_name (str): The table to write to.
+        items (list): The item dicts to put.
+        max_workers (int): The number of batches in flight at once.
+        max_retries (int): How many times a batch's UnprocessedItems are retried.
+        base_delay (float): The base backoff delay in seconds.
+
+    Returns:
+        WriteStats: The throughput and throttle counters for the write.
+    """
+    stats = WriteStats(table_name)
+    start = time.perf_counter()
+
+    batches = [
+        [{'PutRequest': {'Item': item}} for item in items[i:i + BATCH_SIZE]]
+        for i in range(0, len(items), BATCH_SIZE)
+    ]
+
+    def write(batch):
+        _write_batch(client, table_name, batch, stats, max_retries, base_delay)
+        stats.add(items=len(batch), batches=1)
+
+    if batches:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as pool:
+            list(pool.map(write, batches))
+
+    stats.elapsed = time.perf_counter() - start
+    return stats
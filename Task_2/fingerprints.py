@@ -0,0 +1,201 @@
+"""## Change detection for the KPI items written to DynamoDB
+
+Most (category, order_date) KPI rows of a run come out identical to the items
+already in the tables. Each item is fingerprinted with a 64-bit hash of its
+attributes, exactly as they are sent to DynamoDB, and compared with the
+fingerprints of the items earlier runs wrote, kept per table in a compact
+Parquet side file:
+
+    state/kpi_fingerprints/<table>.parquet   the key attributes and fingerprint of every written item
+
+Only new and changed items are written. The side file records when the table
+was created, so the fingerprints of a table that was deleted and recreated are
+discarded instead of trusted, and it is updated only after the writes
+succeed, so the items of a failed write are all sent again by the next run.
+The micro-batches (see ``common.microbatch``) only update items no batch run
+has written whole, so they never change an item behind its fingerprint.
+"""
+
+from io import BytesIO
+
+from common.incremental import STATE_PREFIX
+from common.lazy import lazy_import
+from common.metrics import count
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+FINGERPRINTS_PREFIX = 'kpi_fingerprints/'
+FINGERPRINT_COLUMN = 'fingerprint'
+CREATED_METADATA = b'table_created'
+
+# A write unit covers an item of up to 1 KB
+WRITE_UNIT_BYTES = 1024
+
+
+def attribute_strings(columns):
+    """Render item attributes, built column-wise, as a frame of the strings sent to DynamoDB.
+
+    Numbers are rendered by their decimal representation, as DynamoDB receives them.
+    """
+    return pd.DataFrame({name: [str(value) for value in values] for name, values in columns.items()})
+
+
+def fingerprints(strings):
+    """Hash the attributes of each item, rendered by ``attribute_strings``, to one uint64 per item."""
+    return pd.util.hash_pandas_object(strings, index=False).to_numpy()
+
+
+def write_units(columns, strings):
+    """Approximate the write units a PutItem of each item consumes, as DynamoDB bills them.
+
+    Args:
+        columns (dict): The items' attributes, built column-wise.
+        strings (pandas.DataFrame): The same attributes rendered by ``attribute_strings``.
+    """
+    sizes = np.zeros(len(strings), dtype='int64')
+    if not len(strings):
+        # No items, and columns built from no values have no string dtype
+        return sizes
+    for name, values in columns.items():
+        lengths = strings[name].str.encode('utf-8').str.len().to_numpy(dtype='int64')
+        if len(values) and not isinstance(values[0], str):
+            # Numbers take about one byte per two significant digits, plus one
+            lengths = (lengths + 1) // 2 + 1
+        sizes += len(name.encode('utf-8')) + lengths
+    return np.maximum(1, -(-sizes // WRITE_UNIT_BYTES))
+
+
+class ChangeReport:
+    """The items of one table a run wrote and skipped, and their write units."""
+
+    def __init__(self, table_name, written=0, skipped=0, units_written=0, units_saved=0, reset=False):
+        self.table_name = table_name
+        self.written = written
+        self.skipped = skipped
+        self.units_written = units_written
+        self.units_saved = units_saved
+        self.reset = reset
+
+    def to_dict(self):
+        return {
+            'table': self.table_name,
+            'written': self.written,
+            'skipped': self.skipped,
+            'units_written': self.units_written,
+            'units_saved': self.units_saved,
+        }
+
+    def report(self):
+        total = self.written + self.skipped
+        share = self.skipped / total if total else 0.0
+        print(
+            f"{self.table_name}: {self.written} new or changed items written, {self.skipped} unchanged "
+            f"items skipped ({share:.1%}), {self.units_saved} of {self.units_written + self.units_saved} "
+            f"write units saved" + (" (fingerprints reset: the table was recreated)" if self.reset else "")
+        )
+
+
+class FingerprintStore:
+    """The fingerprints of the items written to one KPI table.
+
+    Args:
+        table_name (str): The DynamoDB table.
+        keys (list): The key attributes of its items.
+        table_created (str): When the table was created, in ISO 8601.
+        stored (pandas.DataFrame): The key attributes and fingerprints of the written items.
+        reset (bool): Whether stored fingerprints were discarded because the table was recreated.
+    """
+
+    def __init__(self, table_name, keys, table_created, stored, reset=False):
+        self.table_name = table_name
+        self.keys = keys
+        self.table_created = table_created
+        self.stored = stored
+        self.reset = reset
+        self.pending = None
+
+    @staticmethod
+    def key(table_name, prefix=STATE_PREFIX):
+        return f"{prefix}{FINGERPRINTS_PREFIX}{table_name}.parquet"
+
+    @classmethod
+    def load(cls, s3, bucket, client, table_name, keys, prefix=STATE_PREFIX):
+        """Load the fingerprints of a table, or none if it has none or was recreated since they were saved.
+
+        Args:
+            s3: A boto3 S3 client.
+            bucket (str): The bucket of the side file.
+            client: A boto3 DynamoDB client, to look up when the table was created.
+            table_name (str): The DynamoDB table.
+            keys (list): The key attributes of its items.
+            prefix (str): The state prefix the side file is under.
+        """
+        import pyarrow.parquet as pq
+
+        table_created = client.describe_table(TableName=table_name)['Table']['CreationDateTime'].isoformat()
+        empty = pd.DataFrame({**{key: pd.Series(dtype='object') for key in keys},
+                              FINGERPRINT_COLUMN: pd.Series(dtype='uint64')})
+        try:
+            response = s3.get_object(Bucket=bucket, Key=cls.key(table_name, prefix))
+        except s3.exceptions.NoSuchKey:
+            return cls(table_name, keys, table_created, empty)
+
+        table = pq.read_table(BytesIO(response['Body'].read()))
+        if (table.schema.metadata or {}).get(CREATED_METADATA, b'').decode('utf-8') != table_created:
+            return cls(table_name, keys, table_created, empty, reset=True)
+        return cls(table_name, keys, table_created, table.to_pandas())
+
+    def _index(self, frame):
+        return pd.MultiIndex.from_frame(frame[self.keys])
+
+    def changed(self, columns):
+        """Compare a run's items with the stored fingerprints.
+
+        The fingerprints of the compared items are kept until ``save``.
+
+        Args:
+            columns (dict): The items' attributes, built column-wise.
+
+        Returns:
+            tuple: A boolean array that is True for the new and changed items, and
+            the ``ChangeReport`` of the comparison.
+        """
+        strings = attribute_strings(columns)
+        current = pd.DataFrame({key: columns[key] for key in self.keys})
+        current[FINGERPRINT_COLUMN] = fingerprints(strings)
+        positions = self._index(self.stored).get_indexer(self._index(current))
+        previous = self.stored[FINGERPRINT_COLUMN].to_numpy()
+        unchanged = positions >= 0
+        unchanged[unchanged] = previous[positions[unchanged]] == current[FINGERPRINT_COLUMN].to_numpy()[unchanged]
+        self.pending = current
+
+        units = write_units(columns, strings)
+        report = ChangeReport(
+            self.table_name,
+            written=int((~unchanged).sum()),
+            skipped=int(unchanged.sum()),
+            units_written=int(units[~unchanged].sum()),
+            units_saved=int(units[unchanged].sum()),
+            reset=self.reset,
+        )
+        count('ddb.items_skipped', report.skipped)
+        count('ddb.write_units_saved', report.units_saved)
+        return ~unchanged, report
+
+    def save(self, s3, bucket, prefix=STATE_PREFIX):
+        """Merge the fingerprints of the compared items into the side file, once they are written."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.pending is None:
+            return
+        replaced = self._index(self.stored).isin(self._index(self.pending))
+        self.stored = pd.concat([self.stored[~replaced], self.pending], ignore_index=True)
+        self.pending = None
+
+        table = pa.Table.from_pandas(self.stored, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), CREATED_METADATA: self.table_created})
+        buffer = BytesIO()
+        pq.write_table(table, buffer, compression='zstd')
+        s3.put_object(Bucket=bucket, Key=self.key(self.table_name, prefix), Body=buffer.getvalue())
@@ -0,0 +1,76 @@
+"""## HyperLogLog sketches for mergeable distinct counts
+
+Holds one sketch per group code, as a ``(groups, 2 ** precision)`` array of
+``uint8`` registers. Sketches built over different shards of the data merge
+by taking the register-wise maximum, so a distinct count that cannot be summed
+across shards can still be estimated from them. The relative standard error
+is about ``1.04 / sqrt(2 ** precision)``, 1.6% at the default precision of 12.
+"""
+
+from common.lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+
+def _leading_zeros(values):
+    """Count the leading zero bits of each uint64 value, with a vectorized binary search."""
+    values = values.copy()
+    zeros = np.zeros(len(values), dtype='uint8')
+    for shift in (32, 16, 8, 4, 2, 1):
+        top_clear = values < np.uint64(1) << np.uint64(64 - shift)
+        zeros[top_clear] += shift
+        values[top_clear] <<= np.uint64(shift)
+    return zeros
+
+
+class HyperLogLog:
+    """HyperLogLog sketches of the distinct values in each group.
+
+    Args:
+        n_groups (int): The number of groups.
+        precision (int): The number of hash bits that pick a register, from 4 to 16.
+        registers (numpy.ndarray): Existing registers to wrap, e.g. from another process.
+    """
+
+    def __init__(self, n_groups, precision=12, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError(f"HyperLogLog precision must be between 4 and 16, not {precision}")
+        self.precision = precision
+        if registers is None:
+            registers = np.zeros((n_groups, 1 << precision), dtype='uint8')
+        self.registers = registers
+
+    def add(self, groups, values):
+        """Add integer values to the sketches of their groups.
+
+        Args:
+            groups (numpy.ndarray): The group code of each value.
+            values (numpy.ndarray): The values, hashed with ``pandas.util.hash_array``.
+        """
+        p = np.uint64(self.precision)
+        hashes = pd.util.hash_array(np.asarray(values))
+        index = (hashes >> (np.uint64(64) - p)).astype('int64')
+        # The guard bit caps the rank at 64 - precision + 1
+        rest = (hashes << p) | (np.uint64(1) << (p - np.uint64(1)))
+        np.maximum.at(self.registers, (np.asarray(groups), index), _leading_zeros(rest) + 1)
+
+    def merge(self, other):
+        """Merge another set of sketches over the same groups into this one."""
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self):
+        """Estimate the number of distinct values per group.
+
+        Returns:
+            numpy.ndarray: The rounded estimates, as int64.
+        """
+        m = self.registers.shape[1]
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.exp2(-self.registers.astype('float64')).sum(axis=1)
+        zeros = (self.registers == 0).sum(axis=1)
+        # Linear counting is more accurate while many registers are still empty
+        small = (raw <= 2.5 * m) & (zeros > 0)
+        linear = m * np.log(m / np.maximum(zeros, 1))
+        return np.rint(np.where(small, linear, raw)).astype('int64')
@@ -0,0 +1,192 @@
+"""## Single-pass KPI engine for the Transformation Task
+
+Computes the category-level and order-level KPIs of ``run_transformation``
+without materializing the merged order items x orders frame. Only the join
+keys and the measured columns are projected, categories and order dates are
+factorized to integer codes once, and both KPI tables are aggregated from the
+same code arrays.
+
+The output is identical to the original groupby implementation, down to the
+last bit: revenue is still summed by pandas' grouped sum over the order items
+in their original order, and every other aggregate is an exact integer count.
+"""
+
+from common.lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+CATEGORY_KPI_COLUMNS = ['category', 'order_date', 'daily_revenue', 'avg_order_value', 'avg_return_rate']
+CATEGORY_COUNT_COLUMNS = ['category', 'order_date', 'revenue_cents', 'returned_items', 'order_count']
+ORDER_KPI_COLUMNS = [
+    'order_date', 'total_orders', 'total_revenue', 'total_items_sold', 'return_rate', 'unique_customers',
+]
+
+
+def _join_orders(orders, order_items):
+    """Match each order item to its order, like an inner merge on ``order_id``.
+
+    Returns:
+        tuple: For the matched items in merge order, the item row positions, the
+        order row positions, and a code per distinct order id.
+    """
+    order_ids = pd.Index(orders['order_id'])
+    if order_ids.is_unique:
+        order_pos = order_ids.get_indexer(order_items['order_id'])
+        item_pos = np.flatnonzero(order_pos >= 0)
+        order_pos = order_pos[item_pos]
+        return item_pos, order_pos, order_pos
+
+    # Duplicate order ids fan out like the merge does, so let the merge decide the rows
+    items = pd.DataFrame({'order_id': order_items['order_id'].to_numpy(), 'item_pos': np.arange(len(order_items))})
+    lookup = pd.DataFrame({'order_id': orders['order_id'].to_numpy(), 'order_pos': np.arange(len(orders))})
+    merged = items.merge(lookup, on='order_id', how='inner')
+    order_pos = merged['order_pos'].to_numpy()
+    return merged['item_pos'].to_numpy(), order_pos, pd.factorize(orders['order_id'])[0][order_pos]
+
+
+def _category_codes(products, product_ids):
+    """Factorize product categories, sorted, and look them up for the given product ids.
+
+    The last row wins for duplicated product ids, as in a dict built from the rows.
+    Unknown products and missing categories get code -1.
+    """
+    products = products.drop_duplicates('id', keep='last')
+    category = products['category']
+    if isinstance(category.dtype, pd.CategoricalDtype):
+        # Group by the category values, not the categorical, so the output keeps plain strings
+        category = category.astype(category.cat.categories.dtype)
+    codes, categories = pd.factorize(category, sort=True)
+    positions = pd.Index(products['id']).get_indexer(product_ids)
+    item_codes = np.where(positions >= 0, codes[positions], -1)
+    return item_codes, categories
+
+
+def _distinct_per_group(groups, values, n_values, n_groups):
+    """Count the distinct non-negative ``values`` within each group code."""
+    valid = (groups >= 0) & (values >= 0)
+    pairs = pd.unique(groups[valid].astype('int64') * n_values + values[valid])
+    return np.bincount(pairs // n_values, minlength=n_groups)
+
+
+def _grouped_sum(values, groups, n_groups):
+    """Sum float values per group code with pandas' compensated grouped sum, in row order."""
+    sums = pd.Series(values).groupby(groups, sort=True).sum()
+    return sums.reindex(np.arange(n_groups), fill_value=0.0).to_numpy()
+
+
+def compute_kpis(products, orders, order_items):
+    """Compute category-level and order-level KPIs in one factorized pass.
+
+    The inputs are not modified.
+
+    Args:
+        products (pandas.DataFrame): Validated products data.
+        orders (pandas.DataFrame): Validated orders data, with ``order_date``.
+        order_items (pandas.DataFrame): Validated order items data.
+
+    Returns:
+        tuple: A tuple of two pandas DataFrames: category-level KPIs and order-level KPIs.
+    """
+    item_pos, order_pos, order_key = _join_orders(orders, order_items)
+    n_orders = len(orders)
+
+    # Per-order codes, gathered onto the matched items
+    order_date_codes, dates = pd.factorize(orders['order_date'], sort=True)
+    order_returned = orders['returned_at'].notna().to_numpy()
+    n_dates = len(dates)
+    date_code = order_date_codes[order_pos]
+    returned = order_returned[order_pos]
+
+    # Per-item columns, projected to the matched items
+    revenue = order_items['sale_price'].to_numpy(dtype='float64')[item_pos]
+    cat_code, categories = _category_codes(products, order_items['product_id'].to_numpy()[item_pos])
+    user_code, users = pd.factorize(order_items['user_id'].to_numpy()[item_pos])
+
+    # Order-level KPIs, over every matched item with an order date
+    dated = date_code >= 0
+    items = np.bincount(date_code[dated], minlength=n_dates)
+    returned_items = np.bincount(date_code[dated], weights=returned[dated], minlength=n_dates).astype('int64')
+    day_revenue = _grouped_sum(revenue[dated], date_code[dated], n_dates)
+    total_orders = _distinct_per_group(date_code, order_key, max(n_orders, 1), n_dates)
+    unique_customers = _distinct_per_group(date_code, user_code, max(len(users), 1), n_dates)
+
+    present = items > 0
+    order_kpi = pd.DataFrame({
+        'order_date': dates[present],
+        'total_orders': total_orders[present],
+        'total_revenue': day_revenue[present],
+        'total_items_sold': items[present],
+        'return_rate': returned_items[present] / items[present],
+    })
+    order_kpi['total_revenue'] = order_kpi['total_revenue'].round(2)
+    order_kpi['return_rate'] = order_kpi['return_rate'].round(4)
+    order_kpi['return_rate'] = order_kpi['return_rate'] * 100  # Convert to percentage
+    order_kpi['unique_customers'] = unique_customers[present]
+
+    # Category-level KPIs, over the matched items with a known category and an order date
+    n_groups = len(categories) * n_dates
+    group = np.where((cat_code >= 0) & dated, cat_code * n_dates + date_code, -1)
+    grouped = group >= 0
+    group_items = np.bincount(group[grouped], minlength=n_groups)
+    group_returns = np.bincount(group[grouped], weights=returned[grouped], minlength=n_groups).astype('int64')
+    group_revenue = _grouped_sum(revenue[grouped], group[grouped], n_groups)
+    order_count = _distinct_per_group(group, order_key, max(n_orders, 1), n_groups)
+
+    keys = np.flatnonzero(group_items > 0)
+    cat_kpi = pd.DataFrame({
+        'category': categories.take(keys // n_dates) if n_dates else categories[:0],
+        'order_date': dates.take(keys % n_dates) if n_dates else dates[:0],
+        'daily_revenue': group_revenue[keys],
+    })
+    cat_kpi['avg_order_value'] = cat_kpi['daily_revenue'] / order_count[keys]
+    cat_kpi['avg_return_rate'] = group_returns[keys] / order_count[keys]
+    cat_kpi['daily_revenue'] = cat_kpi['daily_revenue'].round(2)
+    cat_kpi['avg_order_value'] = cat_kpi['avg_order_value'].round(2)
+    cat_kpi['avg_return_rate'] = cat_kpi['avg_return_rate'].round(4)
+    cat_kpi['avg_return_rate'] = cat_kpi['avg_return_rate'] * 100  # Convert to percentage
+
+    return cat_kpi[CATEGORY_KPI_COLUMNS], order_kpi[ORDER_KPI_COLUMNS]
+
+
+def compute_category_counts(products, orders, order_items):
+    """Sum the additive measures behind the category-level KPIs, per (category, order_date).
+
+    The KPIs themselves are ratios and rounded, so they cannot be summed over
+    several days. These are their exact numerators and denominators, with
+    revenue in integer cents as in the incremental state. The inputs are not modified.
+
+    Args:
+        products (pandas.DataFrame): Validated products data.
+        orders (pandas.DataFrame): Validated orders data, with ``order_date``.
+        order_items (pandas.DataFrame): Validated order items data.
+
+    Returns:
+        pandas.DataFrame: ``revenue_cents``, ``returned_items`` and ``order_count``
+        per (category, order_date), for the keys of ``compute_kpis``' category-level KPIs.
+    """
+    item_pos, order_pos, order_key = _join_orders(orders, order_items)
+    order_date_codes, dates = pd.factorize(orders['order_date'], sort=True)
+    n_dates = len(dates)
+    date_code = order_date_codes[order_pos]
+    returned = orders['returned_at'].notna().to_numpy()[order_pos]
+    cents = np.round(order_items['sale_price'].to_numpy(dtype='float64')[item_pos] * 100).astype('int64')
+    cat_code, categories = _category_codes(products, order_items['product_id'].to_numpy()[item_pos])
+
+    n_groups = len(categories) * n_dates
+    group = np.where((cat_code >= 0) & (date_code >= 0), cat_code * n_dates + date_code, -1)
+    grouped = group >= 0
+    group_items = np.bincount(group[grouped], minlength=n_groups)
+    keys = np.flatnonzero(group_items > 0)
+    # Integer sums per group, so the cents stay exact
+    revenue = pd.Series(cents[grouped]).groupby(group[grouped], sort=True).sum()
+    returns = np.bincount(group[grouped], weights=returned[grouped], minlength=n_groups).astype('int64')
+    order_count = _distinct_per_group(group, order_key, max(len(orders), 1), n_groups)
+
+    return pd.DataFrame({
+        'category': categories.take(keys // n_dates) if n_dates else categories[:0],
+        'order_date': dates.take(keys % n_dates) if n_dates else dates[:0],
+        'revenue_cents': revenue.reindex(keys, fill_value=0).to_numpy(dtype='int64'),
+        'returned_items': returns[keys],
+        'order_count': order_count[keys],
+    })[CATEGORY_COUNT_COLUMNS]
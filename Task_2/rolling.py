@@ -0,0 +1,211 @@
+"""## Rolling-window KPIs per category
+
+The trailing 7-day and 30-day revenue, average order value and return rate of
+each category. Summing the daily KPI rows over every window again would cost
+a window's worth of rows per output row, and the whole history on every run.
+Instead, the exact daily sums behind the category KPIs (revenue in cents,
+distinct orders and returned items, see ``kpi_engine.compute_category_counts``)
+are kept as running totals in one int64 array per measure, with a row per
+category and a column per day:
+
+    totals[measure][c, d] = sum of the measure for category c over the days before day d
+
+The sum of any window is the difference of two columns, so every output row
+costs the same whatever the window. A run sets the daily sums of the
+(category, order_date) keys it computed, like the KPI writes do: the
+difference to the stored day is added to the totals from that day on, which
+only touches the last column when the day is new. The arrays grow by doubling,
+so a new day usually only fills in a column. Only the windows that contain a
+changed day are recomputed and written.
+
+The totals are kept in ``state/rolling_kpi/category.npz`` and saved only once
+the rolling KPIs of a run are written, so a failed run is sent again whole.
+"""
+
+from io import BytesIO
+
+from common.incremental import STATE_PREFIX
+from common.lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+ROLLING_PREFIX = 'rolling_kpi/'
+WINDOWS = (7, 30)
+MEASURES = ('revenue_cents', 'order_count', 'returned_items')
+ROLLING_KPI_COLUMNS = ['category', 'order_date'] + [
+    f"{name}_{days}d" for days in WINDOWS for name in ('revenue', 'orders', 'avg_order_value', 'return_rate')
+]
+
+
+def _day_numbers(column):
+    """Convert an ``order_date`` column of dates or strings to days since 1970-01-01."""
+    return pd.to_datetime(column).to_numpy().astype('datetime64[D]').astype('int64')
+
+
+def _dates(day_numbers):
+    return pd.to_datetime(np.asarray(day_numbers, dtype='int64'), unit='D').date
+
+
+class RollingStore:
+    """Running totals of the daily category sums, by category and day.
+
+    Args:
+        categories (list): The category of each row of the totals.
+        first_day (int): The day of the first column, in days since 1970-01-01.
+        totals (dict): One int64 array per name in ``MEASURES``, with a row per
+            category and one more column than days: column ``d`` holds the sum
+            over the days before ``first_day + d``.
+    """
+
+    def __init__(self, categories=None, first_day=0, totals=None):
+        self.categories = list(categories or [])
+        self.rows = {category: row for row, category in enumerate(self.categories)}
+        self.first_day = first_day
+        if totals is None:
+            totals = {name: np.zeros((len(self.categories), 1), dtype='int64') for name in MEASURES}
+        self.days = next(iter(totals.values())).shape[1] - 1
+        # The arrays may have spare columns past ``days``, so that new days do not copy them
+        self._totals = totals
+
+    @staticmethod
+    def key(prefix=STATE_PREFIX):
+        return f"{prefix}{ROLLING_PREFIX}category.npz"
+
+    @classmethod
+    def load(cls, s3, bucket, prefix=STATE_PREFIX):
+        """Load the stored totals, or empty ones if none were saved yet."""
+        try:
+            response = s3.get_object(Bucket=bucket, Key=cls.key(prefix))
+        except s3.exceptions.NoSuchKey:
+            return cls()
+        with np.load(BytesIO(response['Body'].read()), allow_pickle=False) as stored:
+            return cls(
+                stored['categories'].tolist(), int(stored['first_day']),
+                {name: stored[name] for name in MEASURES},
+            )
+
+    def save(self, s3, bucket, prefix=STATE_PREFIX):
+        """Write the totals, without their spare columns."""
+        buffer = BytesIO()
+        np.savez_compressed(
+            buffer,
+            categories=np.array(self.categories, dtype='str'),
+            first_day=np.int64(self.first_day),
+            **{name: self.totals(name) for name in MEASURES},
+        )
+        s3.put_object(Bucket=bucket, Key=self.key(prefix), Body=buffer.getvalue())
+
+    def totals(self, name):
+        """The running totals of a measure, one row per category and ``days + 1`` columns."""
+        return self._totals[name][:, :self.days + 1]
+
+    def _extend(self, categories, first_day, last_day):
+        """Make room for new categories and for the days from ``first_day`` to ``last_day``."""
+        new = [category for category in pd.unique(np.asarray(categories, dtype='object')) if category not in self.rows]
+        for category in new:
+            self.rows[category] = len(self.categories)
+            self.categories.append(category)
+
+        if not self.days:
+            self.first_day = first_day
+        before = max(0, self.first_day - first_day)
+        after = max(0, last_day + 1 - (self.first_day + self.days))
+        capacity = next(iter(self._totals.values())).shape[1] - 1
+        for name, totals in self._totals.items():
+            if new:
+                totals = np.vstack([totals, np.zeros((len(new), totals.shape[1]), dtype='int64')])
+            if before or self.days + after > capacity:
+                # Nothing was sold before the first day, and the spare columns double
+                spare = max(self.days + after, 2 * capacity) - self.days - after
+                used = totals[:, :self.days + 1]
+                totals = np.hstack([
+                    np.zeros((len(totals), before), dtype='int64'), used,
+                    np.repeat(used[:, -1:], after + spare, axis=1),
+                ])
+            elif after:
+                totals[:, self.days + 1:self.days + 1 + after] = totals[:, self.days:self.days + 1]
+            self._totals[name] = totals
+        self.first_day -= before
+        self.days += before + after
+
+    def update(self, counts):
+        """Set the daily sums of some (category, order_date) keys.
+
+        Args:
+            counts (pandas.DataFrame): ``revenue_cents``, ``order_count`` and
+                ``returned_items`` per (category, order_date). The last row of a
+                repeated key wins.
+
+        Returns:
+            numpy.ndarray: A boolean array, one row per category and a column per
+            day, that is True for the days whose sums changed and for the days
+            after the last one stored before.
+        """
+        counts = counts.dropna(subset=['category']).drop_duplicates(['category', 'order_date'], keep='last')
+        if not len(counts):
+            return np.zeros((len(self.categories), self.days), dtype=bool)
+
+        days = _day_numbers(counts['order_date'])
+        end = self.first_day + self.days if self.days else int(days.min())
+        self._extend(counts['category'], int(days.min()), int(days.max()))
+        rows = pd.Index(self.categories).get_indexer(counts['category'])
+        columns = days - self.first_day
+        start = int(columns.min())
+
+        changed = np.zeros((len(self.categories), self.days), dtype=bool)
+        # The windows that end on a new day are new, even where the day sold nothing
+        changed[:, end - self.first_day:] = True
+        for name in MEASURES:
+            totals = self._totals[name]
+            stored = totals[rows, columns + 1] - totals[rows, columns]
+            delta = np.zeros((len(self.categories), self.days - start), dtype='int64')
+            delta[rows, columns - start] = counts[name].to_numpy(dtype='int64') - stored
+            changed[:, start:] |= delta != 0
+            totals[:, start + 1:self.days + 1] += np.cumsum(delta, axis=1)
+        return changed
+
+    def window_sums(self, name, rows, columns, days):
+        """Sum a measure over the ``days`` days that end on the given columns, for the given rows."""
+        totals = self._totals[name]
+        return totals[rows, columns + 1] - totals[rows, np.maximum(columns + 1 - days, 0)]
+
+    def rolling_kpis(self, changed=None):
+        """Compute the rolling KPIs of every window that contains a changed day.
+
+        Args:
+            changed (numpy.ndarray): The changed days, as returned by ``update``.
+                Defaults to every day.
+
+        Returns:
+            pandas.DataFrame: The rolling KPIs per (category, order_date), for the
+            windows with at least one order in the longest window.
+        """
+        if changed is None:
+            changed = np.ones((len(self.categories), self.days), dtype=bool)
+        # A changed day affects the windows that end up to the longest window after it
+        marks = np.zeros((len(self.categories), self.days + 1), dtype='int64')
+        np.cumsum(changed, axis=1, out=marks[:, 1:])
+        columns = np.arange(self.days)
+        affected = marks[:, 1:] - marks[:, np.maximum(columns + 1 - max(WINDOWS), 0)] > 0
+        rows, columns = np.nonzero(affected)
+        longest = self.window_sums('order_count', rows, columns, max(WINDOWS))
+        rows, columns = rows[longest > 0], columns[longest > 0]
+        # In category order, then by day
+        order = np.lexsort((columns, np.argsort(np.argsort(self.categories, kind='stable'))[rows]))
+        rows, columns = rows[order], columns[order]
+
+        rolling = {
+            'category': np.asarray(self.categories, dtype='object')[rows],
+            'order_date': _dates(self.first_day + columns),
+        }
+        for days in WINDOWS:
+            revenue = self.window_sums('revenue_cents', rows, columns, days) / 100
+            orders = self.window_sums('order_count', rows, columns, days)
+            returned = self.window_sums('returned_items', rows, columns, days)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rolling[f"revenue_{days}d"] = revenue.round(2)
+                rolling[f"orders_{days}d"] = orders
+                rolling[f"avg_order_value_{days}d"] = np.where(orders > 0, revenue / orders, 0.0).round(2)
+                rolling[f"return_rate_{days}d"] = np.where(orders > 0, returned / orders, 0.0).round(4) * 100
+        return pd.DataFrame(rolling)[ROLLING_KPI_COLUMNS]
@@ -0,0 +1,201 @@
+"""## Sharded, multi-process KPI computation for the Transformation Task
+
+Splits the validated data into shards and aggregates them on a process pool,
+so a task with several vCPUs uses all of them:
+
+- ``order_date`` (default): each shard holds whole order dates, balanced by
+  order count. Every KPI is grouped by order date, so the KPIs of a shard are
+  final, and concatenating them gives exactly the output of ``compute_kpis``.
+- ``order_id``: orders and their items are assigned to shards by a hash of
+  ``order_id``, which keeps the shards even when a few dates dominate. Each
+  shard returns mergeable partials: revenue in integer cents, item and return
+  counts, and order counts, which add up because every order is in exactly one
+  shard. A customer can order in several shards, so the distinct customers per
+  day are merged either exactly, as the union of the shards' (day, customer)
+  pairs, or (``distinct='hll'``) estimated from HyperLogLog sketches merged by
+  register maximum. Revenue is summed in cents, so, as in incremental mode, an
+  average on a rounding boundary can differ by a cent from ``compute_kpis``.
+
+The inputs reach the workers once, through the pool initializer; with the
+``fork`` start method they are inherited rather than copied.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from common.incremental import kpis_from_counts
+from common.lazy import lazy_import
+from hll import HyperLogLog
+from kpi_engine import _category_codes, _distinct_per_group, _join_orders, compute_kpis
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+SHARD_KEYS = ('order_date', 'order_id')
+DISTINCT_MODES = ('exact', 'hll')
+
+# The inputs of the current pool, set in each worker by the initializer
+_inputs = None
+
+
+def _init_worker(products, orders, order_items, order_shard):
+    global _inputs
+    _inputs = (products, orders, order_items, order_shard)
+
+
+def date_shards(order_dates, n_shards):
+    """Assign each order to a shard of consecutive order dates with about as many orders each.
+
+    Returns:
+        numpy.ndarray: The shard of each order, or -1 for orders without a date.
+    """
+    codes, dates = pd.factorize(order_dates, sort=True)
+    counts = np.bincount(codes[codes >= 0], minlength=len(dates))
+    total = max(counts.sum(), 1)
+    # A date goes to the shard its midpoint in the cumulative order count falls in
+    midpoints = np.cumsum(counts) - counts / 2
+    shard_of_date = np.minimum((midpoints * n_shards // total).astype('int64'), n_shards - 1)
+    return np.where(codes >= 0, shard_of_date[codes] if len(dates) else -1, -1)
+
+
+def hash_shards(order_ids, n_shards):
+    """Assign each row to a shard by a hash of its ``order_id``, the same in every process."""
+    hashes = pd.util.hash_pandas_object(pd.Series(order_ids), index=False).to_numpy()
+    return (hashes % np.uint64(n_shards)).astype('int64')
+
+
+def _date_shard_kpis(shard):
+    """Compute the final KPIs of one shard of order dates."""
+    products, orders, order_items, order_shard = _inputs
+    orders = orders[order_shard == shard]
+    order_items = order_items[order_items['order_id'].isin(orders['order_id'])]
+    return compute_kpis(products, orders, order_items)
+
+
+def _order_shard_partials(shard, n_shards, distinct, precision):
+    """Compute the mergeable partial aggregates of one shard of order ids."""
+    products, orders, order_items, _ = _inputs
+    orders = orders[hash_shards(orders['order_id'], n_shards) == shard]
+    order_items = order_items[hash_shards(order_items['order_id'], n_shards) == shard]
+
+    item_pos, order_pos, order_key = _join_orders(orders, order_items)
+    order_date_codes, dates = pd.factorize(orders['order_date'], sort=True)
+    n_dates = len(dates)
+    date_code = order_date_codes[order_pos]
+    returned = orders['returned_at'].notna().to_numpy()[order_pos]
+    cents = (order_items['sale_price'].to_numpy(dtype='float64')[item_pos] * 100).round().astype('int64')
+    cat_code, categories = _category_codes(products, order_items['product_id'].to_numpy()[item_pos])
+    user_code, users = pd.factorize(order_items['user_id'].to_numpy()[item_pos])
+    users = np.asarray(users, dtype='int64')
+    n_orders = max(len(orders), 1)
+
+    dated = date_code >= 0
+    items = np.bincount(date_code[dated], minlength=n_dates)
+    day = pd.DataFrame({
+        'order_date': dates,
+        'revenue_cents': np.bincount(date_code[dated], weights=cents[dated], minlength=n_dates).astype('int64'),
+        'items': items,
+        'returned_items': np.bincount(date_code[dated], weights=returned[dated], minlength=n_dates).astype('int64'),
+        'total_orders': _distinct_per_group(date_code, order_key, n_orders, n_dates),
+    })[items > 0]
+
+    n_groups = len(categories) * n_dates
+    group = np.where((cat_code >= 0) & dated, cat_code * n_dates + date_code, -1)
+    grouped = group >= 0
+    group_items = np.bincount(group[grouped], minlength=n_groups)
+    keys = np.flatnonzero(group_items > 0)
+    cat = pd.DataFrame({
+        'category': categories.take(keys // n_dates) if n_dates else categories[:0],
+        'order_date': dates.take(keys % n_dates) if n_dates else dates[:0],
+        'revenue_cents': np.bincount(group[grouped], weights=cents[grouped], minlength=n_groups).astype('int64')[keys],
+        'returned_items': np.bincount(
+            group[grouped], weights=returned[grouped], minlength=n_groups,
+        ).astype('int64')[keys],
+        'order_count': _distinct_per_group(group, order_key, n_orders, n_groups)[keys],
+    })
+
+    customers = dated & (user_code >= 0)
+    if distinct == 'hll':
+        sketch = HyperLogLog(n_dates, precision)
+        sketch.add(date_code[customers], users.take(user_code[customers]))
+        return cat, day, dates, sketch.registers
+
+    pairs = pd.unique(date_code[customers].astype('int64') * max(len(users), 1) + user_code[customers])
+    return cat, day, dates, (pairs // max(len(users), 1), users.take(pairs % max(len(users), 1)))
+
+
+def _merge_partials(partials, distinct, precision):
+    """Merge the partial aggregates of the order id shards into the final KPIs."""
+    cat_counts = pd.concat([cat for cat, *_ in partials], ignore_index=True)
+    cat_counts = cat_counts.groupby(['category', 'order_date'], as_index=False, sort=False).sum()
+    day_counts = pd.concat([day for _, day, *_ in partials], ignore_index=True)
+    day_counts = day_counts.groupby('order_date', as_index=False, sort=True).sum()
+    dates = pd.Index(day_counts['order_date'])
+
+    if distinct == 'hll':
+        sketch = HyperLogLog(len(dates), precision)
+        for _, _, shard_dates, registers in partials:
+            rows = dates.get_indexer(shard_dates)
+            present = rows >= 0
+            np.maximum.at(sketch.registers, rows[present], registers[present])
+        unique_customers = sketch.estimate()
+    else:
+        frames = []
+        for _, _, shard_dates, (day_codes, user_ids) in partials:
+            frames.append(pd.DataFrame({
+                'day': dates.get_indexer(shard_dates)[day_codes],
+                'user_id': user_ids,
+            }))
+        pairs = pd.concat(frames, ignore_index=True).drop_duplicates()
+        pairs = pairs[pairs['day'] >= 0]
+        unique_customers = np.bincount(pairs['day'].to_numpy(dtype='int64'), minlength=len(dates))
+
+    day_counts['unique_customers'] = unique_customers
+    return kpis_from_counts(cat_counts, day_counts)
+
+
+def _concat_kpis(results):
+    """Concatenate the final KPIs of the date shards in the order ``compute_kpis`` returns them."""
+    results = [result for result in results if len(result[1])] or results[:1]
+    cat_kpi = pd.concat([cat for cat, _ in results], ignore_index=True)
+    cat_kpi = cat_kpi.sort_values(['category', 'order_date'], kind='stable', ignore_index=True)
+    order_kpi = pd.concat([order for _, order in results], ignore_index=True)
+    order_kpi = order_kpi.sort_values('order_date', kind='stable', ignore_index=True)
+    return cat_kpi, order_kpi
+
+
+def compute_kpis_sharded(products, orders, order_items, workers, shard_by='order_date',
+                         distinct='exact', precision=12):
+    """Compute category-level and order-level KPIs on a pool of worker processes.
+
+    The inputs are not modified.
+
+    Args:
+        products (pandas.DataFrame): Validated products data.
+        orders (pandas.DataFrame): Validated orders data, with ``order_date``.
+        order_items (pandas.DataFrame): Validated order items data.
+        workers (int): The number of worker processes, and of shards.
+        shard_by (str): ``order_date`` or ``order_id``.
+        distinct (str): How the distinct customers of ``order_id`` shards are
+            merged: ``exact`` or ``hll``.
+        precision (int): The HyperLogLog precision, with ``distinct='hll'``.
+
+    Returns:
+        tuple: A tuple of two pandas DataFrames: category-level KPIs and order-level KPIs.
+    """
+    if shard_by not in SHARD_KEYS:
+        raise ValueError(f"Unknown shard key: {shard_by}. Expected one of {', '.join(SHARD_KEYS)}")
+    if distinct not in DISTINCT_MODES:
+        raise ValueError(f"Unknown distinct count mode: {distinct}. Expected one of {', '.join(DISTINCT_MODES)}")
+
+    order_shard = date_shards(orders['order_date'], workers) if shard_by == 'order_date' else None
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=context,
+        initializer=_init_worker, initargs=(products, orders, order_items, order_shard),
+    ) as pool:
+        if shard_by == 'order_date':
+            return _concat_kpis(list(pool.map(_date_shard_kpis, range(workers))))
+        shard_partials = partial(_order_shard_partials, n_shards=workers, distinct=distinct, precision=precision)
+        return _merge_partials(list(pool.map(shard_partials, range(workers))), distinct, precision)
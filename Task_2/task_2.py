@@ -1,34 +1,89 @@
 """## Transformation Task"""
 
-import boto3, os
-import pandas as pd
+import os
 from datetime import datetime
-from io import StringIO
+from functools import lru_cache
 import sys
+import uuid
+
+from common import aws_io
+from common.handoff import load_frame
+from common.incremental import INCREMENTAL, PART_COLUMN, IncrementalState, compute_partials, load_batch_files
+from common.lazy import lazy_import, preload
+from common.metrics import RunMetrics, stage
+from common.microbatch import expire_saved
+from common.partitions import write_partitions
+from common.schemas import transformation_columns
+from archiver import archive, iter_objects
+from dynamo_writer import (
+    batch_write, category_kpi_columns, items_from_columns, order_kpi_columns, rolling_kpi_columns,
+)
+from fingerprints import FingerprintStore
+from kpi_engine import compute_category_counts, compute_kpis
+from rolling import RollingStore
+from sharded import compute_kpis_sharded
+
+pd = lazy_import('pandas')
 # import logging
 
 # logging.basicConfig(level=logging.INFO)
 # logger = logging.getLogger(__name__)
 
-# Set up AWS creds
-AWS_ACCESS_KEY = os.environ.get('AWS_ACCESS_KEY_ID')
-AWS_SECRET_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
-AWS_REGION = os.environ.get('AWS_REGION', 'eu-west-1')
+# AWS credentials and AWS_REGION are read from the environment by common.aws_io
 S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME')
 
 # DynamoDB table names
 CATEGORY_TABLE = os.environ.get('CATEGORY_TABLE')
 ORDER_TABLE = os.environ.get('ORDER_TABLE')
 
+# Number of BatchWriteItem calls in flight at once
+DDB_WRITE_WORKERS = int(os.environ.get('DDB_WRITE_WORKERS', '4'))
+
+# Only write the KPI items that are new or changed since the previous run
+SKIP_UNCHANGED = os.environ.get('SKIP_UNCHANGED', 'true').lower() in ('1', 'true', 'yes')
+
+# Rolling 7 and 30-day KPIs per category, written under processed/ and, when
+# ROLLING_TABLE is set, to that DynamoDB table (keyed like CategoryKPI)
+ROLLING_KPIS = os.environ.get('ROLLING_KPIS', 'true').lower() in ('1', 'true', 'yes')
+ROLLING_TABLE = os.environ.get('ROLLING_TABLE')
+
+# Sharded transformation: worker processes (1 computes the KPIs in-process), the
+# shard key (order_date or order_id) and, for order_id shards, how distinct
+# customers are merged (exact or hll)
+TRANSFORM_WORKERS = int(os.environ.get('TRANSFORM_WORKERS', '1'))
+SHARD_BY = os.environ.get('SHARD_BY', 'order_date')
+DISTINCT_COUNTS = os.environ.get('DISTINCT_COUNTS', 'exact')
+
+# Number of raw files copied to the archive at once
+ARCHIVE_WORKERS = int(os.environ.get('ARCHIVE_WORKERS', '16'))
+
+# Number of KPI partitions uploaded to the processed folder at once
+OUTPUT_WORKERS = int(os.environ.get('OUTPUT_WORKERS', '16'))
+
 # S3_BUCKET_NAME = 'e-commerce-shop-a'
 ARCHIVE_PREFIX = 'archive/'
+# The archive folder of a run is named after its start time, without colons
+ARCHIVE_FORMAT = '%Y-%m-%d-T-%H-%M-%S'
 RAW_PREFIX = 'raw-data/'
 VALIDATED_PREFIX = 'validated/'
 PROCESSED_PREFIX = 'processed/'
 
+# The S3 trigger's status file and its markers of the orders and order_items
+# parts uploaded so far (see lambda_trigger.py)
+STATUS_KEY = 'status/execution_started.txt'
+READY_PREFIX = 'status/ready/'
+READY_FOLDERS = ('orders', 'order_items')
+
 # s3 = boto3.client('s3')
-s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY, aws_secret_access_key=AWS_SECRET_KEY)
-ddb = boto3.resource('dynamodb', region_name=os.environ['AWS_REGION'])
+@lru_cache(maxsize=None)
+def get_s3():
+    """Create the S3 client on first use, with a connection pool wide enough for the archive and output workers."""
+    return aws_io.client('s3', max(ARCHIVE_WORKERS, OUTPUT_WORKERS))
+
+@lru_cache(maxsize=None)
+def get_ddb():
+    """Create the DynamoDB resource on first use, with a connection pool wide enough for the write workers."""
+    return aws_io.resource('dynamodb', DDB_WRITE_WORKERS)
 
 DATE = datetime.today().date().isoformat()
 
@@ -47,9 +102,26 @@ def read_csv_s3(key):
         pandas.DataFrame: The contents of the CSV file as a DataFrame.
     """
 
-    response = s3.get_object(Bucket=S3_BUCKET_NAME, Key=key)
+    response = get_s3().get_object(Bucket=S3_BUCKET_NAME, Key=key)
     return pd.read_csv(response['Body'])
 
+def load_validated(name):
+    """Load a dataset written by the validation task from the S3 "validated" folder.
+
+    Args:
+        name (str): The dataset name, e.g. ``orders``.
+
+    Only the columns the transformation uses are parsed.
+
+    Returns:
+        pandas.DataFrame: The validated dataset, with the dtypes it was saved with.
+    """
+    columns = transformation_columns(name)
+    if INCREMENTAL and name == 'order_items' and columns is not None:
+        # Incremental runs count the items of each part file separately
+        columns = columns + [PART_COLUMN]
+    return load_frame(get_s3(), S3_BUCKET_NAME, VALIDATED_PREFIX, name, columns=columns)
+
 # products_df = read_csv_s3(VALIDATED_PREFIX + 'products.csv')
 # orders_df = read_csv_s3(VALIDATED_PREFIX + 'orders.csv')
 # order_items_df = read_csv_s3(VALIDATED_PREFIX + 'order_items.csv')
@@ -75,6 +147,11 @@ def run_transformation(products, orders, order_items):
     - return rate
     - unique customers
 
+    Only the needed columns are joined, and both KPI tables are aggregated in one
+    factorized pass (see ``kpi_engine``). With ``TRANSFORM_WORKERS`` above 1, the
+    data is split into shards by ``SHARD_BY`` and aggregated on that many worker
+    processes (see ``sharded``). The inputs are not modified.
+
     Parameters:
         products (pandas.DataFrame): Validated products data.
         orders (pandas.DataFrame): Validated orders data.
@@ -84,67 +161,53 @@ def run_transformation(products, orders, order_items):
         tuple: A tuple of two pandas DataFrames: category-level KPIs and order-level KPIs.
     """
 
-    # Create a map of product_id to category
-    product_map = dict(zip(products['id'], products['category']))
-
-    # Derive is_returned from returned_at
-    orders['is_returned'] = orders['returned_at'].notna()
-
-    # Merge order_items with orders
-    merged = order_items.merge(orders, on='order_id', how='inner')
-
-    # Add product category
-    merged['category'] = merged['product_id'].map(product_map)
+    if TRANSFORM_WORKERS > 1:
+        return compute_kpis_sharded(
+            products, orders, order_items, TRANSFORM_WORKERS, shard_by=SHARD_BY, distinct=DISTINCT_COUNTS,
+        )
+    return compute_kpis(products, orders, order_items)
 
-    # Create order_date column from created_at
-    # merged['order_date'] = pd.to_datetime(merged['created_at']).dt.date
+def run_incremental_transformation(products, orders, order_items):
+    """
+    Merge the partial aggregates of a batch of new data into the stored state and
+    compute the KPIs of the order dates it touches.
 
-    # Compute total_price
-    merged['total_price'] = merged['sale_price']  # Assuming this is per item and already accounts for quantity
+    The returned state must be saved with ``state.save`` once the KPIs are written,
+    which also commits the batch's part files to the manifest.
 
-    # Calculating Category-Level KPIs
-    cat_kpi = (
-        merged.groupby(['category', 'order_date'])
-        .agg(
-            daily_revenue=('total_price', 'sum'),
-            order_count=('order_id', 'nunique'),
-            return_count=('is_returned', 'sum')
-        )
-        .reset_index()
-    )
-    cat_kpi['avg_order_value'] = cat_kpi['daily_revenue'] / cat_kpi['order_count']
-    cat_kpi['avg_return_rate'] = cat_kpi['return_count'] / cat_kpi['order_count']
-    cat_kpi = cat_kpi.drop(columns=['order_count', 'return_count'])
-    cat_kpi['daily_revenue'] = cat_kpi['daily_revenue'].round(2)
-    cat_kpi['avg_order_value'] = cat_kpi['avg_order_value'].round(2)
-    cat_kpi['avg_return_rate'] = cat_kpi['avg_return_rate'].round(4)
-    cat_kpi['avg_return_rate'] = cat_kpi['avg_return_rate'] * 100  # Convert to percentage
-
-    # Calculating Order-Level KPIs
-    order_kpi = (
-        merged.groupby('order_date')
-        .agg(
-            total_orders=('order_id', 'nunique'),
-            total_revenue=('total_price', 'sum'),
-            total_items_sold=('id', 'count'),  # 'id' from order_items (item-level ID)
-            return_rate=('is_returned', 'mean'),  # Mean of True/False = percentage
-            unique_customers=('user_id_x', 'nunique')  # '_x' might be needed if merged causes duplication
-        )
-        .reset_index()
-    )
-    order_kpi['total_revenue'] = order_kpi['total_revenue'].round(2)
-    order_kpi['return_rate'] = order_kpi['return_rate'].round(4)
-    order_kpi['return_rate'] = order_kpi['return_rate'] * 100  # Convert to percentage
+    Parameters:
+        products (pandas.DataFrame): Validated products data.
+        orders (pandas.DataFrame): Validated orders from the new part files.
+        order_items (pandas.DataFrame): Validated order items from the new part files,
+            with the part file each was read from.
 
-    return cat_kpi, order_kpi
+    Returns:
+        tuple: The category-level KPIs and order-level KPIs of the affected order
+        dates, and the updated ``IncrementalState``.
+    """
+    state = IncrementalState.load(get_s3(), S3_BUCKET_NAME)
+    partials = compute_partials(products, orders, order_items, state.orders_index)
+    # The parked items are kept whole, with the day they were first parked, for Task 1 to check again
+    pending_items = load_frame(get_s3(), S3_BUCKET_NAME, VALIDATED_PREFIX, 'pending_items')
+    dates = state.merge(partials, load_batch_files(get_s3(), S3_BUCKET_NAME), pending_items)
+    cat_kpi, order_kpi = state.kpis(dates)
+    print(f"Incremental run: {len(dates)} order date(s), {len(cat_kpi)} category KPI(s) and "
+          f"{len(order_kpi)} order KPI(s) affected")
+    return cat_kpi, order_kpi, state
 
 # Writing to DynamoDB
-from decimal import Decimal
-
 def write_to_dynamodb(cat_kpi, order_kpi):
     """
     Writes the category-level and order-level KPIs to DynamoDB.
 
+    Item payloads are built column-wise and sent with BatchWriteItem in groups
+    of 25 across ``DDB_WRITE_WORKERS`` parallel workers, retrying any
+    UnprocessedItems with backoff.
+
+    When ``SKIP_UNCHANGED`` is set, only the items whose fingerprint differs from
+    the one recorded when they were last written are sent (see ``fingerprints``),
+    and the items written and skipped are reported with the write units saved.
+
     Args:
         cat_kpi (pd.DataFrame): The category-level KPIs.
         order_kpi (pd.DataFrame): The order-level KPIs.
@@ -152,142 +215,241 @@ def write_to_dynamodb(cat_kpi, order_kpi):
     Returns:
         tuple: The category-level and order-level KPIs.
     """
+    client = get_ddb().meta.client
+    tables = (
+        ('Category', CATEGORY_TABLE, ['category', 'order_date'], category_kpi_columns(cat_kpi)),
+        ('Order', ORDER_TABLE, ['order_date'], order_kpi_columns(order_kpi)),
+    )
 
-    # Writing Category-Level KPIs to DynamoDB
-    cat_table = ddb.Table(CATEGORY_TABLE)
-    for _, row in cat_kpi.iterrows():
-        # Convert 'order_date' to datetime if it's a string
-        if isinstance(row['order_date'], str):
-            row['order_date'] = pd.to_datetime(row['order_date']).date()
-
-        item = {
-            "category": row['category'],
-            # "order_date": row['order_date'],
-            "order_date": row['order_date'].isoformat(),  # Convert to ISO 8601 string
-            # "daily_revenue": row['daily_revenue'],
-            # "avg_order_value": row['avg_order_value'],
-            # "avg_return_rate": row['avg_return_rate']
-            "daily_revenue": Decimal(str(row['daily_revenue'])),
-            "avg_order_value": Decimal(str(row['avg_order_value'])),
-            "avg_return_rate": Decimal(str(round(row['avg_return_rate'], 2)))
-        }
-        cat_table.put_item(Item=item)
-        # print(f"Saved Category KPI: {item}")
-    print("Saved Category KPIs")
-
-    # Writing Order-Level KPIs to DynamoDB
-    order_table = ddb.Table(ORDER_TABLE)
-    for _, row in order_kpi.iterrows():
-        # Convert 'order_date' to datetime if it's a string
-        if isinstance(row['order_date'], str):
-            row['order_date'] = pd.to_datetime(row['order_date']).date()
-
-        item = {
-            "order_date": row['order_date'].isoformat(),  # Convert to ISO 8601 string
-            "total_orders": row['total_orders'],
-            "total_revenue": Decimal(str(row['total_revenue'])),
-            "total_items_sold": row['total_items_sold'],
-            "return_rate": Decimal(str(round(row['return_rate'], 2))),
-            "unique_customers": row['unique_customers']
-        }
-        order_table.put_item(Item=item)
-        # print(f"Saved Order KPI: {item}")
-    print("Saved Order KPIs")
+    stores = []
+    for label, table_name, keys, columns in tables:
+        changed = None
+        if SKIP_UNCHANGED:
+            store = FingerprintStore.load(get_s3(), S3_BUCKET_NAME, client, table_name, keys)
+            changed, changes = store.changed(columns)
+            stores.append(store)
+            changes.report()
+        stats = batch_write(client, table_name, items_from_columns(columns, changed), max_workers=DDB_WRITE_WORKERS)
+        stats.report()
+        print(f"Saved {label} KPIs")
+
+    # Record the fingerprints only once every table's items are written
+    for store in stores:
+        store.save(get_s3(), S3_BUCKET_NAME)
 
     return cat_kpi, order_kpi
 
 # Write the data to s3 processed folder
 def write_to_s3(cat_kpi, order_kpi):
     """
-    Save category-level and order-level KPIs to S3 as CSV files with a timestamp.
+    Save category-level and order-level KPIs to the S3 processed folder, partitioned by order date.
 
     Args:
         cat_kpi (pd.DataFrame): The DataFrame containing category-level KPIs.
         order_kpi (pd.DataFrame): The DataFrame containing order-level KPIs.
 
-    This function generates a timestamp to create unique S3 keys for the CSV files,
-    converts the DataFrames to CSV format, and uploads them to the specified S3 bucket
-    under the 'processed' prefix. It prints the S3 paths where the files are saved.
+    Each table is upserted into ``processed/<table>/order_date=YYYY-MM-DD/`` as one
+    compressed Parquet file per order date, written on ``OUTPUT_WORKERS`` threads.
+    The partitions of the run are recorded in the table indexes and in a run
+    manifest under ``processed/_runs/`` (see ``common.partitions``).
+
+    Returns:
+        str: The S3 key of the run manifest.
     """
 
     # Save according to date and time
-    # timestamp = datetime.utcnow().strftime("%Y/%m/%d-%H:%M:%S") # %Y-%m-%d-T-%H:%M:%S
-    timestamp = datetime.utcnow().strftime("%Y-%m-%d-T-%H:%M:%S")
+    run_id = datetime.utcnow().strftime('%Y-%m-%d-T-%H-%M-%S') + '-' + uuid.uuid4().hex[:8]
+
+    manifest_key = write_partitions(
+        get_s3(), S3_BUCKET_NAME,
+        {'category_kpi': cat_kpi, 'order_kpi': order_kpi},
+        run_id, prefix=PROCESSED_PREFIX, max_workers=OUTPUT_WORKERS,
+    )
+
+    print(f"Saved Category KPIs to: s3://{S3_BUCKET_NAME}/{PROCESSED_PREFIX}category_kpi/")
+    print(f"Saved Order KPIs to: s3://{S3_BUCKET_NAME}/{PROCESSED_PREFIX}order_kpi/")
+    print(f"Run manifest: s3://{S3_BUCKET_NAME}/{manifest_key}")
+
+    return manifest_key
 
-    # Convert DataFrame to CSV
-    cat_csv_buffer = StringIO()
-    cat_kpi.to_csv(cat_csv_buffer, index=False)
+def write_rolling_kpis(counts):
+    """
+    Update the rolling-window totals with a run's daily category sums and write the rolling KPIs they change.
+
+    The rolling KPIs are upserted into ``processed/rolling_category_kpi/`` like the
+    daily KPIs, and written to ``ROLLING_TABLE`` if it is set. The totals are
+    saved only once the rolling KPIs are written (see ``rolling``).
+
+    Args:
+        counts (pd.DataFrame): ``revenue_cents``, ``returned_items`` and ``order_count``
+            per (category, order_date), for the keys the run computed.
 
-    order_csv_buffer = StringIO()
-    order_kpi.to_csv(order_csv_buffer, index=False)
+    Returns:
+        pd.DataFrame: The rolling KPIs that were written.
+    """
+    store = RollingStore.load(get_s3(), S3_BUCKET_NAME)
+    rolling = store.rolling_kpis(store.update(counts))
+
+    if len(rolling):
+        run_id = datetime.utcnow().strftime('%Y-%m-%d-T-%H-%M-%S') + '-' + uuid.uuid4().hex[:8]
+        write_partitions(
+            get_s3(), S3_BUCKET_NAME, {'rolling_category_kpi': rolling},
+            run_id, prefix=PROCESSED_PREFIX, max_workers=OUTPUT_WORKERS,
+        )
+        if ROLLING_TABLE:
+            items = items_from_columns(rolling_kpi_columns(rolling))
+            batch_write(get_ddb().meta.client, ROLLING_TABLE, items, max_workers=DDB_WRITE_WORKERS).report()
+    store.save(get_s3(), S3_BUCKET_NAME)
 
-    # Define the S3 key for the CSV file with timestamp
-    cat_key = f"{PROCESSED_PREFIX}{timestamp}/category_kpi.csv"
-    order_key = f"{PROCESSED_PREFIX}{timestamp}/order_kpi.csv"
+    print(f"Rolling KPIs: {len(rolling)} (category, order_date) window(s) updated over "
+          f"{len(store.categories)} categories and {store.days} days")
+    return rolling
 
-    # Upload the CSV file to S3
-    s3.put_object(Bucket=S3_BUCKET_NAME, Key=cat_key, Body=cat_csv_buffer.getvalue())
-    s3.put_object(Bucket=S3_BUCKET_NAME, Key=order_key, Body=order_csv_buffer.getvalue())
+def archive_files():
+    """
+    Return the raw files to archive, mapping each key to the ETag it was processed at.
 
-    print(f"Saved Category KPIs to: s3://{S3_BUCKET_NAME}/{cat_key}")
-    print(f"Saved Order KPIs to: s3://{S3_BUCKET_NAME}/{order_key}")
+    These are the files recorded by the validation task. If it did not record
+    any, everything currently under the raw folder is listed, lazily and page by page.
 
-    return cat_key, order_key
+    Returns:
+        dict: The S3 keys of the raw files and their ETags.
+    """
+    try:
+        return load_batch_files(get_s3(), S3_BUCKET_NAME)
+    except get_s3().exceptions.NoSuchKey:
+        files = {}
+        for prefix in (RAW_PREFIX + 'products.csv', RAW_PREFIX + 'orders/', RAW_PREFIX + 'order_items/'):
+            files.update((obj['Key'], obj['ETag']) for obj in iter_objects(get_s3(), S3_BUCKET_NAME, prefix))
+        return files
 
 def archive_data(files):
     """
     Archive specified files from S3 to the archive directory with a timestamp.
 
-    This function takes a list of S3 file keys, copies each file to an archive 
-    directory within the same S3 bucket, appending a timestamp to the archive 
-    path, and then deletes the original file from its location.
+    The files are copied server-side on ``ARCHIVE_WORKERS`` threads (large ones
+    with a multipart copy), each copy is verified against its source, and the
+    sources are then deleted in batches of up to 1000 keys. If an earlier
+    archive failed part-way, it is resumed and these files are added to it
+    (see ``archiver``). The parts saved for the micro-batches of the archived
+    files, and the trigger's status file and readiness markers, are then
+    cleared for the next drop.
 
     Args:
-        files (list): List of S3 keys representing the files to be archived.
-    """
-
-    timestamp = datetime.utcnow().strftime('%Y-%m-%d-T-%H:%M:%S')
-    for key in files:
-        # Copy to archive
-        archive_key = ARCHIVE_PREFIX + timestamp + '/' + key.split('/', 1)[1]
-        s3.copy_object(Bucket=S3_BUCKET_NAME, CopySource={'Bucket': S3_BUCKET_NAME, 'Key': key}, Key=archive_key)
+        files: The S3 keys of the files to archive, as a list or as a dict mapping
+            each key to the ETag it was processed at. Files whose ETag changed
+            since are left in place for the next run.
 
-        # Delete original
-        s3.delete_object(Bucket=S3_BUCKET_NAME, Key=key)
+    Returns:
+        ArchiveStats: The counters of the archive.
+    """
 
-        print(f"\nArchived data to: s3://{S3_BUCKET_NAME}/{archive_key}")
+    timestamp = datetime.utcnow().strftime(ARCHIVE_FORMAT)
+    destination = ARCHIVE_PREFIX + timestamp + '/'
+    stats = archive(get_s3(), S3_BUCKET_NAME, files, destination, max_workers=ARCHIVE_WORKERS)
+    stats.report()
 
-    # Archive processed files
-all_files = [RAW_PREFIX + 'products.csv']
-all_files += [obj['Key'] for obj in s3.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=RAW_PREFIX + 'orders/').get('Contents', []) if obj['Key'].endswith('.csv')]
-all_files += [obj['Key'] for obj in s3.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=RAW_PREFIX + 'order_items/').get('Contents', []) if obj['Key'].endswith('.csv')]
+    print(f"\nArchived data to: s3://{S3_BUCKET_NAME}/{destination}")
+    # The real-time micro-batches no longer need to join with the archived parts
+    expire_saved(get_s3(), S3_BUCKET_NAME, stats.archived)
+    reset_trigger()
+    return stats
 
+def reset_trigger():
+    """
+    Clear the trigger's readiness markers and status file once the drop is archived.
 
-def main():
-    try:
-        print("Starting ECS Task: Transformation Job")
+    Without this, the markers of the archived drop would make the next drop
+    start as soon as products.csv arrives. Parts uploaded during the run were
+    left in raw-data/ and their upload events skipped, so the folders that
+    still hold parts get their marker back once the status file is gone.
+    """
+    s3 = get_s3()
+    s3.delete_objects(
+        Bucket=S3_BUCKET_NAME,
+        Delete={'Objects': [{'Key': READY_PREFIX + kind} for kind in READY_FOLDERS], 'Quiet': True},
+    )
+    s3.delete_object(Bucket=S3_BUCKET_NAME, Key=STATUS_KEY)
+    for kind in READY_FOLDERS:
+        if s3.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=f"{RAW_PREFIX}{kind}/", MaxKeys=1).get('KeyCount'):
+            s3.put_object(Bucket=S3_BUCKET_NAME, Key=READY_PREFIX + kind, Body=b'')
 
-        print("Loading Validated Data...")
-        products_df = read_csv_s3(VALIDATED_PREFIX + 'products.csv')
-        orders_df = read_csv_s3(VALIDATED_PREFIX + 'orders.csv')
-        order_items_df = read_csv_s3(VALIDATED_PREFIX + 'order_items.csv')
 
-        print("Running Transformation...")
-        merged = run_transformation(products_df, orders_df, order_items_df)
+def process_validated(products_df, orders_df, order_items_df):
+    """
+    Run the transformation on validated data and publish the results.
 
-        # write_to_dynamodb(cat_kpi, order_kpi)
-        # write_to_s3(cat_kpi, order_kpi)
+    Computes the KPIs (incrementally when ``INCREMENTAL`` is set), writes them to
+    DynamoDB and to the S3 processed folder, updates the rolling-window KPIs when
+    ``ROLLING_KPIS`` is set, commits the incremental state, and archives the raw data.
 
-        print("Writing to DynamoDB...")
+    Parameters:
+        products_df (pandas.DataFrame): Validated products data.
+        orders_df (pandas.DataFrame): Validated orders data.
+        order_items_df (pandas.DataFrame): Validated order items data.
+    """
+    print("Running Transformation...")
+    with stage('transform') as s:
+        s.rows_in = len(products_df) + len(orders_df) + len(order_items_df)
+        if INCREMENTAL:
+            *merged, state = run_incremental_transformation(products_df, orders_df, order_items_df)
+        else:
+            merged = run_transformation(products_df, orders_df, order_items_df)
+        s.rows_out = len(merged[0]) + len(merged[1])
+
+    # write_to_dynamodb(cat_kpi, order_kpi)
+    # write_to_s3(cat_kpi, order_kpi)
+
+    print("Writing to DynamoDB...")
+    with stage('write_dynamodb') as s:
+        s.rows_in = len(merged[0]) + len(merged[1])
         write_to_dynamodb(merged[0], merged[1])
-        print("Successfully written to DynamoDB.")
+    print("Successfully written to DynamoDB.")
 
-        print("Writing to S3...")
+    print("Writing to S3...")
+    with stage('write_s3') as s:
+        s.rows_in = len(merged[0]) + len(merged[1])
         write_to_s3(merged[0], merged[1])
-        print("Successfully written to S3.")
+    print("Successfully written to S3.")
+
+    if ROLLING_KPIS:
+        print("Updating Rolling KPIs...")
+        with stage('rolling_kpis') as s:
+            if INCREMENTAL:
+                counts = state.category_counts(merged[1]['order_date'])
+            else:
+                counts = compute_category_counts(products_df, orders_df, order_items_df)
+            s.rows_in = len(counts)
+            s.rows_out = len(write_rolling_kpis(counts))
+
+    if INCREMENTAL:
+        # Commit the merged state and manifest only once the KPIs are written
+        with stage('save_state'):
+            state.save(get_s3(), S3_BUCKET_NAME)
+        print("Saved incremental state.")
+
+    print("Archiving Data...")
+    with stage('archive') as s:
+        files = archive_files()
+        s.rows_in = len(files)
+        s.rows_out = archive_data(files).deleted
+
+def main():
+    try:
+        print("Starting ECS Task: Transformation Job")
+
+        with RunMetrics('transformation', [get_s3(), get_ddb().meta.client]):
+            # Import pandas and pyarrow while the first S3 requests are in flight
+            preload('pandas', 'pyarrow.parquet')
+
+            print("Loading Validated Data...")
+            with stage('load_validated') as s:
+                products_df = load_validated('products')
+                orders_df = load_validated('orders')
+                order_items_df = load_validated('order_items')
+                s.rows_out = len(products_df) + len(orders_df) + len(order_items_df)
 
-        print("Archiving Data...")
-        archive_data(all_files)
+            process_validated(products_df, orders_df, order_items_df)
 
     except Exception as e:
         print("Error during processing:", e)
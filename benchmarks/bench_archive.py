@@ -0,0 +1,84 @@
+"""## Benchmark: serial vs parallel archiving of the raw part files
+
+Uploads N small part files to a moto S3 bucket and archives them twice: with
+the loop ``archive_data`` used before (one ``copy_object`` and one
+``delete_object`` per file) and with ``archiver.archive``.
+
+moto answers in microseconds, so a fixed delay is added to every request to
+stand in for the round trip to S3 (``--latency-ms``, 20 by default). The
+archive time is then dominated by request latency, as it is against S3.
+
+Usage:
+    python benchmarks/bench_archive.py [--parts 100 1000 5000] [--latency-ms 20]
+"""
+
+import argparse
+import time
+from datetime import datetime
+
+import local_aws
+
+import boto3
+from botocore.config import Config
+from moto import mock_aws
+
+from archiver import archive
+
+
+def serial_archive(s3, bucket, files):
+    """The archive loop as ``archive_data`` implemented it before the archiver."""
+    timestamp = datetime.utcnow().strftime('%Y-%m-%d-T-%H:%M:%S')
+    for key in files:
+        archive_key = 'archive/' + timestamp + '/' + key.split('/', 1)[1]
+        s3.copy_object(Bucket=bucket, CopySource={'Bucket': bucket, 'Key': key}, Key=archive_key)
+        s3.delete_object(Bucket=bucket, Key=key)
+
+
+def upload_parts(s3, parts):
+    body = b'id,order_id,user_id,product_id,sale_price\n' + b'1,1,1,1,9.99\n' * 100
+    keys = [f"raw-data/order_items/part_{i:05d}.csv" for i in range(parts)]
+    for key in keys:
+        s3.put_object(Bucket=local_aws.BUCKET, Key=key, Body=body)
+    return keys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--parts', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--workers', type=int, default=16)
+    args = parser.parse_args()
+
+    print(f"{'parts':>7}{'mode':>10}{'wall s':>9}{'requests':>10}")
+    with mock_aws():
+        s3 = boto3.client(
+            's3', region_name=local_aws.REGION,
+            config=Config(max_pool_connections=max(10, args.workers)),
+        )
+        local_aws.create_bucket(s3)
+        requests = []
+
+        def delay(**kwargs):
+            requests.append(1)
+            time.sleep(args.latency_ms / 1000)
+
+        for parts in args.parts:
+            for mode in ('serial', 'parallel'):
+                local_aws.empty_bucket(s3)
+                keys = upload_parts(s3, parts)
+
+                s3.meta.events.register('before-send.s3', delay)
+                requests.clear()
+                start = time.perf_counter()
+                if mode == 'serial':
+                    serial_archive(s3, local_aws.BUCKET, keys)
+                else:
+                    archive(s3, local_aws.BUCKET, keys, 'archive/bench/', max_workers=args.workers)
+                elapsed = time.perf_counter() - start
+                s3.meta.events.unregister('before-send.s3', delay)
+
+                print(f"{parts:>7}{mode:>10}{elapsed:>9.2f}{len(requests):>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""## Benchmark: backfilling the KPIs of archived drops
+
+Splits a synthetic history into ``--snapshots`` consecutive drops and archives
+each one under ``archive/<timestamp>/`` in a local S3 stand-in, as
+``archive_data`` leaves them. Each drop also sends again a share
+(``--resend``) of the previous drop's orders, now returned, with their items,
+so the same orders appear in two snapshots.
+
+The archive is then backfilled with ``backfill.run_backfill`` for each
+``--workers`` count, into fresh local DynamoDB tables, and the KPIs it writes
+are checked against ``compute_kpis`` over the history with every order kept
+once, in its latest version. A backfill of the middle snapshot alone must add
+the later snapshots, which hold resent orders of its days, and write only the
+days from its first order date on, with the KPIs of the whole history.
+Finally a backfill is stopped after half of the snapshots are staged and run
+again, which must validate only the remaining snapshots and write the same
+KPIs.
+
+Usage:
+    pip install moto pyarrow
+    python benchmarks/bench_backfill.py [--scale 10] [--snapshots 12] [--days 360] [--workers 1 4]
+"""
+
+import argparse
+import contextlib
+import io
+import time
+
+import local_aws
+
+import boto3
+import numpy as np
+import pandas as pd
+from moto import mock_aws
+
+
+def snapshots(scale, count, days, resend, seed=0):
+    """Split a synthetic history into drops of consecutive days, each resending part of the previous one."""
+    import synthetic
+
+    frames = synthetic.generate(scale, seed=seed, days=days)
+    orders, items = frames['orders'], frames['order_items']
+    day = (pd.to_datetime(orders['created_at']) - pd.Timestamp(synthetic.START_DATE)).dt.days
+    window = day * count // days
+
+    rng = np.random.default_rng(seed)
+    drops, previous = [], None
+    for number in range(count):
+        drop_orders = orders[window == number]
+        if previous is not None:
+            again = previous[rng.random(len(previous)) < resend].copy()
+            again['status'] = 'returned'
+            again['returned_at'] = (pd.to_datetime(again['created_at']) + pd.Timedelta(days=9)).dt.strftime('%Y-%m-%dT%H:%M:%S')
+            drop_orders = pd.concat([again, drop_orders], ignore_index=True)
+        drop_items = items[items['order_id'].isin(drop_orders['order_id'])]
+        taken = pd.Timestamp(synthetic.START_DATE) + pd.Timedelta(days=(number + 1) * days // count)
+        drops.append((taken.strftime('%Y-%m-%d-T-%H-%M-%S'), {
+            'products': frames['products'], 'orders': drop_orders, 'order_items': drop_items,
+        }))
+        previous = orders[window == number]
+    return drops
+
+
+def reference_kpis(drops):
+    """The KPIs of the history with each order and order item kept once, in its latest version."""
+    from kpi_engine import compute_kpis
+
+    orders = pd.concat([frames['orders'] for _, frames in drops]).drop_duplicates('order_id', keep='last')
+    items = pd.concat([frames['order_items'] for _, frames in drops]).drop_duplicates('id', keep='last')
+    orders = orders.assign(
+        order_date=pd.to_datetime(orders['created_at']).dt.date,
+        return_date=pd.to_datetime(orders['returned_at']).dt.date,
+    )
+    return compute_kpis(drops[0][1]['products'], orders, items)
+
+
+def fresh_environment(drops):
+    """Create the bucket, tables and archive in the current mock, and reset the tasks' clients."""
+    import synthetic
+    import task_1
+    import task_2
+
+    s3 = boto3.client('s3', region_name=local_aws.REGION)
+    local_aws.create_bucket(s3)
+    local_aws.create_tables(boto3.client('dynamodb', region_name=local_aws.REGION))
+    for taken, frames in drops:
+        synthetic.upload_parts(s3, local_aws.BUCKET, frames, prefix=f"archive/{taken}/")
+    for getter in (task_1.get_s3, task_1.get_products_cache, task_2.get_s3, task_2.get_ddb):
+        getter.cache_clear()
+    return s3
+
+
+def check(written, expected):
+    for got, want in zip(written, expected):
+        pd.testing.assert_frame_equal(got.reset_index(drop=True), want.reset_index(drop=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=10)
+    parser.add_argument('--snapshots', type=int, default=12)
+    parser.add_argument('--days', type=int, default=360)
+    parser.add_argument('--resend', type=float, default=0.05, help="Share of a drop's orders sent again in the next")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    args = parser.parse_args()
+
+    drops = snapshots(args.scale, args.snapshots, args.days, args.resend)
+    expected = reference_kpis(drops)
+    rows = sum(len(frames['orders']) + len(frames['order_items']) for _, frames in drops)
+    print(f"{args.snapshots} snapshots, {rows} order and item rows; "
+          f"{len(expected[0])} category KPI rows, {len(expected[1])} order KPI rows expected")
+
+    import backfill
+
+    print(f"{'workers':>8}{'wall s':>9}")
+    for workers in args.workers:
+        with mock_aws():
+            fresh_environment(drops)
+            backfill.BACKFILL_WORKERS = workers
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                written = backfill.run_backfill()
+            elapsed = time.perf_counter() - start
+            check(written, expected)
+        print(f"{workers:>8}{elapsed:>9.2f}")
+    print("every run wrote the KPIs of the deduplicated history")
+
+    # One snapshot in the middle: its days are written whole, and no earlier day
+    taken, middle = drops[len(drops) // 2]
+    day = pd.Timestamp(taken.split('-T-')[0]).date().isoformat()
+    first_date = pd.to_datetime(middle['orders']['created_at']).dt.date.min()
+    with mock_aws():
+        fresh_environment(drops)
+        with contextlib.redirect_stdout(io.StringIO()):
+            written = backfill.run_backfill(since=day, until=day)
+    check(written, [kpi[kpi['order_date'] >= first_date] for kpi in expected])
+    print(f"snapshot {taken} alone: {len(written[1])} order date(s) from {first_date} on written whole, "
+          f"{(expected[1]['order_date'] < first_date).sum()} earlier ones left alone")
+
+    # Stop after half of the snapshots are staged, then continue
+    validate_snapshot, validated = backfill.validate_snapshot, []
+
+    def stopping(snapshot):
+        if len(validated) >= args.snapshots // 2:
+            raise RuntimeError("stopped")
+        validated.append(snapshot)
+        return validate_snapshot(snapshot)
+
+    with mock_aws():
+        s3 = fresh_environment(drops)
+        backfill.BACKFILL_WORKERS = 1
+        backfill.validate_snapshot = stopping
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                backfill.run_backfill()
+            except RuntimeError:
+                pass
+        first = len(validated)
+        backfill.validate_snapshot = lambda snapshot: (validated.append(snapshot), validate_snapshot(snapshot))[1]
+        with contextlib.redirect_stdout(io.StringIO()):
+            written = backfill.run_backfill()
+        backfill.validate_snapshot = validate_snapshot
+        check(written, expected)
+        left = s3.list_objects_v2(Bucket=local_aws.BUCKET, Prefix='backfill/').get('KeyCount', 0)
+        print(f"resumed: {first} snapshot(s) validated before the stop, {len(validated) - first} after, "
+              f"same KPIs written, {left} staged object(s) left")
+
+
+if __name__ == '__main__':
+    main()
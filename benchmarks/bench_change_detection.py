@@ -0,0 +1,111 @@
+"""## Benchmark: rewriting every KPI item vs writing only the changed ones
+
+Generates a synthetic drop spread over a long range of order dates and writes
+its KPIs to local DynamoDB stand-ins, which records their fingerprints. The
+KPIs of the last ``--changed-days`` order dates are then changed, as a later
+drop with late orders would, and written again twice: once rewriting every
+item (``SKIP_UNCHANGED=false``) and once with change detection, each into its
+own tables. Reports the BatchWriteItem calls and items each needed, the write
+units saved, and checks that both modes leave the tables with the same items.
+
+Usage:
+    pip install moto pyarrow
+    python benchmarks/bench_change_detection.py [--scale 10] [--days 730] [--changed-days 3]
+"""
+
+import argparse
+import contextlib
+import io
+import time
+
+import local_aws
+
+import boto3
+import pandas as pd
+from moto import mock_aws
+
+
+def scan(client, table_name):
+    items, kwargs = [], {}
+    while True:
+        response = client.scan(TableName=table_name, **kwargs)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return sorted(items, key=lambda item: sorted((k, str(v)) for k, v in item.items()))
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def kpis(scale, days):
+    import synthetic
+    from kpi_engine import compute_kpis
+
+    frames = synthetic.generate(scale, days=days)
+    orders = frames['orders'].assign(
+        order_date=pd.to_datetime(frames['orders']['created_at']).dt.date,
+        return_date=pd.to_datetime(frames['orders']['returned_at']).dt.date,
+    )
+    return compute_kpis(frames['products'], orders, frames['order_items'])
+
+
+def write(task_2, cat_kpi, order_kpi, skip_unchanged):
+    """Write the KPIs and return the wall time, BatchWriteItem calls, items sent and the printed report."""
+    task_2.SKIP_UNCHANGED = skip_unchanged
+    sent = {'calls': 0, 'items': 0}
+
+    def count(params, **kwargs):
+        sent['calls'] += 1
+        sent['items'] += sum(len(requests) for requests in params['RequestItems'].values())
+
+    events = task_2.get_ddb().meta.client.meta.events
+    events.register('provide-client-params.dynamodb.BatchWriteItem', count)
+    output = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        task_2.write_to_dynamodb(cat_kpi, order_kpi)
+    elapsed = time.perf_counter() - start
+    events.unregister('provide-client-params.dynamodb.BatchWriteItem', count)
+    return elapsed, sent, output.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=10)
+    parser.add_argument('--days', type=int, default=730)
+    parser.add_argument('--changed-days', type=int, default=3)
+    args = parser.parse_args()
+
+    cat_kpi, order_kpi = kpis(args.scale, args.days)
+    last = sorted(order_kpi['order_date'].unique())[-args.changed_days:]
+    changed_cat = cat_kpi.assign(daily_revenue=cat_kpi['daily_revenue'].where(
+        ~cat_kpi['order_date'].isin(last), cat_kpi['daily_revenue'] + 1))
+    changed_order = order_kpi.assign(total_orders=order_kpi['total_orders'].where(
+        ~order_kpi['order_date'].isin(last), order_kpi['total_orders'] + 1))
+    print(f"{len(cat_kpi)} category KPI rows, {len(order_kpi)} order KPI rows over {args.days} days, "
+          f"the last {args.changed_days} days changed")
+
+    results, tables = {}, {}
+    for label, skip in (('rewrite all', False), ('changed only', True)):
+        # Each mode starts from its own tables, seeded with the first drop's KPIs
+        with mock_aws():
+            local_aws.create_bucket(boto3.client('s3', region_name=local_aws.REGION))
+            client = boto3.client('dynamodb', region_name=local_aws.REGION)
+            local_aws.create_tables(client)
+            import task_2
+
+            task_2.get_s3.cache_clear()
+            task_2.get_ddb.cache_clear()
+            write(task_2, cat_kpi, order_kpi, skip_unchanged=True)
+            results[label] = write(task_2, changed_cat, changed_order, skip)
+            tables[label] = [scan(client, table) for table in ('CategoryKPI', 'OrderKPI')]
+
+    print(f"{'mode':<14}{'wall s':>8}{'calls':>8}{'items':>9}")
+    for label, (elapsed, sent, _) in results.items():
+        print(f"{label:<14}{elapsed:>8.2f}{sent['calls']:>8}{sent['items']:>9}")
+    for line in results['changed only'][2].splitlines():
+        if 'skipped' in line:
+            print(line)
+    print(f"tables {'identical' if tables['rewrite all'] == tables['changed only'] else 'DIFFER'} after both modes")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""## Benchmark: CSV vs Parquet for the validated/ hand-off
+
+Validates the Data/ sample against a local S3 stand-in, then saves and loads
+the validated datasets in each hand-off format, reporting bytes written,
+upload time and load time.
+
+Usage:
+    pip install moto pyarrow
+    python benchmarks/bench_handoff.py [--scale N] [--repeat N]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import time
+
+import local_aws  # noqa: F401  (sets up sys.path and the environment)
+
+import boto3
+import pandas as pd
+from moto import mock_aws
+
+
+def scale_frames(frames, factor):
+    """Repeat every dataset ``factor`` times to simulate a larger drop."""
+    return {name: pd.concat([df] * factor, ignore_index=True) for name, df in frames.items()}
+
+
+def bench_format(s3, fmt, frames, repeat):
+    """Time saving and loading every dataset in one format, keeping the best run."""
+    from common.handoff import frame_key, load_frame, save_frame
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for name, df in frames.items():
+            save_frame(s3, local_aws.BUCKET, 'validated/', name, df, fmt=fmt)
+        saved = time.perf_counter()
+        for name in frames:
+            load_frame(s3, local_aws.BUCKET, 'validated/', name, fmt=fmt)
+        loaded = time.perf_counter()
+        run = {'upload_s': saved - start, 'load_s': loaded - saved}
+        if best is None or run['upload_s'] + run['load_s'] < best['upload_s'] + best['load_s']:
+            best = run
+
+    best['bytes'] = sum(
+        s3.head_object(Bucket=local_aws.BUCKET, Key=frame_key('validated/', name, fmt))['ContentLength']
+        for name in frames
+    )
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=int, default=1, help="Repeat the sample this many times")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per format; the best is kept")
+    parser.add_argument('--json', action='store_true', help="Print machine-readable results")
+    args = parser.parse_args()
+
+    with mock_aws():
+        s3 = boto3.client('s3', region_name=local_aws.REGION)
+        local_aws.create_bucket(s3)
+        local_aws.upload_sample(s3)
+
+        from common.handoff import CsvFormat, ParquetFormat
+        import task_1
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            products, orders, order_items = task_1.run_validation()
+        frames = scale_frames(
+            {'products': products, 'orders': orders, 'order_items': order_items}, args.scale
+        )
+
+        results = {
+            'csv': bench_format(s3, CsvFormat(), frames, args.repeat),
+            'parquet': bench_format(s3, ParquetFormat(), frames, args.repeat),
+        }
+
+    if args.json:
+        print(json.dumps({'scale': args.scale, 'results': results}, indent=2))
+        return
+
+    print(f"scale={args.scale}, rows={sum(len(df) for df in frames.values())}")
+    print(f"{'format':<10}{'bytes':>14}{'upload s':>12}{'load s':>10}")
+    for name, result in results.items():
+        print(f"{name:<10}{result['bytes']:>14,}{result['upload_s']:>12.3f}{result['load_s']:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
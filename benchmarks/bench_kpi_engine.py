@@ -0,0 +1,164 @@
+"""## Benchmark: the original merge/groupby KPI code vs the single-pass KPI engine
+
+Generates synthetic drops, validates them like the validation task and writes
+them as the Parquet hand-off, once per scale. Each implementation then loads
+the hand-off and computes the KPIs in a fresh subprocess, so the reported
+memory is how far the resident set grew during the KPI computation alone.
+Both outputs are compared and must be identical.
+
+Usage:
+    python benchmarks/bench_kpi_engine.py [--scales 10 100]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import local_aws  # noqa: F401  (sets up sys.path and the environment)
+
+DATASETS = ('products', 'orders', 'order_items')
+
+
+def reference_transformation(products, orders, order_items):
+    """The KPI computation as ``run_transformation`` implemented it before the KPI engine."""
+    product_map = dict(zip(products['id'], products['category']))
+    orders['is_returned'] = orders['returned_at'].notna()
+    merged = order_items.merge(orders, on='order_id', how='inner')
+    merged['category'] = merged['product_id'].map(product_map)
+    merged['total_price'] = merged['sale_price']
+
+    cat_kpi = (
+        merged.groupby(['category', 'order_date'])
+        .agg(
+            daily_revenue=('total_price', 'sum'),
+            order_count=('order_id', 'nunique'),
+            return_count=('is_returned', 'sum')
+        )
+        .reset_index()
+    )
+    cat_kpi['avg_order_value'] = cat_kpi['daily_revenue'] / cat_kpi['order_count']
+    cat_kpi['avg_return_rate'] = cat_kpi['return_count'] / cat_kpi['order_count']
+    cat_kpi = cat_kpi.drop(columns=['order_count', 'return_count'])
+    cat_kpi['daily_revenue'] = cat_kpi['daily_revenue'].round(2)
+    cat_kpi['avg_order_value'] = cat_kpi['avg_order_value'].round(2)
+    cat_kpi['avg_return_rate'] = cat_kpi['avg_return_rate'].round(4)
+    cat_kpi['avg_return_rate'] = cat_kpi['avg_return_rate'] * 100
+
+    order_kpi = (
+        merged.groupby('order_date')
+        .agg(
+            total_orders=('order_id', 'nunique'),
+            total_revenue=('total_price', 'sum'),
+            total_items_sold=('id', 'count'),
+            return_rate=('is_returned', 'mean'),
+            unique_customers=('user_id_x', 'nunique')
+        )
+        .reset_index()
+    )
+    order_kpi['total_revenue'] = order_kpi['total_revenue'].round(2)
+    order_kpi['return_rate'] = order_kpi['return_rate'].round(4)
+    order_kpi['return_rate'] = order_kpi['return_rate'] * 100
+
+    return cat_kpi, order_kpi
+
+
+def prepare(scale, directory):
+    """Generate, validate and write one drop as the Parquet hand-off."""
+    import pandas as pd
+
+    import synthetic
+    from common.handoff import ParquetFormat
+
+    frames = synthetic.generate(scale, invalid_rate=0.01)
+    orders = frames['orders'].dropna(subset=['order_id', 'user_id', 'created_at'])
+    order_items = frames['order_items'].dropna(subset=['id', 'product_id', 'sale_price'])
+    order_items = order_items[order_items['sale_price'] > 0]
+    order_items = order_items[order_items['order_id'].isin(set(orders['order_id']))]
+    orders['order_date'] = pd.to_datetime(orders['created_at']).dt.date
+    orders['return_date'] = pd.to_datetime(orders['returned_at']).dt.date
+
+    fmt = ParquetFormat()
+    validated = {'products': frames['products'], 'orders': orders, 'order_items': order_items}
+    for name, df in validated.items():
+        with open(os.path.join(directory, f"{name}.parquet"), 'wb') as f:
+            f.write(fmt.dumps(df, name))
+    return {name: len(df) for name, df in validated.items()}
+
+
+def measure_one(directory, engine):
+    """Load one prepared drop and compute its KPIs with one implementation."""
+    from common.handoff import ParquetFormat
+    from kpi_engine import compute_kpis
+
+    fmt = ParquetFormat()
+    frames = []
+    for name in DATASETS:
+        with open(os.path.join(directory, f"{name}.parquet"), 'rb') as f:
+            frames.append(fmt.loads(f.read(), name))
+
+    run = compute_kpis if engine == 'single-pass' else reference_transformation
+    start = time.perf_counter()
+    with local_aws.PeakRSS() as rss:
+        cat_kpi, order_kpi = run(*frames)
+    elapsed = time.perf_counter() - start
+
+    cat_kpi.to_pickle(os.path.join(directory, f"{engine}-category.pkl"))
+    order_kpi.to_pickle(os.path.join(directory, f"{engine}-order.pkl"))
+    return {'engine': engine, 'wall_s': elapsed, 'rss_growth_mib': rss.growth_mib}
+
+
+def identical(directory):
+    import pandas as pd
+
+    for table in ('category', 'order'):
+        before = pd.read_pickle(os.path.join(directory, f"original-{table}.pkl"))
+        after = pd.read_pickle(os.path.join(directory, f"single-pass-{table}.pkl"))
+        pd.testing.assert_frame_equal(before, after, check_exact=True)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', type=float, nargs='+', default=[10, 100])
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per engine; the fastest is reported")
+    parser.add_argument('--json', action='store_true', help="Print machine-readable results")
+    parser.add_argument('--one', nargs=2, metavar=('DIRECTORY', 'ENGINE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one:
+        print(json.dumps(measure_one(*args.one)))
+        return
+
+    results = []
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory() as directory:
+            rows = prepare(scale, directory)
+            for engine in ('original', 'single-pass'):
+                runs = []
+                for _ in range(args.repeat):
+                    out = subprocess.run(
+                        [sys.executable, __file__, '--one', directory, engine],
+                        check=True, capture_output=True, text=True,
+                    ).stdout
+                    runs.append(json.loads(out.strip().splitlines()[-1]))
+                best = min(runs, key=lambda r: r['wall_s'])
+                best['rss_growth_mib'] = min(r['rss_growth_mib'] for r in runs)
+                results.append({'scale': scale, 'order_items': rows['order_items'], **best})
+            identical(directory)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'scale':>6}{'items':>11}{'engine':>13}{'wall s':>9}{'RSS growth MiB':>16}")
+    for r in results:
+        print(f"{r['scale']:>6g}{r['order_items']:>11}{r['engine']:>13}{r['wall_s']:>9.2f}{r['rss_growth_mib']:>16.1f}")
+    print("outputs identical at every scale")
+
+
+if __name__ == '__main__':
+    main()
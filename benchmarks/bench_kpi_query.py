@@ -0,0 +1,165 @@
+"""## Benchmark: scanning the KPI tables vs the cached KPI query API
+
+Writes the KPIs of a synthetic drop spread over several years to local
+DynamoDB and S3 stand-ins, the way Task 2 does, then loads a dashboard (the
+order KPIs and every category's KPIs of the last ``--range-days`` days)
+repeatedly in three ways:
+
+- ``scan``: a full Scan of both tables filtered in pandas, as ad hoc readers did
+- ``cold``: ``common.kpi_query.KpiQuery`` with an empty cache, i.e. Query and BatchGetItem
+- ``warm``: the same reader again, answered from its cache
+
+Reports the p50/p95 latency and the requests each load needed, and checks
+that all three return the same KPIs. Finally the KPIs of the last
+``--changed-days`` days are rewritten by a new run, and the reader must fetch
+those dates again, and only those, after its next sync.
+
+Usage:
+    pip install moto pyarrow
+    python benchmarks/bench_kpi_query.py [--scale 2] [--days 1095] [--range-days 30] [--loads 5]
+"""
+
+import argparse
+import contextlib
+import io
+import time
+
+import local_aws
+
+import boto3
+import numpy as np
+import pandas as pd
+from moto import mock_aws
+
+
+def kpis(scale, days):
+    import synthetic
+    from kpi_engine import compute_kpis
+
+    frames = synthetic.generate(scale, days=days)
+    orders = frames['orders'].assign(
+        order_date=pd.to_datetime(frames['orders']['created_at']).dt.date,
+        return_date=pd.to_datetime(frames['orders']['returned_at']).dt.date,
+    )
+    return compute_kpis(frames['products'], orders, frames['order_items'])
+
+
+def scan_dashboard(client, start, end):
+    """Scan both tables whole and keep the range, returning the frames and the Scan calls made."""
+    from common.kpi_query import _frame
+
+    calls, frames = 0, []
+    for table, name in (('order_kpi', 'OrderKPI'), ('category_kpi', 'CategoryKPI')):
+        items, kwargs = [], {}
+        while True:
+            response = client.scan(TableName=name, **kwargs)
+            calls += 1
+            items.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        df = _frame(items, table)
+        df = df[(df['order_date'] >= start) & (df['order_date'] <= end)]
+        keys = ['order_date'] if table == 'order_kpi' else ['category', 'order_date']
+        frames.append(df.sort_values(keys, ignore_index=True))
+    return tuple(frames), calls
+
+
+def timed(load, loads):
+    timings, result = [], None
+    for _ in range(loads):
+        start = time.perf_counter()
+        result = load()
+        timings.append(time.perf_counter() - start)
+    return np.percentile(timings, 50), np.percentile(timings, 95), result
+
+
+def same(left, right):
+    for a, b in zip(left, right):
+        pd.testing.assert_frame_equal(a.reset_index(drop=True), b.reset_index(drop=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=2)
+    parser.add_argument('--days', type=int, default=1095)
+    parser.add_argument('--range-days', type=int, default=30)
+    parser.add_argument('--changed-days', type=int, default=3)
+    parser.add_argument('--loads', type=int, default=5, help="Dashboard loads per mode")
+    args = parser.parse_args()
+
+    cat_kpi, order_kpi = kpis(args.scale, args.days)
+    dates = sorted(order_kpi['order_date'].unique())
+    start, end = dates[-args.range_days], dates[-1]
+    print(f"{len(cat_kpi)} category KPI rows, {len(order_kpi)} order KPI rows over {args.days} days; "
+          f"dashboard of {start} .. {end}")
+
+    with mock_aws():
+        s3 = boto3.client('s3', region_name=local_aws.REGION)
+        local_aws.create_bucket(s3)
+        local_aws.create_tables(boto3.client('dynamodb', region_name=local_aws.REGION))
+        import task_2
+        from common.kpi_query import KpiQuery, LruTtlCache
+
+        task_2.get_s3.cache_clear()
+        task_2.get_ddb.cache_clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            task_2.write_to_dynamodb(cat_kpi, order_kpi)
+            task_2.write_to_s3(cat_kpi, order_kpi)
+
+        client = boto3.resource('dynamodb', region_name=local_aws.REGION).meta.client
+
+        def reader():
+            return KpiQuery(client, 'CategoryKPI', 'OrderKPI', s3=s3, bucket=local_aws.BUCKET, cache=LruTtlCache())
+
+        results = {}
+        results['scan'] = timed(lambda: scan_dashboard(client, start, end)[0], args.loads)
+        scan_calls = scan_dashboard(client, start, end)[1]
+
+        cold_requests = []
+
+        def cold():
+            query = reader()
+            loaded = query.dashboard(start, end)
+            cold_requests.append(dict(query.requests))
+            return loaded
+
+        results['cold'] = timed(cold, args.loads)
+        warm_reader = reader()
+        warm_reader.dashboard(start, end)
+        before = dict(warm_reader.requests)
+        results['warm'] = timed(lambda: warm_reader.dashboard(start, end), args.loads)
+        warm_requests = {op: n - before[op] for op, n in warm_reader.requests.items()}
+
+        same(results['scan'][2], results['cold'][2])
+        same(results['scan'][2], results['warm'][2])
+
+        requests = {'scan': f"{scan_calls} Scan", 'cold': cold_requests[-1], 'warm': warm_requests}
+        print(f"{'mode':<6}{'p50 ms':>9}{'p95 ms':>9}  requests per load")
+        for label, (p50, p95, _) in results.items():
+            print(f"{label:<6}{p50 * 1000:>9.1f}{p95 * 1000:>9.1f}  {requests[label]}")
+        print("all modes returned the same KPIs")
+
+        # A later run rewrites the last days; the warm reader must refetch those dates only
+        last = dates[-args.changed_days:]
+        changed_cat = cat_kpi[cat_kpi['order_date'].isin(last)]
+        changed_cat = changed_cat.assign(daily_revenue=changed_cat['daily_revenue'] + 1)
+        changed_order = order_kpi[order_kpi['order_date'].isin(last)]
+        changed_order = changed_order.assign(total_orders=changed_order['total_orders'] + 1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            task_2.write_to_dynamodb(changed_cat, changed_order)
+            task_2.write_to_s3(changed_cat, changed_order)
+
+        dropped = warm_reader.sync(force=True)
+        before = dict(warm_reader.requests)
+        orders, by_category = warm_reader.dashboard(start, end)
+        refetched = {op: n - before[op] for op, n in warm_reader.requests.items()}
+        expected = scan_dashboard(client, start, end)[0]
+        same(expected, (orders, by_category))
+        print(f"after a run rewrote {args.changed_days} days: {dropped} cached items dropped, "
+              f"reload made {refetched} and matches a fresh scan")
+        print(f"cache: {warm_reader.cache.stats}")
+
+
+if __name__ == '__main__':
+    main()
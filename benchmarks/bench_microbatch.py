@@ -0,0 +1,169 @@
+"""## Benchmark: KPI freshness and correctness of the real-time micro-batches
+
+Uploads products.csv and then the orders and order_items parts of the Data/
+sample to local S3 and DynamoDB stand-ins in a shuffled order, and applies each
+upload's micro-batch from a pool of threads, like concurrent Lambda
+invocations. Reports how long after its upload each part's contribution is in
+the KPI tables, i.e. the freshness of the KPIs, where a batch run only updates
+them once every part has arrived.
+
+The stored KPIs are compared with the batch transformation of the same drop;
+with revenue summed in cents, as in incremental mode, an average on a rounding
+boundary may differ by a cent, and no row may be missing, extra or further
+off. Every event is then replayed, as a retried Lambda would, which must make
+no counter update and leave the tables unchanged.
+
+Usage:
+    pip install moto
+    python benchmarks/bench_microbatch.py [--concurrency 4] [--seed 0]
+"""
+
+import argparse
+import glob
+import os
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import local_aws
+
+import boto3
+import pandas as pd
+from moto import mock_aws
+
+
+def serialize_moto_updates():
+    """Make moto's UpdateItem atomic across threads, as DynamoDB's is per item.
+
+    moto applies an update as an unlocked read-modify-write, so concurrent
+    updates of one item can lose each other's additions.
+    """
+    from moto.dynamodb.models import DynamoDBBackend
+
+    lock = threading.Lock()
+    update_item = DynamoDBBackend.update_item
+
+    def locked(self, *args, **kwargs):
+        with lock:
+            return update_item(self, *args, **kwargs)
+
+    DynamoDBBackend.update_item = locked
+
+
+def s3_event(key):
+    return {'Records': [{'s3': {'bucket': {'name': local_aws.BUCKET}, 'object': {'key': key}}}]}
+
+
+def scan(table):
+    items, kwargs = [], {}
+    while True:
+        response = table.scan(**kwargs)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def stored_kpis(ddb):
+    columns = {
+        'CATEGORY_TABLE': ['category', 'order_date', 'daily_revenue', 'avg_order_value', 'avg_return_rate'],
+        'ORDER_TABLE': [
+            'order_date', 'total_orders', 'total_revenue', 'total_items_sold', 'return_rate', 'unique_customers',
+        ],
+    }
+    frames = []
+    for env, names in columns.items():
+        items = scan(ddb.Table(os.environ[env]))
+        df = pd.DataFrame([{name: item.get(name) for name in names} for item in items], columns=names)
+        frames.append(df.astype({name: 'float64' for name in names if name not in ('category', 'order_date')}))
+    return frames
+
+
+def compare(stored, expected, keys):
+    """Return the number of rows missing or extra, and of values that differ by more than a cent."""
+    expected = expected.copy()
+    expected['order_date'] = pd.to_datetime(expected['order_date']).dt.strftime('%Y-%m-%d')
+    merged = stored.merge(expected, on=keys, how='outer', suffixes=('', '_batch'), indicator=True)
+    unmatched = int((merged['_merge'] != 'both').sum())
+    both = merged[merged['_merge'] == 'both']
+    values = [column for column in stored.columns if column not in keys]
+    differ = sum(int(((both[c] - both[f"{c}_batch"]).abs() > 0.0101).sum()) for c in values)
+    return unmatched, differ
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=4, help="Micro-batches applied at once")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the upload order")
+    args = parser.parse_args()
+
+    serialize_moto_updates()
+    with mock_aws():
+        s3 = boto3.client('s3', region_name=local_aws.REGION)
+        local_aws.create_bucket(s3)
+        local_aws.create_tables(boto3.client('dynamodb', region_name=local_aws.REGION))
+        ddb = boto3.resource('dynamodb', region_name=local_aws.REGION)
+
+        import lambda_trigger
+        import task_1
+        from kpi_engine import compute_kpis
+
+        s3.upload_file(os.path.join(local_aws.DATA_DIR, 'products.csv'), local_aws.BUCKET, 'raw-data/products.csv')
+        uploads = [
+            (path, f"raw-data/{folder}/{os.path.basename(path)}")
+            for folder in ('orders', 'order_items')
+            for path in sorted(glob.glob(os.path.join(local_aws.DATA_DIR, folder, '*.csv')))
+        ]
+        random.Random(args.seed).shuffle(uploads)
+
+        def upload_and_apply(upload):
+            path, key = upload
+            s3.upload_file(path, local_aws.BUCKET, key)
+            start = time.perf_counter()
+            stats = lambda_trigger.apply_microbatches(s3_event(key), s3, local_aws.BUCKET)
+            return time.perf_counter() - start, stats[0]
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(upload_and_apply, uploads))
+        wall = time.perf_counter() - start
+        latencies = [latency for latency, _ in results]
+        applied = sum(stats['applied'] for _, stats in results)
+        print(f"{len(uploads)} parts in {wall:.2f}s with {args.concurrency} concurrent micro-batches")
+        print(f"freshness after upload: median {statistics.median(latencies):.2f}s, max {max(latencies):.2f}s")
+        print(f"{applied} counter updates, {sum(stats['pairs'] for _, stats in results)} pairs applied")
+
+        cat_kpi, order_kpi = compute_kpis(*task_1.run_validation())
+        before = stored_kpis(ddb)
+        for name, stored, expected, keys in (
+            ('category KPIs', before[0], cat_kpi, ['category', 'order_date']),
+            ('order KPIs', before[1], order_kpi, ['order_date']),
+        ):
+            unmatched, differ = compare(stored, expected, keys)
+            print(f"{name}: {len(stored)} rows, {unmatched} missing or extra, "
+                  f"{differ} values more than a cent off the batch run")
+            assert not unmatched, f"{name}: {unmatched} rows missing or extra"
+            assert not differ, f"{name}: {differ} values more than a cent off the batch run"
+
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            replays = list(pool.map(
+                lambda upload: lambda_trigger.apply_microbatches(s3_event(upload[1]), s3, local_aws.BUCKET)[0],
+                uploads,
+            ))
+        after = stored_kpis(ddb)
+        unchanged = all(
+            b.sort_values(list(b.columns[:2]), ignore_index=True).equals(
+                a.sort_values(list(a.columns[:2]), ignore_index=True))
+            for b, a in zip(before, after)
+        )
+        replayed = sum(r['applied'] for r in replays)
+        print(f"replayed every event: {replayed} counter updates, "
+              f"tables {'unchanged' if unchanged else 'CHANGED'}")
+        assert replayed == 0, f"{replayed} counter updates on replay"
+        assert unchanged, "the replay changed the tables"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""## Benchmark: inferred vs typed CSV parsing of the raw inputs
+
+Parses products, orders and order_items the way the validation task used to
+(plain ``pd.read_csv``) and through the schema registry (declared dtypes,
+categoricals, only the columns validation needs, ISO 8601 timestamps), with
+the C and the pyarrow parse engines. The typed reads also parse the
+timestamps, which the plain read leaves as strings.
+
+Reports the best parse time and the in-memory size of the parsed frame
+(``memory_usage(deep=True)``), on the Data/ sample and on scaled synthetic data.
+
+Usage:
+    python benchmarks/bench_parsing.py [--scales 10 50] [--repeat 5]
+"""
+
+import argparse
+import glob
+import io
+import os
+import time
+
+import local_aws
+
+import pandas as pd
+
+from common.schemas import RAW_SCHEMAS
+
+MIB = 1024 * 1024
+DATASETS = ('products', 'orders', 'order_items')
+
+MODES = {
+    'inferred': lambda body, name: pd.read_csv(io.BytesIO(body)),
+    'typed, all columns': lambda body, name: RAW_SCHEMAS[name].read(io.BytesIO(body), engine='c'),
+    'typed': lambda body, name: RAW_SCHEMAS[name].read(io.BytesIO(body), stage='validation', engine='c'),
+    'typed, pyarrow': lambda body, name: RAW_SCHEMAS[name].read(io.BytesIO(body), stage='validation', engine='pyarrow'),
+}
+
+
+def sample_files():
+    """Return the Data/ sample as one CSV body per dataset."""
+    bodies = {'products': open(os.path.join(local_aws.DATA_DIR, 'products.csv'), 'rb').read()}
+    for name in ('orders', 'order_items'):
+        paths = sorted(glob.glob(os.path.join(local_aws.DATA_DIR, name, '*.csv')))
+        frames = [pd.read_csv(path, dtype=str, keep_default_na=False) for path in paths]
+        bodies[name] = pd.concat(frames).to_csv(index=False).encode('utf-8')
+    return bodies
+
+
+def synthetic_files(scale):
+    """Return a synthetic drop at ``scale`` as one CSV body per dataset."""
+    import synthetic
+
+    frames = synthetic.generate(scale)
+    return {name: df.to_csv(index=False).encode('utf-8') for name, df in frames.items()}
+
+
+def measure(bodies, repeat):
+    results = []
+    for name in DATASETS:
+        for mode, parse in MODES.items():
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                df = parse(bodies[name], name)
+                best = min(best, time.perf_counter() - start)
+            results.append({
+                'dataset': name,
+                'mode': mode,
+                'parse_s': best,
+                'memory_mib': df.memory_usage(deep=True).sum() / MIB,
+                'columns': len(df.columns),
+            })
+    return results
+
+
+def report(label, bodies, results):
+    print(f"\n{label}: " + ', '.join(f"{name} {len(body) / MIB:.1f} MiB" for name, body in bodies.items()))
+    print(f"{'dataset':<13}{'mode':<20}{'parse s':>9}{'memory MiB':>12}{'columns':>9}")
+    for r in results:
+        print(f"{r['dataset']:<13}{r['mode']:<20}{r['parse_s']:>9.3f}{r['memory_mib']:>12.1f}{r['columns']:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', type=float, nargs='*', default=[10, 50])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    bodies = sample_files()
+    report("Data/ sample", bodies, measure(bodies, args.repeat))
+    for scale in args.scales:
+        bodies = synthetic_files(scale)
+        report(f"synthetic x{scale:g}", bodies, measure(bodies, max(1, args.repeat // 2)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""## Benchmark: end-to-end wall clock of the two-task and fused pipeline modes
+
+Starts a local moto server as the S3 and DynamoDB stand-in and runs the
+pipeline as real processes, so interpreter start-up and the boto3/pandas
+imports are included, like a container cold start would:
+
+- two-task: ``Task_1/task_1.py`` followed by ``Task_2/task_2.py``
+- fused: ``Pipeline/pipeline.py``
+
+The raw data is re-uploaded before every run, since the transformation
+archives it.
+
+Usage:
+    pip install "moto[server]" pyarrow
+    python benchmarks/bench_pipeline_modes.py [--scale N] [--repeat N]
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import local_aws
+
+import boto3
+from moto.server import ThreadedMotoServer
+
+MODES = {
+    'two-task': [['Task_1', 'task_1.py'], ['Task_2', 'task_2.py']],
+    'fused': [['Pipeline', 'pipeline.py']],
+}
+
+
+def run_mode(mode, env):
+    """Run every process of one mode in order and return the wall time of each."""
+    timings = []
+    for folder, script in MODES[mode]:
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, os.path.join(local_aws.ROOT, folder, script)],
+            env=env, check=True, stdout=subprocess.DEVNULL,
+        )
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=int, default=1, help="Copies of the Data/ sample to upload")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per mode; the best is kept")
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--json', action='store_true', help="Print machine-readable results")
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=args.port, verbose=False)
+    server.start()
+    endpoint = f"http://127.0.0.1:{args.port}"
+    try:
+        s3 = boto3.client('s3', region_name=local_aws.REGION, endpoint_url=endpoint)
+        local_aws.create_bucket(s3)
+        local_aws.create_tables(boto3.client('dynamodb', region_name=local_aws.REGION, endpoint_url=endpoint))
+
+        env = dict(os.environ, AWS_ENDPOINT_URL=endpoint)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [local_aws.ROOT, os.path.join(local_aws.ROOT, 'Task_1'), os.path.join(local_aws.ROOT, 'Task_2')]
+        )
+
+        results = {}
+        for mode in MODES:
+            best = None
+            for _ in range(args.repeat):
+                local_aws.empty_bucket(s3)
+                local_aws.upload_scaled_sample(s3, args.scale)
+                timings = run_mode(mode, env)
+                if best is None or sum(timings) < sum(best):
+                    best = timings
+            results[mode] = {'wall_s': sum(best), 'process_s': best}
+    finally:
+        server.stop()
+
+    if args.json:
+        print(json.dumps({'scale': args.scale, 'results': results}, indent=2))
+        return
+
+    print(f"scale={args.scale}, best of {args.repeat}")
+    print(f"{'mode':<10}{'wall s':>9}  per process")
+    for mode, result in results.items():
+        print(f"{mode:<10}{result['wall_s']:>9.2f}  {', '.join(f'{t:.2f}' for t in result['process_s'])}")
+
+
+if __name__ == '__main__':
+    main()
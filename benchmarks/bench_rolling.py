@@ -0,0 +1,139 @@
+"""## Benchmark: rolling-window KPIs from running totals vs re-aggregating the history
+
+Generates ``--years`` of synthetic orders, with each category split into
+``--subcategories``, and replays them as one run per order date, in date
+order, as daily drops would arrive. Each run updates the rolling 7 and 30-day
+category KPIs in one of two ways:
+
+- ``re-aggregate``: the daily category sums of the whole history so far are
+  summed over every window again, so a run costs more as the history grows;
+- ``running totals``: the run's day is set in a ``rolling.RollingStore`` and
+  only the windows that contain it are computed.
+
+Reports the time per run at the end of each year of history. Re-aggregating
+runs only on the last day of each year, since it is the slow one. Then checks
+that the totals give the same KPIs as re-aggregating the full history. Late
+returns are then added to ``--late-days`` past days. Only the windows that
+contain those days must be rewritten, with the KPIs a full recompute gives.
+Finally, the totals are saved to and loaded from a local S3 stand-in.
+
+Usage:
+    pip install moto pyarrow
+    python benchmarks/bench_rolling.py [--scale 2] [--years 3] [--subcategories 8] [--late-days 5]
+"""
+
+import argparse
+import time
+
+import local_aws
+
+import boto3
+import numpy as np
+import pandas as pd
+from moto import mock_aws
+
+
+def daily_counts(scale, days, subcategories, seed=0):
+    """The daily category sums of a synthetic history, with each category split into sub-categories."""
+    import synthetic
+    from kpi_engine import compute_category_counts
+
+    frames = synthetic.generate(scale, seed=seed, days=days)
+    products = frames['products']
+    products = products.assign(category=products['category'] + ' / ' + (products['id'] % subcategories).astype(str))
+    orders = frames['orders'].assign(order_date=pd.to_datetime(frames['orders']['created_at']).dt.date)
+    counts = compute_category_counts(products, orders, frames['order_items'])
+    return counts.sort_values(['order_date', 'category'], ignore_index=True)
+
+
+def reaggregate(counts):
+    """The rolling KPIs of every (category, day), summing the daily sums over each window again."""
+    from rolling import ROLLING_KPI_COLUMNS, WINDOWS
+
+    calendar = pd.date_range(pd.Timestamp(counts['order_date'].min()), pd.Timestamp(counts['order_date'].max()))
+    frames = []
+    for category, daily in counts.groupby('category', sort=True):
+        daily = daily.set_index(pd.to_datetime(daily['order_date']))
+        daily = daily[['revenue_cents', 'order_count', 'returned_items']].reindex(calendar, fill_value=0)
+        frame = pd.DataFrame({'category': category, 'order_date': calendar.date})
+        for days in WINDOWS:
+            sums = daily.rolling(days, min_periods=1).sum().astype('int64')
+            revenue = sums['revenue_cents'].to_numpy() / 100
+            orders = sums['order_count'].to_numpy()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                frame[f"revenue_{days}d"] = revenue.round(2)
+                frame[f"orders_{days}d"] = orders
+                frame[f"avg_order_value_{days}d"] = np.where(orders > 0, revenue / orders, 0.0).round(2)
+                frame[f"return_rate_{days}d"] = np.where(
+                    orders > 0, sums['returned_items'].to_numpy() / orders, 0.0
+                ).round(4) * 100
+        frames.append(frame[frame[f"orders_{max(WINDOWS)}d"] > 0])
+    return pd.concat(frames, ignore_index=True)[ROLLING_KPI_COLUMNS]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=2, help="Orders per day, in multiples of the sample's")
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--subcategories', type=int, default=8, help="Sub-categories per synthetic category")
+    parser.add_argument('--late-days', type=int, default=5, help="Past days that get late returns")
+    args = parser.parse_args()
+
+    from rolling import RollingStore, WINDOWS
+
+    days = 365 * args.years
+    # The sample spreads its orders over 30 days, so keep its orders per day
+    counts = daily_counts(args.scale * days / 30, days, args.subcategories)
+    by_day = dict(tuple(counts.groupby('order_date', sort=True)))
+    print(f"{days} days, {counts['category'].nunique()} categories, {len(counts)} daily category rows")
+
+    store = RollingStore()
+    print(f"{'history':>8}{'re-aggregate ms/run':>21}{'running totals ms/run':>23}")
+    year_end = {day for number, day in enumerate(by_day, 1) if number % 365 == 0}
+    year_runs, year_start = 0, time.perf_counter()
+    for number, (day, daily) in enumerate(by_day.items(), 1):
+        rolling = store.rolling_kpis(store.update(daily))
+        assert set(rolling['order_date']) == {day}, "a new day only updates its own windows"
+        year_runs += 1
+        if day in year_end:
+            totals_ms = (time.perf_counter() - year_start) / year_runs * 1000
+            start = time.perf_counter()
+            reaggregate(counts[counts['order_date'] <= day])
+            naive_ms = (time.perf_counter() - start) * 1000
+            print(f"{number:>7}d{naive_ms:>21.2f}{totals_ms:>23.3f}")
+            year_runs, year_start = 0, time.perf_counter()
+
+    expected = reaggregate(counts)
+    pd.testing.assert_frame_equal(store.rolling_kpis(), expected)
+    print(f"running totals match re-aggregating the history: {len(expected)} rolling rows")
+
+    # Late returns on some past days only rewrite the windows that contain them
+    rng = np.random.default_rng(1)
+    late = counts[counts['order_date'].isin(rng.choice(list(by_day)[:-max(WINDOWS)], args.late_days, replace=False))]
+    late = late.assign(returned_items=late['returned_items'] + 1)
+    start = time.perf_counter()
+    rewritten = store.rolling_kpis(store.update(late))
+    elapsed = (time.perf_counter() - start) * 1000
+    counts = pd.concat([counts, late]).drop_duplicates(['category', 'order_date'], keep='last')
+    expected = reaggregate(counts)
+    keys = ['category', 'order_date']
+    pd.testing.assert_frame_equal(
+        rewritten, expected.merge(rewritten[keys], on=keys).sort_values(keys, ignore_index=True),
+    )
+    assert len(rewritten) <= len(late) * max(WINDOWS)
+    print(f"late returns on {args.late_days} day(s): {len(rewritten)} rolling rows rewritten in {elapsed:.2f} ms, "
+          f"matching a full recompute")
+
+    with mock_aws():
+        s3 = boto3.client('s3', region_name=local_aws.REGION)
+        local_aws.create_bucket(s3)
+        store.save(s3, local_aws.BUCKET)
+        size = s3.head_object(Bucket=local_aws.BUCKET, Key=RollingStore.key())['ContentLength']
+        loaded = RollingStore.load(s3, local_aws.BUCKET)
+    pd.testing.assert_frame_equal(loaded.rolling_kpis(), store.rolling_kpis())
+    print(f"saved totals: {size / 1024:.1f} KiB for {len(store.categories)} categories x {store.days} days, "
+          f"loaded back identical")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""## Benchmark: scaling of the sharded KPI computation across worker processes
+
+Generates one synthetic drop per scale, validated and written as the Parquet
+hand-off like in ``bench_kpi_engine``, and computes its KPIs with the serial
+KPI engine and with ``compute_kpis_sharded`` for each worker count and shard
+mode. Reports the best wall time, the speedup over the serial engine, and
+whether the output is identical (for HyperLogLog, the largest relative error
+of ``unique_customers`` instead).
+
+The speedup is bounded by the cores of the machine it runs on, which are
+printed first.
+
+Usage:
+    python benchmarks/bench_sharded.py [--scales 20 100] [--workers 1 2 4 8]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import local_aws  # noqa: F401  (sets up sys.path and the environment)
+
+import pandas as pd
+
+from bench_kpi_engine import DATASETS, prepare
+from common.handoff import ParquetFormat
+from kpi_engine import compute_kpis
+from sharded import compute_kpis_sharded
+
+MODES = {
+    'order_date': {'shard_by': 'order_date'},
+    'order_id': {'shard_by': 'order_id'},
+    'order_id, hll': {'shard_by': 'order_id', 'distinct': 'hll'},
+}
+
+
+def best_of(repeat, fn):
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def compare(result, expected):
+    """Return 'identical', or the largest relative error of unique_customers if only that differs."""
+    try:
+        for got, want in zip(result, expected):
+            pd.testing.assert_frame_equal(got, want, check_exact=True)
+        return 'identical'
+    except AssertionError:
+        error = (result[1]['unique_customers'] / expected[1]['unique_customers'] - 1).abs().max()
+        pd.testing.assert_frame_equal(result[0], expected[0], check_exact=True)
+        return f"customers within {error:.1%}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', type=float, nargs='+', default=[20, 100])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per configuration; the fastest is reported")
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPU(s) available")
+    print(f"{'scale':>6}{'mode':>15}{'workers':>9}{'wall s':>9}{'speedup':>9}  output")
+    fmt = ParquetFormat()
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory() as directory:
+            prepare(scale, directory)
+            frames = []
+            for name in DATASETS:
+                with open(os.path.join(directory, f"{name}.parquet"), 'rb') as f:
+                    frames.append(fmt.loads(f.read(), name))
+
+        serial, expected = best_of(args.repeat, lambda: compute_kpis(*frames))
+        print(f"{scale:>6g}{'serial':>15}{1:>9}{serial:>9.2f}{1:>9.2f}  reference")
+        for mode, options in MODES.items():
+            for workers in args.workers:
+                wall, result = best_of(args.repeat, lambda: compute_kpis_sharded(*frames, workers, **options))
+                print(f"{scale:>6g}{mode:>15}{workers:>9}{wall:>9.2f}{serial / wall:>9.2f}  {compare(result, expected)}")
+
+
+if __name__ == '__main__':
+    main()
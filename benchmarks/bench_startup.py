@@ -0,0 +1,129 @@
+"""## Benchmark: start-up time of the task entry points
+
+Starts a local moto server as the S3 and DynamoDB stand-in and runs each
+entry point as a fresh process, the way a Fargate task starts, measuring from
+the moment the process is spawned:
+
+- import: until the task module is imported, in a process that only imports it
+- first request: until the task opens its first connection to AWS, i.e. the
+  first useful work of the run
+- total: until the process exits
+
+The first connection is caught with an audit hook on ``socket.connect``, so
+the measurement itself imports nothing. ``--root`` points at another checkout,
+e.g. a ``git worktree`` of an older commit, to measure it the same way.
+
+Usage:
+    pip install "moto[server]" pyarrow
+    python benchmarks/bench_startup.py [--repeat 5] [--root PATH]
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import local_aws
+
+import boto3
+from moto.server import ThreadedMotoServer
+
+# (name, folder, script, module), run in this order against a fresh drop
+ENTRY_POINTS = [
+    ('task_1', 'Task_1', 'task_1.py', 'task_1'),
+    ('task_2', 'Task_2', 'task_2.py', 'task_2'),
+    ('pipeline', 'Pipeline', 'pipeline.py', 'pipeline'),
+]
+
+# Runs in the measured process; reports its marks on stderr when it exits
+BOOTSTRAP = """
+import atexit, json, os, sys, time
+start = float(os.environ['BENCH_SPAWNED_AT'])
+marks = {}
+def hook(event, args):
+    if event == 'socket.connect' and 'first_request_s' not in marks:
+        marks['first_request_s'] = time.time() - start
+sys.addaudithook(hook)
+atexit.register(lambda: sys.stderr.write('BENCH ' + json.dumps(marks) + '\\n'))
+mode, target = sys.argv[1], sys.argv[2]
+if mode == 'import':
+    __import__(target)
+    marks['import_s'] = time.time() - start
+else:
+    import runpy
+    sys.argv = [target]
+    runpy.run_path(target, run_name='__main__')
+"""
+
+
+def spawn(env, mode, target):
+    """Run one measured process and return its marks and its total time."""
+    env = dict(env, BENCH_SPAWNED_AT=repr(time.time()))
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', BOOTSTRAP, mode, target],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    )
+    total = time.perf_counter() - start
+    lines = [line for line in result.stderr.splitlines() if line.startswith('BENCH ')]
+    if result.returncode != 0 or not lines:
+        raise RuntimeError(f"{target} failed:\n{result.stderr[-2000:]}")
+    return {**json.loads(lines[-1][len('BENCH '):]), 'total_s': total}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per entry point; the median is reported")
+    parser.add_argument('--root', default=local_aws.ROOT, help="The checkout to measure")
+    parser.add_argument('--port', type=int, default=5056)
+    parser.add_argument('--json', action='store_true', help="Print machine-readable results")
+    args = parser.parse_args()
+    root = os.path.abspath(args.root)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=args.port, verbose=False)
+    server.start()
+    endpoint = f"http://127.0.0.1:{args.port}"
+    try:
+        s3 = boto3.client('s3', region_name=local_aws.REGION, endpoint_url=endpoint)
+        local_aws.create_bucket(s3)
+        local_aws.create_tables(boto3.client('dynamodb', region_name=local_aws.REGION, endpoint_url=endpoint))
+
+        env = dict(os.environ, AWS_ENDPOINT_URL=endpoint)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [root] + [os.path.join(root, folder) for folder in ('Task_1', 'Task_2', 'Pipeline')]
+        )
+
+        runs = {name: [] for name, *_ in ENTRY_POINTS}
+        for _ in range(args.repeat):
+            for name, folder, script, module in ENTRY_POINTS:
+                if name != 'task_2':
+                    # Task 2 transforms what Task 1 validated; the others start from a fresh drop
+                    local_aws.empty_bucket(s3)
+                    local_aws.upload_sample(s3)
+                imported = spawn(env, 'import', module)
+                run = spawn(env, 'run', os.path.join(root, folder, script))
+                runs[name].append({'import_s': imported['import_s'], **run})
+    finally:
+        server.stop()
+
+    results = {
+        name: {metric: statistics.median(r[metric] for r in samples) for metric in samples[0]}
+        for name, samples in runs.items()
+    }
+    if args.json:
+        print(json.dumps({'root': root, 'results': results}, indent=2))
+        return
+
+    print(f"{root}, median of {args.repeat}")
+    print(f"{'entry point':<12}{'import s':>10}{'first request s':>17}{'total s':>9}")
+    for name, r in results.items():
+        print(f"{name:<12}{r['import_s']:>10.3f}{r['first_request_s']:>17.3f}{r['total_s']:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""## Benchmark: peak memory of batch vs streaming validation
+
+Uploads growing copies of the Data/ sample to a local S3 stand-in and runs
+the validation task in batch mode (``run_validation`` plus ``save_to_s3``) and
+in streaming mode (``run_streaming_validation``). Each run happens in a fresh
+subprocess, and the reported memory is how far the resident set grew above
+its size right before the run.
+
+The stand-in keeps every object in the same process, so the validated
+output (reported as ``output MiB``) is part of that growth in both modes.
+
+Usage:
+    pip install moto pyarrow
+    python benchmarks/bench_streaming.py [--scales 1 4 16] [--chunk-rows N]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import subprocess
+import sys
+import time
+
+import local_aws  # noqa: F401  (sets up sys.path and the environment)
+
+MIB = 1024 * 1024
+
+
+def run_batch(task_1):
+    products, orders, order_items = task_1.run_validation()
+    task_1.save_to_s3(products, "products")
+    task_1.save_to_s3(orders, "orders")
+    task_1.save_to_s3(order_items, "order_items")
+
+
+def measure_one(scale, mode, chunk_rows):
+    """Run one validation mode against ``scale`` copies of the sample and return its metrics."""
+    import boto3
+    from moto import mock_aws
+
+    with mock_aws():
+        s3 = boto3.client('s3', region_name=local_aws.REGION)
+        local_aws.create_bucket(s3)
+        local_aws.upload_scaled_sample(s3, scale)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            import task_1
+        task_1.STREAM_CHUNK_ROWS = chunk_rows
+        run = task_1.run_streaming_validation if mode == 'streaming' else lambda: run_batch(task_1)
+
+        start = time.perf_counter()
+        with local_aws.PeakRSS() as rss, contextlib.redirect_stdout(io.StringIO()):
+            run()
+        elapsed = time.perf_counter() - start
+
+        response = s3.list_objects_v2(Bucket=local_aws.BUCKET, Prefix='validated/')
+        output = sum(obj['Size'] for obj in response.get('Contents', []))
+
+    return {
+        'scale': scale,
+        'mode': mode,
+        'wall_s': elapsed,
+        'rss_growth_mib': rss.growth_mib,
+        'output_mib': output / MIB,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--chunk-rows', type=int, default=20000)
+    parser.add_argument('--json', action='store_true', help="Print machine-readable results")
+    parser.add_argument('--one', nargs=2, metavar=('SCALE', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one:
+        print(json.dumps(measure_one(int(args.one[0]), args.one[1], args.chunk_rows)))
+        return
+
+    results = []
+    for scale in args.scales:
+        for mode in ('batch', 'streaming'):
+            out = subprocess.run(
+                [sys.executable, __file__, '--one', str(scale), mode, '--chunk-rows', str(args.chunk_rows)],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            results.append(json.loads(out.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'scale':>6}{'mode':>11}{'wall s':>9}{'RSS growth MiB':>16}{'output MiB':>12}")
+    for r in results:
+        print(f"{r['scale']:>6}{r['mode']:>11}{r['wall_s']:>9.2f}{r['rss_growth_mib']:>16.1f}{r['output_mib']:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""## Benchmark: fixed vs adaptive concurrency against a throttling table
+
+Writes KPI items with ``dynamo_writer.batch_write`` on ``--workers`` threads to
+a local DynamoDB stand-in that only admits ``--capacity`` BatchWriteItem
+requests per second, like a provisioned table, and answers the rest with
+ProvisionedThroughputExceededException. moto answers in microseconds, so
+``--latency-ms`` is added to every admitted request.
+
+The write runs twice, through ``common.aws_io`` clients: with the adaptive
+limiter off (``ADAPTIVE_CONCURRENCY=false``), where every worker keeps a
+request in flight and retries into the throttle, and with it on. Reports the
+wall time, the requests sent, the throttled attempts and retries, and the
+concurrency limit the writer settled at.
+
+Usage:
+    pip install moto
+    python benchmarks/bench_throttling.py [--items 5000] [--workers 16] [--capacity 40] [--latency-ms 20]
+"""
+
+import argparse
+import json
+import threading
+import time
+
+import local_aws
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from moto import mock_aws
+
+from common import aws_io
+
+
+class TokenBucket:
+    """Admits ``rate`` requests per second, with a burst of one second's worth."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            self.requests += 1
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def throttle(client, bucket, latency):
+    """Answer the BatchWriteItem requests the bucket does not admit as throttled."""
+    body = json.dumps({
+        '__type': 'com.amazonaws.dynamodb.v20120810#ProvisionedThroughputExceededException',
+        'message': 'The level of configured provisioned throughput for the table was exceeded.',
+    }).encode('utf-8')
+
+    def before_send(request, **kwargs):
+        if not bucket.take():
+            response = AWSResponse(request.url, 400, {'x-amzn-ErrorType': 'ProvisionedThroughputExceededException'}, None)
+            response._content = body
+            return response
+        time.sleep(latency)
+        return None
+
+    client.meta.events.register_first('before-send.dynamodb.BatchWriteItem', before_send)
+
+
+def items(count):
+    return [{'order_date': f"d{n:06d}", 'total_orders': n, 'total_revenue': n} for n in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--capacity', type=float, default=40, help="BatchWriteItem requests admitted per second")
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    args = parser.parse_args()
+
+    from dynamo_writer import batch_write
+
+    print(f"{'mode':<10}{'wall s':>8}{'requests':>10}{'throttled':>11}{'retries':>9}{'limit':>7}")
+    for label, adaptive in (('fixed', False), ('adaptive', True)):
+        aws_io.ADAPTIVE_CONCURRENCY = adaptive
+        aws_io._services.clear()
+        aws_io.resource.cache_clear()
+        with mock_aws():
+            local_aws.create_tables(boto3.client('dynamodb', region_name=local_aws.REGION))
+            client = aws_io.resource('dynamodb', args.workers).meta.client
+            bucket = TokenBucket(args.capacity)
+            throttle(client, bucket, args.latency_ms / 1000)
+            start = time.perf_counter()
+            batch_write(client, 'OrderKPI', items(args.items), max_workers=args.workers)
+            elapsed = time.perf_counter() - start
+            written = client.scan(TableName='OrderKPI', Select='COUNT')['Count']
+        stats = aws_io.service_stats()['dynamodb']
+        assert written == args.items, f"{written} of {args.items} items written"
+        print(f"{label:<10}{elapsed:>8.2f}{bucket.requests:>10}{stats['throttles']:>11}"
+              f"{stats['retries']:>9}{stats['limit']:>7.1f}")
+    print("every item was written in both modes")
+
+
+if __name__ == '__main__':
+    main()
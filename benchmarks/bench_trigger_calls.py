@@ -0,0 +1,112 @@
+"""## Benchmark: AWS API calls made by the Lambda trigger
+
+Uploads the Data/ sample to a local S3 stand-in one object at a time, invokes
+``lambda_handler`` with the S3 event for each upload, and counts the API calls
+it makes. It then replays the final uploads concurrently, with no status file.
+Fails unless no invocation lists a folder, the uploads start one execution,
+and the concurrent invocations start exactly one more.
+
+Usage:
+    pip install moto
+    python benchmarks/bench_trigger_calls.py
+"""
+
+import argparse
+import collections
+import contextlib
+import glob
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import local_aws
+
+import boto3
+from moto import mock_aws
+
+
+def s3_event(key):
+    return {'Records': [{'s3': {'bucket': {'name': local_aws.BUCKET}, 'object': {'key': key}}}]}
+
+
+def sample_keys():
+    keys = [('products.csv', 'raw-data/products.csv')]
+    for folder in ('orders', 'order_items'):
+        for path in sorted(glob.glob(os.path.join(local_aws.DATA_DIR, folder, '*.csv'))):
+            name = os.path.basename(path)
+            keys.append((os.path.join(folder, name), f"raw-data/{folder}/{name}"))
+    return keys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--json', action='store_true', help="Print machine-readable results")
+    args = parser.parse_args()
+
+    with mock_aws():
+        s3 = boto3.client('s3', region_name=local_aws.REGION)
+        local_aws.create_bucket(s3)
+        sfn = boto3.client('stepfunctions', region_name=local_aws.REGION)
+        arn = sfn.create_state_machine(
+            name='etl', definition=json.dumps({'StartAt': 'Done', 'States': {'Done': {'Type': 'Succeed'}}}),
+            roleArn='arn:aws:iam::123456789012:role/etl',
+        )['stateMachineArn']
+        os.environ['STATE_MACHINE_ARN'] = arn
+
+        import lambda_trigger
+
+        calls = collections.Counter()
+        for service in ('s3', 'stepfunctions'):
+            lambda_trigger.get_client(service).meta.events.register(
+                'before-call', lambda model, **kwargs: calls.update([model.name])
+            )
+
+        # One invocation per uploaded object, in upload order
+        statuses = collections.Counter()
+        keys = sample_keys()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for path, key in keys:
+                s3.upload_file(os.path.join(local_aws.DATA_DIR, path), local_aws.BUCKET, key)
+                statuses[lambda_trigger.lambda_handler(s3_event(key), None)['status']] += 1
+        sequential = dict(calls)
+
+        # Concurrent invocations racing for the status file
+        s3.delete_object(Bucket=local_aws.BUCKET, Key=lambda_trigger.STATUS_KEY)
+        calls.clear()
+        with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(args.concurrency) as pool:
+            racing = list(pool.map(
+                lambda key: lambda_trigger.lambda_handler(s3_event(key), None)['status'],
+                [key for _, key in keys[-args.concurrency:]],
+            ))
+        concurrent = dict(calls)
+        executions = len(sfn.list_executions(stateMachineArn=arn)['executions'])
+
+    assert 'ListObjectsV2' not in sequential and 'ListObjectsV2' not in concurrent, "an invocation listed a folder"
+    assert sequential.get('StartExecution') == 1, f"{sequential.get('StartExecution', 0)} executions for the uploads"
+    assert concurrent.get('StartExecution') == 1, f"{concurrent.get('StartExecution', 0)} executions for the race"
+    assert executions == 2
+
+    results = {
+        'uploads': len(keys),
+        'sequential_calls': sum(sequential.values()),
+        'sequential_calls_by_operation': sequential,
+        'sequential_statuses': dict(statuses),
+        'concurrent_invocations': args.concurrency,
+        'concurrent_statuses': dict(collections.Counter(racing)),
+        'concurrent_calls_by_operation': concurrent,
+        'executions_started': executions,
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{results['uploads']} uploads -> {results['sequential_calls']} API calls: {sequential}")
+    print(f"statuses: {results['sequential_statuses']}")
+    print(f"{args.concurrency} concurrent invocations -> {results['concurrent_statuses']}")
+    print(f"executions started in total: {executions}, one per round, and no folder listed")
+
+
+if __name__ == '__main__':
+    main()
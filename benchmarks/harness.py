@@ -0,0 +1,194 @@
+"""## End-to-end benchmark harness for the ETL tasks
+
+Generates a synthetic drop at each requested scale, uploads it to local S3 and
+DynamoDB stand-ins (moto), and runs the pipeline stages one after the other:
+
+    run_validation -> run_transformation -> write_to_dynamodb -> write_to_s3 -> archive_data
+
+For every stage it records wall time, peak RSS, RSS growth and the AWS API
+calls made, per service and operation. Each scale runs in a fresh process.
+Results are written as JSON tagged with the git commit, so runs from two
+commits can be compared:
+
+    python benchmarks/harness.py run --scales 1 10 --out before.json
+    python benchmarks/harness.py run --scales 1 10 --out after.json
+    python benchmarks/harness.py compare before.json after.json
+
+Task settings such as ``STREAMING`` or ``DDB_WRITE_WORKERS`` are read from the
+environment as usual, so they can be benchmarked the same way.
+"""
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import local_aws
+
+STAGES = ['run_validation', 'run_transformation', 'write_to_dynamodb', 'write_to_s3', 'archive_data']
+
+
+class CallCounter:
+    """Counts the API calls made through a set of boto3 clients, by service and operation."""
+
+    def __init__(self, clients):
+        self.counts = collections.Counter()
+        for client in clients:
+            client.meta.events.register('before-call', self._count)
+
+    def _count(self, model, **kwargs):
+        self.counts[f"{model.service_model.service_name}.{model.name}"] += 1
+
+    def take(self):
+        """Return the counts since the last call and reset them."""
+        counts, self.counts = dict(self.counts), collections.Counter()
+        return counts
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=local_aws.ROOT,
+            check=True, capture_output=True, text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_scale(scale, seed, invalid_rate):
+    """Run every stage against one synthetic drop and return the per-stage metrics."""
+    import boto3
+    import pandas as pd
+    from moto import mock_aws
+
+    import synthetic
+
+    frames = synthetic.generate(scale, seed=seed, invalid_rate=invalid_rate)
+
+    with mock_aws():
+        s3 = boto3.client('s3', region_name=local_aws.REGION)
+        local_aws.create_bucket(s3)
+        local_aws.create_tables(boto3.client('dynamodb', region_name=local_aws.REGION))
+        synthetic.upload_parts(s3, local_aws.BUCKET, frames)
+        rows = {name: len(df) for name, df in frames.items()}
+        del frames
+
+        import task_1
+        import task_2
+        counter = CallCounter([task_1.get_s3(), task_2.get_s3(), task_2.get_ddb().meta.client])
+
+        results = {}
+        outputs = {}
+
+        def stage(name, fn):
+            start = time.perf_counter()
+            with local_aws.PeakRSS() as rss, contextlib.redirect_stdout(io.StringIO()):
+                outputs[name] = fn()
+            results[name] = {
+                'wall_s': round(time.perf_counter() - start, 4),
+                'peak_rss_mib': round(rss.peak_mib, 1),
+                'rss_growth_mib': round(rss.growth_mib, 1),
+                'api_calls': counter.take(),
+            }
+
+        stage('run_validation', task_1.run_validation)
+        validated = outputs['run_validation']
+        stage('run_transformation', lambda: task_2.run_transformation(*validated))
+        cat_kpi, order_kpi = outputs['run_transformation']
+        stage('write_to_dynamodb', lambda: task_2.write_to_dynamodb(cat_kpi, order_kpi))
+        stage('write_to_s3', lambda: task_2.write_to_s3(cat_kpi, order_kpi))
+        stage('archive_data', lambda: task_2.archive_data(task_2.archive_files()))
+
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'scale': scale,
+        'seed': seed,
+        'invalid_rate': invalid_rate,
+        'rows': {**rows, 'category_kpis': len(cat_kpi), 'order_kpis': len(order_kpi)},
+        'stages': results,
+    }
+
+
+def run(args):
+    results = []
+    for scale in args.scales:
+        out = subprocess.run(
+            [sys.executable, __file__, 'one', str(scale), '--seed', str(args.seed),
+             '--invalid-rate', str(args.invalid_rate)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        results.append(result)
+        print(f"scale {scale}: " + ', '.join(
+            f"{name} {metrics['wall_s']:.2f}s" for name, metrics in result['stages'].items()
+        ), file=sys.stderr)
+
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+def compare(args):
+    """Print per-stage wall time, peak RSS and API call deltas between two result files."""
+    with open(args.base) as f:
+        base = {result['scale']: result for result in json.load(f)}
+    with open(args.head) as f:
+        head = {result['scale']: result for result in json.load(f)}
+
+    print(f"{'scale':>6}  {'stage':<20}{'wall s':>18}{'peak RSS MiB':>22}{'API calls':>16}")
+    for scale in sorted(base.keys() & head.keys()):
+        for name in STAGES:
+            old, new = base[scale]['stages'].get(name), head[scale]['stages'].get(name)
+            if not old or not new:
+                continue
+            calls = [sum(metrics['api_calls'].values()) for metrics in (old, new)]
+            print(
+                f"{scale:>6}  {name:<20}"
+                f"{old['wall_s']:>8.2f} -> {new['wall_s']:<6.2f}"
+                f"{old['peak_rss_mib']:>10.1f} -> {new['peak_rss_mib']:<8.1f}"
+                f"{calls[0]:>6} -> {calls[1]:<6}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="Run the stages at one or more scales")
+    run_parser.add_argument('--scales', type=float, nargs='+', default=[1, 10])
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--invalid-rate', type=float, default=0.01)
+    run_parser.add_argument('--out', help="Write the JSON results to this file instead of stdout")
+
+    one_parser = commands.add_parser('one')
+    one_parser.add_argument('scale', type=float)
+    one_parser.add_argument('--seed', type=int, default=0)
+    one_parser.add_argument('--invalid-rate', type=float, default=0.01)
+
+    compare_parser = commands.add_parser('compare', help="Compare two result files")
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('head')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'one':
+        print(json.dumps(run_scale(args.scale, args.seed, args.invalid_rate)))
+    else:
+        compare(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""## Local AWS stand-ins for the benchmarks
+
+Sets up the environment the tasks expect and uploads the Data/ sample to an
+in-memory S3 bucket provided by moto.
+"""
+
+import glob
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(ROOT, 'Data')
+BUCKET = 'e-commerce-shop-bench'
+REGION = 'eu-west-1'
+
+# Make the shared package, both task modules and the pipeline entry points importable
+for path in (ROOT, os.path.join(ROOT, 'Task_1'), os.path.join(ROOT, 'Task_2'), os.path.join(ROOT, 'Pipeline')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', REGION)
+os.environ.setdefault('AWS_REGION', REGION)
+os.environ.setdefault('S3_BUCKET_NAME', BUCKET)
+os.environ.setdefault('CATEGORY_TABLE', 'CategoryKPI')
+os.environ.setdefault('ORDER_TABLE', 'OrderKPI')
+
+
+def create_bucket(s3):
+    """Create the benchmark bucket."""
+    s3.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': REGION})
+
+
+def create_tables(dynamodb):
+    """Create the CategoryKPI and OrderKPI tables with the key layout from the README.
+
+    Args:
+        dynamodb: A boto3 DynamoDB client.
+    """
+    dynamodb.create_table(
+        TableName=os.environ['CATEGORY_TABLE'],
+        KeySchema=[
+            {'AttributeName': 'category', 'KeyType': 'HASH'},
+            {'AttributeName': 'order_date', 'KeyType': 'RANGE'},
+        ],
+        AttributeDefinitions=[
+            {'AttributeName': 'category', 'AttributeType': 'S'},
+            {'AttributeName': 'order_date', 'AttributeType': 'S'},
+        ],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    dynamodb.create_table(
+        TableName=os.environ['ORDER_TABLE'],
+        KeySchema=[{'AttributeName': 'order_date', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'order_date', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+
+
+def empty_bucket(s3):
+    """Delete every object in the benchmark bucket."""
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=BUCKET):
+        objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if objects:
+            s3.delete_objects(Bucket=BUCKET, Delete={'Objects': objects})
+
+
+def upload_sample(s3, data_dir=DATA_DIR):
+    """Upload the Data/ sample under raw-data/, as the Lambda trigger expects it.
+
+    Args:
+        s3: A boto3 S3 client.
+        data_dir (str): The directory holding products.csv, orders/ and order_items/.
+    """
+    s3.upload_file(os.path.join(data_dir, 'products.csv'), BUCKET, 'raw-data/products.csv')
+    for folder in ('orders', 'order_items'):
+        for path in sorted(glob.glob(os.path.join(data_dir, folder, '*.csv'))):
+            s3.upload_file(path, BUCKET, f"raw-data/{folder}/{os.path.basename(path)}")
+
+
+def upload_scaled_sample(s3, scale, data_dir=DATA_DIR):
+    """Upload ``scale`` copies of the Data/ parts, with order and item ids offset per copy.
+
+    Every copy keeps the products, dates and prices of the sample, so each one
+    is a distinct but equally valid set of orders.
+
+    Args:
+        s3: A boto3 S3 client.
+        scale (int): The number of copies of the sample to upload.
+        data_dir (str): The directory holding products.csv, orders/ and order_items/.
+    """
+    import pandas as pd
+
+    s3.upload_file(os.path.join(data_dir, 'products.csv'), BUCKET, 'raw-data/products.csv')
+    parts = {
+        folder: [(os.path.basename(path), pd.read_csv(path))
+                 for path in sorted(glob.glob(os.path.join(data_dir, folder, '*.csv')))]
+        for folder in ('orders', 'order_items')
+    }
+    order_offset = max(df['order_id'].max() for _, df in parts['orders']) + 1
+    item_offset = max(df['id'].max() for _, df in parts['order_items']) + 1
+
+    for copy in range(scale):
+        for folder, files in parts.items():
+            for name, df in files:
+                df = df.copy()
+                df['order_id'] += copy * order_offset
+                if folder == 'order_items':
+                    df['id'] += copy * item_offset
+                key = f"raw-data/{folder}/{name[:-4]}_copy{copy}.csv"
+                s3.put_object(Bucket=BUCKET, Key=key, Body=df.to_csv(index=False).encode('utf-8'))
+
+
+class PeakRSS:
+    """Samples the process's resident set size in a background thread.
+
+    Use it as a context manager around the code to measure; ``start_mib`` and
+    ``peak_mib`` hold the RSS at entry and the highest RSS seen inside the block.
+    Only Linux (``/proc/self/statm``) is supported.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start_mib = 0.0
+        self.peak_mib = 0.0
+
+    @staticmethod
+    def current_mib():
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self.peak_mib = max(self.peak_mib, self.current_mib())
+
+    def __enter__(self):
+        import threading
+
+        self.start_mib = self.peak_mib = self.current_mib()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._done.set()
+        self._thread.join()
+        self.peak_mib = max(self.peak_mib, self.current_mib())
+
+    @property
+    def growth_mib(self):
+        return self.peak_mib - self.start_mib
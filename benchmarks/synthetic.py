@@ -0,0 +1,207 @@
+"""## Synthetic data generator shaped like the Data/ sample
+
+Generates products, orders and order_items with the same columns, part-file
+layout and value distributions as the CSVs in Data/, at any scale factor.
+Scale 1 gives roughly the sample's volume (9000 orders, about 27000 order
+items over 30 days); scale N gives N times as many orders over the same days.
+
+Usage:
+    python benchmarks/synthetic.py --scale 10 --out /tmp/data
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# Distributions measured on the Data/ sample
+ORDERS_PER_SCALE = 9000
+PRODUCTS = 10000
+ROWS_PER_PART = 1500
+START_DATE = '2025-03-08'
+DAYS = 30
+USER_IDS = (1000, 9999)
+RETURN_RATE = 0.21
+ITEM_STATUS_MATCH = 0.96
+MISSING_DELIVERED_RATE = 0.01
+MISSING_BRAND_RATE = 0.01
+CATEGORIES = {
+    'Beauty': 'Personal Care',
+    'Sports': 'Outdoors',
+    'Home & Kitchen': 'Home',
+    'Clothing': 'Fashion',
+    'Electronics': 'Tech',
+    'Toys': 'Kids',
+    'Books': 'Media',
+}
+BRANDS = ['Initech', 'Soylent', 'Stark', 'Acme', 'Wonka', 'Umbrella', 'Globex']
+WORDS = [
+    'adaptive', 'balanced', 'budgetary', 'centralized', 'down-sized', 'ergonomic', 'focused',
+    'integrated', 'management', 'national', 'open', 'architecture', 'organized', 'stable',
+    'synergy', 'toolset', 'universal', 'vision', 'workforce', 'protocol',
+]
+
+
+def _timestamps(values, mask=None):
+    """Format datetime64 values as the sample's ISO timestamps, blank where ``mask`` is False."""
+    strings = np.datetime_as_string(values.astype('datetime64[s]'), unit='s')
+    if mask is None:
+        return strings
+    return np.where(mask, strings, None)
+
+
+def _hours(rng, low, high, size):
+    return rng.integers(low, high + 1, size).astype('timedelta64[h]')
+
+
+def generate_products(rng, count=PRODUCTS):
+    """Generate the products dimension."""
+    ids = np.arange(1, count + 1)
+    retail_price = rng.normal(80, 30, count).clip(10.5, 149.91).round(2)
+    cost = rng.uniform(5, np.minimum(100, retail_price / 1.05)).round(2)
+    categories = rng.choice(list(CATEGORIES), count)
+    brands = rng.choice(BRANDS, count).astype(object)
+    brands[rng.random(count) < MISSING_BRAND_RATE] = None
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+    prefixes = [''.join(chars) for chars in rng.choice(letters, (count, 3))]
+    names = [' '.join(words).capitalize() for words in rng.choice(WORDS, (count, 4))]
+
+    return pd.DataFrame({
+        'id': ids,
+        'sku': [f"{prefix}-{number:08d}" for prefix, number in zip(prefixes, rng.integers(0, 10**8, count))],
+        'cost': cost,
+        'category': categories,
+        'name': names,
+        'brand': brands,
+        'retail_price': retail_price,
+        'department': [CATEGORIES[category] for category in categories],
+    })
+
+
+def generate_orders(rng, count, start=START_DATE, days=DAYS):
+    """Generate orders spread uniformly over ``days`` days from ``start``."""
+    created = np.datetime64(start, 's') + rng.integers(0, days * 86400, count).astype('timedelta64[s]')
+    shipped = created + _hours(rng, 1, 48, count)
+    delivered = shipped + _hours(rng, 12, 72, count)
+    returned = delivered + _hours(rng, 24, 120, count)
+    is_returned = rng.random(count) < RETURN_RATE
+    has_delivered = rng.random(count) >= MISSING_DELIVERED_RATE
+
+    return pd.DataFrame({
+        'order_id': np.arange(1, count + 1),
+        'user_id': rng.integers(USER_IDS[0], USER_IDS[1] + 1, count),
+        'status': np.where(is_returned, 'returned', 'delivered'),
+        'created_at': _timestamps(created),
+        'returned_at': _timestamps(returned, is_returned),
+        'shipped_at': _timestamps(shipped),
+        'delivered_at': _timestamps(delivered, has_delivered | is_returned),
+        'num_of_item': rng.integers(1, 6, count),
+    })
+
+
+def generate_order_items(rng, orders, products):
+    """Generate ``num_of_item`` order items per order, priced around the product's retail price."""
+    order_index = np.repeat(np.arange(len(orders)), orders['num_of_item'].to_numpy())
+    count = len(order_index)
+    product_index = rng.integers(0, len(products), count)
+
+    order_created = orders['created_at'].to_numpy().astype('datetime64[s]')[order_index]
+    created = order_created + rng.integers(0, 3600, count).astype('timedelta64[s]')
+    shipped = created + _hours(rng, 1, 36, count)
+    delivered = shipped + _hours(rng, 6, 72, count)
+    returned = delivered + _hours(rng, 24, 120, count)
+
+    order_returned = (orders['status'].to_numpy() == 'returned')[order_index]
+    is_returned = np.where(rng.random(count) < ITEM_STATUS_MATCH, order_returned, ~order_returned)
+    prices = products['retail_price'].to_numpy()[product_index] * rng.uniform(0.85, 1.15, count)
+
+    return pd.DataFrame({
+        'id': np.arange(1, count + 1),
+        'order_id': orders['order_id'].to_numpy()[order_index],
+        'user_id': orders['user_id'].to_numpy()[order_index],
+        'product_id': products['id'].to_numpy()[product_index],
+        'status': np.where(is_returned, 'returned', 'delivered'),
+        'created_at': _timestamps(created),
+        'shipped_at': _timestamps(shipped),
+        'delivered_at': _timestamps(delivered),
+        'returned_at': _timestamps(returned, is_returned),
+        'sale_price': prices.round(2),
+    })
+
+
+def generate(scale=1, seed=0, days=DAYS, start=START_DATE, products=PRODUCTS, invalid_rate=0.0):
+    """Generate a full drop of synthetic data.
+
+    Args:
+        scale (float): Multiplier on the sample's order volume.
+        seed (int): Random seed, so runs are reproducible.
+        days (int): Number of days the orders are spread over.
+        start (str): First order date, as ``YYYY-MM-DD``.
+        products (int): Number of products.
+        invalid_rate (float): Fraction of rows made invalid for the validation task
+            (missing mandatory fields, non-positive prices and orphaned items).
+
+    Returns:
+        dict: The ``products``, ``orders`` and ``order_items`` DataFrames.
+    """
+    rng = np.random.default_rng(seed)
+    products_df = generate_products(rng, products)
+    orders_df = generate_orders(rng, max(1, int(ORDERS_PER_SCALE * scale)), start, days)
+    order_items_df = generate_order_items(rng, orders_df, products_df)
+
+    if invalid_rate:
+        orders_df.loc[rng.random(len(orders_df)) < invalid_rate, 'user_id'] = None
+        bad_items = rng.random(len(order_items_df))
+        missing_price = bad_items < invalid_rate / 3
+        negative_price = (bad_items >= invalid_rate / 3) & (bad_items < invalid_rate * 2 / 3)
+        orphans = (bad_items >= invalid_rate * 2 / 3) & (bad_items < invalid_rate)
+        order_items_df.loc[missing_price, 'sale_price'] = None
+        order_items_df.loc[negative_price, 'sale_price'] = -1.0
+        order_items_df.loc[orphans, 'order_id'] += len(orders_df)
+
+    return {'products': products_df, 'orders': orders_df, 'order_items': order_items_df}
+
+
+def iter_parts(frames, rows_per_part=ROWS_PER_PART):
+    """Yield ``(relative path, DataFrame)`` for every file of the drop, in the Data/ layout."""
+    yield 'products.csv', frames['products']
+    for name in ('orders', 'order_items'):
+        df = frames[name]
+        for number, start in enumerate(range(0, len(df), rows_per_part), start=1):
+            yield f"{name}/{name}_part{number}.csv", df.iloc[start:start + rows_per_part]
+
+
+def write_parts(frames, out_dir, rows_per_part=ROWS_PER_PART):
+    """Write the drop as CSV part files under ``out_dir``, like Data/."""
+    for path, df in iter_parts(frames, rows_per_part):
+        path = os.path.join(out_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        df.to_csv(path, index=False)
+
+
+def upload_parts(s3, bucket, frames, rows_per_part=ROWS_PER_PART, prefix='raw-data/'):
+    """Upload the drop as CSV part files under ``prefix``, as the Lambda trigger expects it."""
+    for path, df in iter_parts(frames, rows_per_part):
+        s3.put_object(Bucket=bucket, Key=prefix + path, Body=df.to_csv(index=False).encode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--days', type=int, default=DAYS)
+    parser.add_argument('--start', default=START_DATE)
+    parser.add_argument('--products', type=int, default=PRODUCTS)
+    parser.add_argument('--invalid-rate', type=float, default=0.0)
+    parser.add_argument('--rows-per-part', type=int, default=ROWS_PER_PART)
+    parser.add_argument('--out', required=True, help="Directory to write products.csv, orders/ and order_items/ to")
+    args = parser.parse_args()
+
+    frames = generate(args.scale, args.seed, args.days, args.start, args.products, args.invalid_rate)
+    write_parts(frames, args.out, args.rows_per_part)
+    print(', '.join(f"{name}: {len(df)} rows" for name, df in frames.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+"""## Code shared by the Lambda trigger and the ECS tasks"""
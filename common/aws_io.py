@@ -0,0 +1,289 @@
+"""## Shared AWS clients with adaptive concurrency
+
+Every entry point gets its boto3 clients from here, so they all:
+
+- connect to ``AWS_REGION``, with a connection pool as wide as the workers
+  that share the client, TCP keep-alive, and botocore's standard retry mode
+  (``AWS_MAX_ATTEMPTS`` attempts, 5 by default);
+- wait for a slot of their service's ``AdaptiveLimiter`` before each call. The
+  limiter starts at the widest worker count of the service's clients, halves
+  when a call is throttled (SlowDown, ProvisionedThroughputExceeded, ...) and
+  grows back by about one slot per round of successful calls, so the thread
+  pools of a task slow down together when S3 or DynamoDB push back instead of
+  retrying into the throttle. A DynamoDB batch whose items come back
+  unprocessed is a throttle too, which the callers report with
+  ``record_throttle``;
+- count per service the calls, errors, throttled attempts, retries, time
+  spent waiting for a slot, and call latency, see ``service_stats``. Throttles
+  and retries are also counted in the current metrics stage.
+
+``ADAPTIVE_CONCURRENCY=false`` keeps the counters but never holds a call back.
+Clients are created on first use, and boto3 is only imported then.
+"""
+
+import os
+import threading
+import time
+from functools import lru_cache
+
+from common.metrics import count
+
+AWS_REGION = os.environ.get('AWS_REGION', 'eu-west-1')
+AWS_MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', '5'))
+ADAPTIVE_CONCURRENCY = os.environ.get('ADAPTIVE_CONCURRENCY', 'true').lower() in ('1', 'true', 'yes')
+
+# The error codes AWS services answer with when a request is throttled
+THROTTLE_ERRORS = frozenset({
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'SlowDown',
+    'BandwidthLimitExceeded',
+    'PriorRequestNotComplete',
+})
+
+# botocore's default connection pool size
+MIN_POOL = 10
+
+
+class AdaptiveLimiter:
+    """Bounds the calls in flight with an additive-increase, multiplicative-decrease limit.
+
+    Args:
+        max_limit (int): The most calls in flight, and the starting limit.
+        min_limit (int): The fewest calls in flight the limit is cut to.
+        decrease (float): The factor the limit is multiplied by on a throttle.
+    """
+
+    def __init__(self, max_limit, min_limit=1, decrease=0.5):
+        self.max_limit = max(min_limit, max_limit)
+        self.min_limit = min_limit
+        self.decrease = decrease
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self._cut_at = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free slot and take it.
+
+        Returns:
+            float: When the slot was taken, to pass back to ``release``.
+        """
+        with self._condition:
+            while self.in_flight >= max(self.min_limit, int(self.limit)):
+                self._condition.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, started, throttled=False):
+        """Give a slot back, growing the limit after a success or cutting it after a throttle."""
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self._cut(started)
+            else:
+                # One more slot per limit's worth of successful calls
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def throttled(self, started):
+        """Cut the limit for a throttle reported outside a call, e.g. unprocessed batch items."""
+        with self._condition:
+            self._cut(started)
+
+    def _cut(self, started):
+        # Calls already in flight at the last cut saw the old limit, so they don't cut again
+        if started >= self._cut_at:
+            self.limit = max(self.min_limit, self.limit * self.decrease)
+            self._cut_at = time.monotonic()
+
+    def widen(self, max_limit):
+        """Raise the most calls in flight, for a client with more workers."""
+        with self._condition:
+            if max_limit > self.max_limit:
+                self.limit += max_limit - self.max_limit
+                self.max_limit = max_limit
+                self._condition.notify_all()
+
+
+class ServiceStats:
+    """Thread-safe call counters for one AWS service."""
+
+    FIELDS = ('calls', 'errors', 'throttles', 'retries', 'wait_s', 'total_s', 'max_s')
+
+    def __init__(self, service):
+        self.service = service
+        self.counts = dict.fromkeys(self.FIELDS, 0)
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self.counts[name] += value
+
+    def call(self, elapsed, waited, error, retries):
+        with self._lock:
+            self.counts['calls'] += 1
+            self.counts['errors'] += int(error)
+            self.counts['retries'] += retries
+            self.counts['wait_s'] += waited
+            self.counts['total_s'] += elapsed
+            self.counts['max_s'] = max(self.counts['max_s'], elapsed)
+
+    def to_dict(self):
+        return {name: round(value, 4) if isinstance(value, float) else value for name, value in self.counts.items()}
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def _service(name, max_workers=None):
+    """Return the limiter and counters of a service, creating them on first use.
+
+    The limiter is widened to ``max_workers``, if given.
+    """
+    with _services_lock:
+        if name not in _services:
+            _services[name] = (AdaptiveLimiter(max_workers or MIN_POOL), ServiceStats(name))
+        limiter, stats = _services[name]
+    if max_workers:
+        limiter.widen(max_workers)
+    return limiter, stats
+
+
+def _error_code(parsed):
+    return (parsed or {}).get('Error', {}).get('Code') if isinstance(parsed, dict) else None
+
+
+def _retry_attempts(parsed=None, exception=None):
+    response = getattr(exception, 'response', None) or parsed or {}
+    return response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+
+
+def _attach(client, service, max_workers):
+    """Register the limiter and counter hooks of a service on a client's events."""
+    limiter, stats = _service(service, max_workers)
+
+    def before_call(context, **kwargs):
+        queued = time.monotonic()
+        context['aws_io_started'] = limiter.acquire() if ADAPTIVE_CONCURRENCY else queued
+        context['aws_io_waited'] = context['aws_io_started'] - queued
+        context['aws_io_throttled'] = False
+
+    def needs_retry(request_dict, response=None, **kwargs):
+        # Every throttled attempt is counted, including the ones botocore retries
+        if response is not None and _error_code(response[1]) in THROTTLE_ERRORS:
+            request_dict['context']['aws_io_throttled'] = True
+            stats.add(throttles=1)
+            count(f"aws.{service}.throttles")
+
+    def after_call(context, parsed=None, exception=None, **kwargs):
+        if 'aws_io_started' not in context:
+            return
+        started = context.pop('aws_io_started')
+        throttled = context['aws_io_throttled'] or _error_code(parsed) in THROTTLE_ERRORS
+        if ADAPTIVE_CONCURRENCY:
+            limiter.release(started, throttled)
+        retries = _retry_attempts(parsed, exception)
+        stats.call(
+            time.monotonic() - started, context['aws_io_waited'],
+            error=exception is not None or _error_code(parsed) is not None, retries=retries,
+        )
+        if retries:
+            count(f"aws.{service}.retries", retries)
+
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('needs-retry', needs_retry)
+    client.meta.events.register('after-call', after_call)
+    client.meta.events.register('after-call-error', after_call)
+    return client
+
+
+def _config(max_workers):
+    from botocore.config import Config
+
+    return Config(
+        region_name=AWS_REGION,
+        max_pool_connections=max(MIN_POOL, max_workers),
+        retries={'mode': 'standard', 'max_attempts': AWS_MAX_ATTEMPTS},
+        tcp_keepalive=True,
+    )
+
+
+@lru_cache(maxsize=None)
+def client(service, max_workers=MIN_POOL):
+    """Return the shared client of a service for up to ``max_workers`` threads.
+
+    Args:
+        service (str): The boto3 service name, e.g. ``s3``.
+        max_workers (int): The number of threads that call through the client at once.
+    """
+    import boto3
+
+    return _attach(boto3.client(service, config=_config(max_workers)), service, max_workers)
+
+
+@lru_cache(maxsize=None)
+def resource(service, max_workers=MIN_POOL):
+    """Return the shared boto3 resource of a service, e.g. ``dynamodb``, like ``client``.
+
+    Its ``meta.client`` serializes plain Python values.
+    """
+    import boto3
+
+    shared = boto3.resource(service, config=_config(max_workers))
+    _attach(shared.meta.client, service, max_workers)
+    return shared
+
+
+def record_throttle(service, started):
+    """Count a throttle that did not fail the call, such as unprocessed batch items, and cut the limit.
+
+    Args:
+        service (str): The boto3 service name.
+        started (float): When the throttled call started, on the ``time.monotonic`` clock.
+    """
+    limiter, stats = _service(service)
+    stats.add(throttles=1)
+    count(f"aws.{service}.throttles")
+    if ADAPTIVE_CONCURRENCY:
+        limiter.throttled(started)
+
+
+def service_stats(since=None):
+    """Return the counters and current concurrency limit of every service used so far.
+
+    Args:
+        since (dict): An earlier ``service_stats()``. The counters are then the
+            ones added since, except ``max_s``, which stays the slowest call overall.
+    """
+    with _services_lock:
+        services = dict(_services)
+    result = {}
+    for name, (limiter, stats) in sorted(services.items()):
+        counters = stats.to_dict()
+        before = (since or {}).get(name, {})
+        for field in ServiceStats.FIELDS:
+            if field != 'max_s' and field in before:
+                counters[field] = round(counters[field] - before[field], 4)
+        result[name] = {**counters, 'limit': round(limiter.limit, 2), 'max_limit': limiter.max_limit}
+    return result
+
+
+def report():
+    """Print one line of counters per service."""
+    for name, counters in service_stats().items():
+        calls = counters['calls']
+        mean = counters['total_s'] / calls if calls else 0.0
+        print(
+            f"AWS {name}: {calls} calls, {counters['errors']} errors, {counters['throttles']} throttled, "
+            f"{counters['retries']} retries, {mean * 1000:.1f} ms mean, {counters['max_s'] * 1000:.1f} ms max, "
+            f"{counters['wait_s']:.2f}s waiting, concurrency {counters['limit']:g} of {counters['max_limit']}"
+        )
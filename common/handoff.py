@@ -0,0 +1,257 @@
+"""## Intermediate file format for the validated/ hand-off between the tasks"""
+
+import os
+from io import BytesIO, StringIO
+
+from common.lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+# Format used for the validated/ prefix: 'parquet' (default) or 'csv'
+HANDOFF_FORMAT = os.environ.get('HANDOFF_FORMAT', 'parquet')
+PARQUET_COMPRESSION = os.environ.get('PARQUET_COMPRESSION', 'zstd')
+
+# Explicit Arrow types for the validated datasets, by Arrow type alias.
+# Columns that are not listed keep the type Arrow infers for them.
+SCHEMAS = {
+    'products': {
+        'id': 'int64',
+        'sku': 'string',
+        'cost': 'double',
+        'category': 'string',
+        'name': 'string',
+        'brand': 'string',
+        'retail_price': 'double',
+        'department': 'string',
+    },
+    'orders': {
+        'order_id': 'int64',
+        'user_id': 'int64',
+        'status': 'string',
+        'created_at': 'timestamp[us]',
+        'returned_at': 'timestamp[us]',
+        'shipped_at': 'timestamp[us]',
+        'delivered_at': 'timestamp[us]',
+        'num_of_item': 'int64',
+        'order_date': 'date32',
+        'return_date': 'date32',
+    },
+    'order_items': {
+        'id': 'int64',
+        'order_id': 'int64',
+        'user_id': 'int64',
+        'product_id': 'int64',
+        'status': 'string',
+        'created_at': 'timestamp[us]',
+        'shipped_at': 'timestamp[us]',
+        'delivered_at': 'timestamp[us]',
+        'returned_at': 'timestamp[us]',
+        'sale_price': 'double',
+    },
+    # The KPI tables, as written under processed/ (see common.partitions),
+    # and the rolling-window KPIs computed from them (see Task_2/rolling.py)
+    'category_kpi': {
+        'category': 'string',
+        'order_date': 'date32',
+        'daily_revenue': 'double',
+        'avg_order_value': 'double',
+        'avg_return_rate': 'double',
+    },
+    'order_kpi': {
+        'order_date': 'date32',
+        'total_orders': 'int64',
+        'total_revenue': 'double',
+        'total_items_sold': 'int64',
+        'return_rate': 'double',
+        'unique_customers': 'int64',
+    },
+    'rolling_category_kpi': {
+        'category': 'string',
+        'order_date': 'date32',
+        'revenue_7d': 'double',
+        'orders_7d': 'int64',
+        'avg_order_value_7d': 'double',
+        'return_rate_7d': 'double',
+        'revenue_30d': 'double',
+        'orders_30d': 'int64',
+        'avg_order_value_30d': 'double',
+        'return_rate_30d': 'double',
+    },
+    # The per-part order lines of the incremental state, one file per order date (see common.incremental)
+    'order_lines': {
+        'part': 'string',
+        'order_id': 'int64',
+        'user_id': 'int64',
+        'category': 'string',
+        'revenue_cents': 'int64',
+        'items': 'int64',
+    },
+}
+
+
+class CsvFormat:
+    """Plain CSV, as the validated/ prefix was originally written."""
+
+    extension = 'csv'
+
+    def dumps(self, df, name):
+        buffer = StringIO()
+        df.to_csv(buffer, index=False)
+        return buffer.getvalue().encode('utf-8')
+
+    def loads(self, body, name, columns=None):
+        return pd.read_csv(BytesIO(body), usecols=columns)
+
+    def open_writer(self, sink, name):
+        return _CsvStreamWriter(sink)
+
+
+class _CsvStreamWriter:
+    """Writes DataFrame chunks to a binary sink as one CSV with a single header."""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.header = True
+
+    def write(self, df):
+        self.sink.write(df.to_csv(index=False, header=self.header).encode('utf-8'))
+        self.header = False
+
+    def close(self):
+        pass
+
+
+class ParquetFormat:
+    """Compressed Parquet written with the explicit schema for each dataset."""
+
+    extension = 'parquet'
+
+    def __init__(self, compression=PARQUET_COMPRESSION):
+        self.compression = compression
+
+    def dumps(self, df, name):
+        import pyarrow.parquet as pq
+
+        table = _arrow_table(df, name)
+        buffer = BytesIO()
+        pq.write_table(table, buffer, compression=self.compression)
+        return buffer.getvalue()
+
+    def loads(self, body, name, columns=None):
+        import pyarrow.parquet as pq
+
+        return pq.read_table(BytesIO(body), columns=columns).to_pandas()
+
+    def open_writer(self, sink, name):
+        return _ParquetStreamWriter(sink, name, self.compression)
+
+
+def _arrow_table(df, name, schema=None):
+    """Convert a DataFrame to an Arrow table cast to the declared schema for ``name``.
+
+    When ``schema`` is given, the table is cast to it instead. Otherwise, columns
+    that are not declared keep their inferred type, and undeclared all-null
+    columns become strings so later chunks can still carry values.
+    """
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if schema is None:
+        declared = SCHEMAS.get(name, {})
+        schema = pa.schema([
+            pa.field(field.name, pa.type_for_alias(declared[field.name]))
+            if field.name in declared
+            else pa.field(field.name, pa.string()) if pa.types.is_null(field.type)
+            else field
+            for field in table.schema
+        ])
+    return table.cast(schema)
+
+
+class _ParquetStreamWriter:
+    """Writes DataFrame chunks to a binary sink as row groups of one Parquet file."""
+
+    def __init__(self, sink, name, compression):
+        self.sink = sink
+        self.name = name
+        self.compression = compression
+        self.writer = None
+
+    def write(self, df):
+        import pyarrow.parquet as pq
+
+        if self.writer is None:
+            table = _arrow_table(df, self.name)
+            self.writer = pq.ParquetWriter(self.sink, table.schema, compression=self.compression)
+        else:
+            table = _arrow_table(df, self.name, self.writer.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+FORMATS = {
+    'csv': CsvFormat,
+    'parquet': ParquetFormat,
+}
+
+
+def get_format(name=None):
+    """Return the hand-off format registered under ``name``.
+
+    Args:
+        name (str): The format name. Defaults to ``HANDOFF_FORMAT``.
+
+    Returns:
+        The format object, with ``extension``, ``dumps``, ``loads`` and ``open_writer``.
+    """
+    name = name or HANDOFF_FORMAT
+    if name not in FORMATS:
+        raise ValueError(f"Unknown hand-off format: {name}. Expected one of {', '.join(FORMATS)}")
+    return FORMATS[name]()
+
+
+def frame_key(prefix, name, fmt):
+    """Build the S3 key of a dataset written in the given format."""
+    return f"{prefix}{name}.{fmt.extension}"
+
+
+def save_frame(s3, bucket, prefix, name, df, fmt=None):
+    """Serialize a DataFrame in the hand-off format and upload it to S3.
+
+    Args:
+        s3: A boto3 S3 client.
+        bucket (str): The bucket to write to.
+        prefix (str): The S3 prefix to write under, e.g. ``validated/``.
+        name (str): The dataset name, e.g. ``orders``.
+        df (pandas.DataFrame): The data to save.
+        fmt: The format object to use. Defaults to ``get_format()``.
+
+    Returns:
+        str: The S3 key that was written.
+    """
+    fmt = fmt or get_format()
+    key = frame_key(prefix, name, fmt)
+    s3.put_object(Bucket=bucket, Key=key, Body=fmt.dumps(df, name))
+    return key
+
+
+def load_frame(s3, bucket, prefix, name, fmt=None, columns=None):
+    """Download a dataset written by ``save_frame`` and parse it.
+
+    Args:
+        s3: A boto3 S3 client.
+        bucket (str): The bucket to read from.
+        prefix (str): The S3 prefix to read under, e.g. ``validated/``.
+        name (str): The dataset name, e.g. ``orders``.
+        fmt: The format object to use. Defaults to ``get_format()``.
+        columns (list): Only parse these columns. Defaults to all.
+
+    Returns:
+        pandas.DataFrame: The dataset.
+    """
+    fmt = fmt or get_format()
+    response = s3.get_object(Bucket=bucket, Key=frame_key(prefix, name, fmt))
+    return fmt.loads(response['Body'].read(), name, columns=columns)
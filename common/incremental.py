@@ -0,0 +1,461 @@
+"""## State for incremental runs: file manifest and per-part partial aggregates
+
+An incremental run only validates the part files that are not yet in the
+manifest, or whose ETag changed since. Their partial aggregates are merged
+into the stored state, and only the KPIs of the order dates they touch are
+recomputed and rewritten.
+
+The partial aggregates are kept per order items part file, as ``order_lines``:
+for each part, order and category, the cents and the number of items the part
+adds. A part sent again, e.g. corrected, replaces exactly its own lines, and an
+order sent again moves the lines of its items to its new order date. The KPIs
+of a date are summed from its lines, with the return flag of each order from
+the orders index, so nothing is counted twice.
+
+Order items whose order is not known yet are parked in the state and offered
+to the referential check again on the next run, so the result does not depend
+on the order in which the part files arrive. Items still parked after
+``PENDING_MAX_DAYS`` days are quarantined instead.
+
+The lines are stored as one Parquet file per order date, like the KPI output
+(see ``common.partitions``), and a run only reads and rewrites the dates it
+touches: the manifest records the dates each part was counted on. The orders
+index, which the referential check of every run reads whole, and the parked
+items are stored as a snapshot next to them. Files are never overwritten. The
+``CURRENT.json`` pointer names the live file of every table and date and holds
+the manifest, so writing the pointer commits a run at once; the files it
+replaced are deleted afterwards.
+"""
+
+import json
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+from common.handoff import ParquetFormat, save_frame
+from common.lazy import lazy_import
+from common.partitions import PARTITION_COLUMN
+from common.rules import REASONS_COLUMN
+
+pd = lazy_import('pandas')
+
+INCREMENTAL = os.environ.get('INCREMENTAL', 'false').lower() in ('1', 'true', 'yes')
+STATE_PREFIX = os.environ.get('STATE_PREFIX', 'state/')
+# Number of order date partitions read or written at once
+STATE_WORKERS = int(os.environ.get('STATE_WORKERS', '16'))
+
+# Part files picked up by the current run, handed from Task 1 to Task 2
+BATCH_FILES_KEY = 'validated/batch_files.json'
+
+# The column of the validated order items naming the part file each was read from
+PART_COLUMN = 'part'
+
+# The counted orders, and the lines of every order items part: per part, order
+# and category, the revenue in integer cents, so merged sums do not depend on
+# merge order, and the number of items. The lines are stored per order date.
+TABLES = {
+    'orders_index': ['order_id', 'order_date', 'is_returned'],
+    'order_lines': [PART_COLUMN, 'order_id', 'user_id', 'category', 'revenue_cents', 'items'],
+}
+ORDERS_INDEX = 'orders_index'
+ORDER_LINES = 'order_lines'
+# Validated order items whose order has not arrived yet, kept whole until it does
+PENDING_ITEMS = 'pending_items'
+# The day an order item was first parked, and the days it may stay parked
+PARKED_ON = 'parked_on'
+PENDING_MAX_DAYS = int(os.environ.get('PENDING_MAX_DAYS', '7'))
+
+# The aggregates of a batch's items as the micro-batches apply them: sums, and
+# distinct keys for the nunique counts
+AGGREGATES = {
+    'cat_sums': ['category', 'order_date', 'revenue_cents', 'returned_items'],
+    'cat_orders': ['category', 'order_date', 'order_id'],
+    'day_sums': ['order_date', 'revenue_cents', 'items', 'returned_items'],
+    'day_orders': ['order_date', 'order_id'],
+    'day_customers': ['order_date', 'user_id'],
+}
+
+
+def _empty(name):
+    return pd.DataFrame(columns=TABLES[name])
+
+
+def _read(s3, bucket, key, name):
+    """Download and parse one Parquet file of the state."""
+    return ParquetFormat().loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read(), name)
+
+
+def park_items(orphans, today=None, max_days=PENDING_MAX_DAYS):
+    """Date newly parked order items and split off the ones parked for too long.
+
+    Args:
+        orphans (pandas.DataFrame): The order items whose order is not known, with
+            the ``parked_on`` day of the ones parked by earlier runs.
+        today (datetime.date): The day of the run. Defaults to today, in UTC.
+        max_days (int): The days an item may stay parked.
+
+    Returns:
+        tuple: The items to park, with their ``parked_on`` day, and the expired
+        items, without it but with a ``reasons`` column, to quarantine.
+    """
+    today = pd.Timestamp(today or datetime.utcnow()).normalize()
+    if PARKED_ON in orphans:
+        parked_on = pd.to_datetime(orphans[PARKED_ON]).fillna(today)
+    else:
+        parked_on = pd.Series(today, index=orphans.index)
+    expired = ((today - parked_on).dt.days > max_days).to_numpy()
+    pending = orphans[~expired].assign(**{PARKED_ON: parked_on[~expired].dt.date})
+    expired = orphans[expired].drop(columns=PARKED_ON, errors='ignore').assign(**{REASONS_COLUMN: 'unknown_order'})
+    return pending, expired
+
+
+def orders_lookup(orders):
+    """Project validated orders down to the columns kept in the orders index."""
+    lookup = orders[['order_id', 'order_date']].copy()
+    lookup['order_date'] = pd.to_datetime(lookup['order_date']).dt.date
+    lookup['is_returned'] = orders['returned_at'].notna()
+    return lookup
+
+
+def compute_partials(products, orders, order_items, orders_index=None):
+    """Compute the partial aggregates contributed by a batch of new data.
+
+    Order items may reference orders from an earlier batch, so the new orders
+    are looked up together with the stored orders index.
+
+    Args:
+        products (pandas.DataFrame): Validated products data.
+        orders (pandas.DataFrame): Validated orders from the new part files.
+        order_items (pandas.DataFrame): Validated order items from the new part
+            files, with the ``part`` they were read from, if known.
+        orders_index (pandas.DataFrame): The stored orders index, if any.
+
+    Returns:
+        dict: The batch's ``orders_index`` rows, its ``order_lines`` with their
+        ``order_date``, and the tables in ``AGGREGATES``.
+    """
+    new_orders = orders_lookup(orders)
+    lookup = new_orders
+    if orders_index is not None and len(orders_index):
+        lookup = pd.concat([new_orders, orders_index], ignore_index=True)
+        lookup = lookup.drop_duplicates('order_id', keep='first')
+
+    columns = ['id', 'order_id', 'user_id', 'product_id', 'sale_price']
+    if PART_COLUMN in order_items:
+        columns.append(PART_COLUMN)
+    merged = order_items[columns].merge(
+        lookup[['order_id', 'order_date', 'is_returned']], on='order_id', how='inner'
+    )
+    categories = products.drop_duplicates('id', keep='last').set_index('id')['category']
+    if isinstance(categories.dtype, pd.CategoricalDtype):
+        categories = categories.astype(categories.cat.categories.dtype)
+    merged['category'] = merged['product_id'].map(categories)
+    merged['is_returned'] = merged['is_returned'].astype(bool)
+    merged['revenue_cents'] = (merged['sale_price'] * 100).round().astype('int64')
+    if PART_COLUMN not in merged:
+        merged[PART_COLUMN] = None
+
+    return {ORDERS_INDEX: new_orders, ORDER_LINES: sum_lines(merged), **aggregate_items(merged)}
+
+
+def sum_lines(items):
+    """Sum order items, with their ``part``, ``category``, ``order_date`` and ``revenue_cents``, into order lines.
+
+    Returns:
+        pandas.DataFrame: The ``order_lines`` columns, after the ``order_date``.
+    """
+    keys = [PARTITION_COLUMN, PART_COLUMN, 'order_id', 'user_id', 'category']
+    lines = (
+        items.groupby(keys, dropna=False, sort=False)
+        .agg(revenue_cents=('revenue_cents', 'sum'), items=('revenue_cents', 'size'))
+        .reset_index()
+    )
+    return lines[[PARTITION_COLUMN] + TABLES[ORDER_LINES]]
+
+
+def aggregate_items(items):
+    """Aggregate counted order items into the tables in ``AGGREGATES``.
+
+    Args:
+        items (pandas.DataFrame): Order items with their ``category``, ``order_date``,
+            ``revenue_cents`` and ``is_returned`` flag.
+
+    Returns:
+        dict: The aggregate tables, keyed by name.
+    """
+    cat_sums = (
+        items.groupby(['category', 'order_date'])
+        .agg(revenue_cents=('revenue_cents', 'sum'), returned_items=('is_returned', 'sum'))
+        .reset_index()
+    )
+    day_sums = (
+        items.groupby('order_date')
+        .agg(
+            revenue_cents=('revenue_cents', 'sum'),
+            items=('id', 'count'),
+            returned_items=('is_returned', 'sum'),
+        )
+        .reset_index()
+    )
+
+    return {
+        'cat_sums': cat_sums[AGGREGATES['cat_sums']],
+        'cat_orders': items[AGGREGATES['cat_orders']].dropna().drop_duplicates(),
+        'day_sums': day_sums[AGGREGATES['day_sums']],
+        'day_orders': items[AGGREGATES['day_orders']].drop_duplicates(),
+        'day_customers': items[AGGREGATES['day_customers']].drop_duplicates(),
+    }
+
+
+def line_counts(lines, orders_index):
+    """Sum order lines into the counts ``kpis_from_counts`` takes.
+
+    Args:
+        lines (pandas.DataFrame): Order lines with their ``order_date``.
+        orders_index (pandas.DataFrame): The orders index, for the return flag of each order.
+
+    Returns:
+        tuple: ``revenue_cents``, ``returned_items`` and ``order_count`` per
+        (category, order_date), and ``revenue_cents``, ``items``, ``returned_items``,
+        ``total_orders`` and ``unique_customers`` per order_date.
+    """
+    returned = lines['order_id'].map(orders_index.set_index('order_id')['is_returned']).eq(True)
+    lines = lines.assign(returned_items=lines['items'].where(returned, 0))
+
+    cat_counts = (
+        lines.groupby(['category', 'order_date'])
+        .agg(
+            revenue_cents=('revenue_cents', 'sum'),
+            returned_items=('returned_items', 'sum'),
+            order_count=('order_id', 'nunique'),
+        )
+        .reset_index()
+    )
+    day_counts = (
+        lines.groupby('order_date')
+        .agg(
+            revenue_cents=('revenue_cents', 'sum'),
+            items=('items', 'sum'),
+            returned_items=('returned_items', 'sum'),
+            total_orders=('order_id', 'nunique'),
+            unique_customers=('user_id', 'nunique'),
+        )
+        .reset_index()
+    )
+    return cat_counts, day_counts
+
+
+def kpis_from_counts(cat_counts, day_counts):
+    """Compute category-level and order-level KPIs from merged sums and distinct counts.
+
+    Args:
+        cat_counts (pandas.DataFrame): ``revenue_cents``, ``returned_items`` and
+            ``order_count`` per (category, order_date).
+        day_counts (pandas.DataFrame): ``revenue_cents``, ``items``, ``returned_items``,
+            ``total_orders`` and ``unique_customers`` per order_date.
+
+    Returns:
+        tuple: A tuple of two pandas DataFrames: category-level KPIs and order-level KPIs.
+    """
+    cat_kpi = cat_counts.sort_values(['category', 'order_date'], ignore_index=True)
+    revenue = cat_kpi['revenue_cents'] / 100
+    cat_kpi['daily_revenue'] = revenue.round(2)
+    cat_kpi['avg_order_value'] = (revenue / cat_kpi['order_count']).round(2)
+    cat_kpi['avg_return_rate'] = (cat_kpi['returned_items'] / cat_kpi['order_count']).round(4) * 100
+    cat_kpi = cat_kpi[['category', 'order_date', 'daily_revenue', 'avg_order_value', 'avg_return_rate']]
+
+    order_kpi = day_counts.sort_values('order_date', ignore_index=True)
+    order_kpi['total_revenue'] = (order_kpi['revenue_cents'] / 100).round(2)
+    order_kpi['total_items_sold'] = order_kpi['items'].astype('int64')
+    order_kpi['return_rate'] = (order_kpi['returned_items'] / order_kpi['items']).round(4) * 100
+    order_kpi = order_kpi[
+        ['order_date', 'total_orders', 'total_revenue', 'total_items_sold', 'return_rate', 'unique_customers']
+    ]
+
+    return cat_kpi, order_kpi
+
+
+class IncrementalState:
+    """The file manifest, orders index and parked items of earlier runs, and their order lines by date.
+
+    The order lines are read per order date, only for the dates a run touches.
+
+    Args:
+        manifest (dict): The counted part files by key, each with its ``etag`` and
+            the order ``dates`` its lines are on.
+        orders_index (pandas.DataFrame): The counted orders.
+        pending_items (pandas.DataFrame): The parked order items.
+        files (dict): The S3 keys of the stored orders index and parked items.
+        partitions (dict): The S3 key of the stored lines of each order date, by ISO date.
+        location (tuple): The S3 client and bucket the partitions are read from.
+    """
+
+    def __init__(self, manifest=None, orders_index=None, pending_items=None, files=None, partitions=None,
+                 location=None):
+        self.manifest = manifest or {}
+        self.orders_index = orders_index if orders_index is not None else _empty(ORDERS_INDEX)
+        self.pending_items = pending_items if pending_items is not None else pd.DataFrame()
+        self.files = files or {}
+        self.partitions = partitions or {}
+        self.location = location
+        # The lines of the order dates read or merged so far, and the dates to write back
+        self.lines = {}
+        self.dirty = set()
+
+    @classmethod
+    def load(cls, s3, bucket, prefix=STATE_PREFIX):
+        """Load the manifest, orders index and parked items, or an empty state if there is none yet.
+
+        No order lines are read until a date needs them.
+        """
+        try:
+            response = s3.get_object(Bucket=bucket, Key=f"{prefix}CURRENT.json")
+        except s3.exceptions.NoSuchKey:
+            return cls(location=(s3, bucket))
+
+        current = json.loads(response['Body'].read())
+        files = current['files']
+        orders_index = _read(s3, bucket, files[ORDERS_INDEX], ORDERS_INDEX)
+        pending_items = _read(s3, bucket, files[PENDING_ITEMS], PENDING_ITEMS)
+        return cls(current['manifest'], orders_index, pending_items, files, current['partitions'], (s3, bucket))
+
+    def new_files(self, objects):
+        """Return the listed objects that are not in the manifest with the same ETag."""
+        return [obj for obj in objects if self.manifest.get(obj['Key'], {}).get('etag') != obj['ETag']]
+
+    def merge(self, partials, files, pending_items):
+        """Merge a batch's partial aggregates and files into the state.
+
+        The lines of the batch's parts that were counted before are replaced by
+        the new ones, and the lines of the orders it sends again move to their
+        new order date. Only the order dates involved are read.
+
+        Args:
+            partials (dict): The tables returned by ``compute_partials``.
+            files (dict): The batch's part files, mapping key to ETag.
+            pending_items (pandas.DataFrame): The order items still waiting for their
+                order after this batch. They replace the previously parked items.
+
+        Returns:
+            list: The affected order dates, as ISO dates.
+        """
+        orders = partials[ORDERS_INDEX]
+        new_lines = partials[ORDER_LINES]
+
+        # The dates the parts and orders sent again were counted on, and the new ones
+        resent = [key for key in files if key in self.manifest]
+        resent_orders = self.orders_index[self.orders_index['order_id'].isin(orders['order_id'])]
+        dates = {day for key in resent for day in self.manifest[key]['dates']}
+        dates |= {str(day) for day in resent_orders['order_date']}
+        dates |= {str(day) for day in orders.loc[orders['order_id'].isin(resent_orders['order_id']), 'order_date']}
+        dates |= {str(day) for day in new_lines[PARTITION_COLUMN]}
+
+        frames = [df for df in (orders, self.orders_index) if len(df)]
+        combined = pd.concat(frames, ignore_index=True) if frames else _empty(ORDERS_INDEX)
+        self.orders_index = combined.drop_duplicates('order_id', keep='first')[TABLES[ORDERS_INDEX]]
+
+        stored = self._frame(dates)
+        stored = stored[~stored[PART_COLUMN].isin(resent)]
+        if len(resent_orders):
+            moved = stored['order_id'].map(orders.drop_duplicates('order_id').set_index('order_id')[PARTITION_COLUMN])
+            stored = stored.assign(**{PARTITION_COLUMN: moved.where(moved.notna(), stored[PARTITION_COLUMN])})
+        frames = [df for df in (stored, new_lines) if len(df)]
+        lines = pd.concat(frames, ignore_index=True) if frames else new_lines
+        days = lines[PARTITION_COLUMN].map(str)
+
+        for day in dates:
+            self.lines[day] = _empty(ORDER_LINES)
+        for day, part in lines.groupby(days, sort=False):
+            self.lines[day] = part[TABLES[ORDER_LINES]].reset_index(drop=True)
+        self.dirty |= dates
+
+        # The parts sent again are only on the dates of their new lines; the
+        # others keep their dates outside the ones merged
+        for key, etag in files.items():
+            self.manifest[key] = {'etag': etag, 'dates': []}
+        for key, part_days in days.groupby(lines[PART_COLUMN]).unique().items():
+            entry = self.manifest.setdefault(key, {'etag': None, 'dates': []})
+            entry['dates'] = sorted((set(entry['dates']) - dates) | set(part_days))
+        self.pending_items = pending_items
+
+        return sorted(dates)
+
+    def kpis(self, dates):
+        """Compute the category-level and order-level KPIs of some order dates from their lines."""
+        return kpis_from_counts(*line_counts(self._frame(dates), self.orders_index))
+
+    def category_counts(self, dates):
+        """Sum the cents, returned items and distinct orders per (category, order_date) of some order dates.
+
+        Returns:
+            pandas.DataFrame: The counts, as ``kpi_engine.compute_category_counts`` returns them.
+        """
+        return line_counts(self._frame(dates), self.orders_index)[0]
+
+    def _frame(self, dates):
+        """Return the lines of some order dates, with their ``order_date``, reading the missing ones."""
+        dates = sorted({str(day) for day in dates})
+        missing = [day for day in dates if day in self.partitions and day not in self.lines]
+        if missing:
+            s3, bucket = self.location
+            with ThreadPoolExecutor(max_workers=max(1, STATE_WORKERS)) as pool:
+                parts = pool.map(lambda day: _read(s3, bucket, self.partitions[day], ORDER_LINES), missing)
+                self.lines.update(zip(missing, parts))
+
+        frames = [
+            self.lines[day].assign(**{PARTITION_COLUMN: date.fromisoformat(day)})
+            for day in dates if len(self.lines.get(day, ()))
+        ]
+        if not frames:
+            return pd.DataFrame(columns=[PARTITION_COLUMN] + TABLES[ORDER_LINES])
+        return pd.concat(frames, ignore_index=True)[[PARTITION_COLUMN] + TABLES[ORDER_LINES]]
+
+    def save(self, s3, bucket, prefix=STATE_PREFIX):
+        """Write the orders index, the parked items and the changed dates, and point ``CURRENT.json`` at them.
+
+        The files they replace are deleted once the pointer has moved.
+
+        Returns:
+            list: The S3 keys written.
+        """
+        run_id = datetime.utcnow().strftime('%Y-%m-%d-T-%H-%M-%S') + '-' + uuid.uuid4().hex[:8]
+        snapshot = f"{prefix}snapshots/{run_id}/"
+        fmt = ParquetFormat()
+        files = {
+            ORDERS_INDEX: save_frame(s3, bucket, snapshot, ORDERS_INDEX, self.orders_index, fmt=fmt),
+            PENDING_ITEMS: save_frame(s3, bucket, snapshot, PENDING_ITEMS, self.pending_items, fmt=fmt),
+        }
+
+        def write(day):
+            key = f"{prefix}{ORDER_LINES}/{PARTITION_COLUMN}={day}/{run_id}.parquet"
+            s3.put_object(Bucket=bucket, Key=key, Body=fmt.dumps(self.lines[day], ORDER_LINES))
+            return day, key
+
+        with ThreadPoolExecutor(max_workers=max(1, STATE_WORKERS)) as pool:
+            written = dict(pool.map(write, sorted(day for day in self.dirty if len(self.lines[day]))))
+
+        replaced = list(self.files.values()) + [self.partitions[day] for day in self.dirty if day in self.partitions]
+        partitions = {day: key for day, key in self.partitions.items() if day not in self.dirty}
+        partitions = dict(sorted({**partitions, **written}.items()))
+        current = {'files': files, 'partitions': partitions, 'manifest': self.manifest, 'updated_at': run_id}
+        s3.put_object(Bucket=bucket, Key=f"{prefix}CURRENT.json", Body=json.dumps(current).encode('utf-8'))
+
+        # delete_objects takes up to 1000 keys per request
+        for start in range(0, len(replaced), 1000):
+            old = [{'Key': key} for key in replaced[start:start + 1000]]
+            s3.delete_objects(Bucket=bucket, Delete={'Objects': old, 'Quiet': True})
+        self.files, self.partitions, self.dirty = files, partitions, set()
+        return list(files.values()) + list(written.values())
+
+
+def save_batch_files(s3, bucket, objects):
+    """Record the raw files picked up by Task 1, for Task 2 to archive and commit."""
+    files = {obj['Key']: obj['ETag'] for obj in objects}
+    s3.put_object(Bucket=bucket, Key=BATCH_FILES_KEY, Body=json.dumps(files).encode('utf-8'))
+
+
+def load_batch_files(s3, bucket):
+    """Load the raw files recorded by ``save_batch_files``, mapping key to ETag."""
+    response = s3.get_object(Bucket=bucket, Key=BATCH_FILES_KEY)
+    return json.loads(response['Body'].read())
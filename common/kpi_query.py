@@ -0,0 +1,349 @@
+"""## Cached read path over the CategoryKPI and OrderKPI tables
+
+Serves the KPIs of a date range, for one category, every category or the
+whole shop, without scans:
+
+- ``CategoryKPI`` (``category`` + ``order_date``) is read with ``Query`` on the
+  category and a ``BETWEEN`` on the date. Long ranges are split into segments
+  of ``segment_days`` fetched in parallel, each following ``LastEvaluatedKey``.
+- ``OrderKPI`` (``order_date``) is read with ``BatchGetItem``, 100 dates per
+  call, calls in parallel, retrying ``UnprocessedKeys`` with backoff.
+
+Results pass through a read-through cache of single items, bounded in size
+(least recently used first out) and in age (``ttl`` seconds). Dates without an
+item are cached as absent too, so a repeated dashboard load is answered from
+memory without any request.
+
+A run of the transformation task rewrites ``processed/<table>/_index.json``,
+which records the run that last wrote each order date (see
+``common.partitions``). When given the bucket, the reader re-reads the indexes
+at most every ``sync_interval`` seconds, a conditional GET that is answered
+with 304 while nothing changed, and drops the cached items of the dates a new
+run rewrote. An index seen for the first time, e.g. written by the first run
+after the reader started, drops every date it lists. Updates the index does
+not record, such as the real-time micro-batches, are picked up within ``ttl``.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from botocore.exceptions import ClientError
+
+from common.aws_io import record_throttle
+from common.handoff import SCHEMAS
+from common.lazy import lazy_import
+from common.partitions import PROCESSED_PREFIX, index_key
+
+pd = lazy_import('pandas')
+
+KPI_CACHE_TTL = float(os.environ.get('KPI_CACHE_TTL', '300'))
+KPI_CACHE_ITEMS = int(os.environ.get('KPI_CACHE_ITEMS', '200000'))
+KPI_QUERY_WORKERS = int(os.environ.get('KPI_QUERY_WORKERS', '8'))
+
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_SIZE = 100
+
+# The KPI attributes returned for each table, as written by Task 2
+ATTRIBUTES = {
+    'category_kpi': list(SCHEMAS['category_kpi']),
+    'order_kpi': list(SCHEMAS['order_kpi']),
+}
+
+# Marks a date cached as having no item
+ABSENT = object()
+
+
+class LruTtlCache:
+    """A thread-safe mapping that drops the least recently used entries beyond ``max_items``
+    and treats entries older than ``ttl`` seconds as missing.
+
+    Args:
+        max_items (int): The number of entries kept.
+        ttl (float): How long an entry is served, in seconds.
+        clock: The time source, in seconds.
+    """
+
+    def __init__(self, max_items=KPI_CACHE_ITEMS, ttl=KPI_CACHE_TTL, clock=time.monotonic):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.clock = clock
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'invalidations': 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_many(self, keys):
+        """Return the fresh values of the keys that are cached, and the keys that are not."""
+        now = self.clock()
+        found, missing = {}, []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and now - entry[1] >= self.ttl:
+                    del self._entries[key]
+                    self.stats['expired'] += 1
+                    entry = None
+                if entry is None:
+                    missing.append(key)
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = entry[0]
+            self.stats['hits'] += len(found)
+            self.stats['misses'] += len(missing)
+        return found, missing
+
+    def put_many(self, values):
+        now = self.clock()
+        with self._lock:
+            for key, value in values.items():
+                self._entries[key] = (value, now)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, predicate=None):
+        """Drop the entries whose key matches ``predicate``, or every entry."""
+        with self._lock:
+            keys = [key for key in self._entries if predicate is None or predicate(key)]
+            for key in keys:
+                del self._entries[key]
+            self.stats['invalidations'] += len(keys)
+        return len(keys)
+
+
+def _dates(start, end):
+    """List the ISO dates from ``start`` to ``end``, inclusive."""
+    start, end = date.fromisoformat(str(start)), date.fromisoformat(str(end))
+    return [(start + timedelta(days=n)).isoformat() for n in range((end - start).days + 1)]
+
+
+def _frame(items, table):
+    """Build a KPI frame with the dtypes of the processed output, from items with Decimal numbers."""
+    columns = ATTRIBUTES[table]
+    df = pd.DataFrame([{name: item.get(name) for name in columns} for item in items], columns=columns)
+    numeric = {
+        name: 'int64' if alias == 'int64' else 'float64'
+        for name, alias in SCHEMAS[table].items() if alias in ('int64', 'double')
+    }
+    df = df.astype(numeric)
+    df['order_date'] = pd.to_datetime(df['order_date']).dt.date
+    return df
+
+
+class KpiQuery:
+    """Date-range and per-category reads of the KPI tables through an item cache.
+
+    Args:
+        client: The client of a boto3 DynamoDB resource (``ddb.meta.client``), which
+            deserializes to plain Python values.
+        category_table (str): The CategoryKPI table name.
+        order_table (str): The OrderKPI table name.
+        s3: A boto3 S3 client, to follow the partition indexes. Optional.
+        bucket (str): The bucket of the processed output. Optional.
+        cache (LruTtlCache): The item cache. Defaults to one with the ``KPI_CACHE_*`` settings.
+        max_workers (int): The number of requests in flight at once.
+        segment_days (int): The length of the date segments a category's range is split into.
+        sync_interval (float): How often the partition indexes are checked, in seconds.
+        prefix (str): The S3 prefix of the processed output.
+    """
+
+    def __init__(self, client, category_table, order_table, s3=None, bucket=None, cache=None,
+                 max_workers=KPI_QUERY_WORKERS, segment_days=90, sync_interval=30.0, prefix=PROCESSED_PREFIX):
+        self.client = client
+        self.tables = {'category_kpi': category_table, 'order_kpi': order_table}
+        self.s3 = s3
+        self.bucket = bucket
+        self.cache = cache or LruTtlCache()
+        self.max_workers = max_workers
+        self.segment_days = segment_days
+        self.sync_interval = sync_interval
+        self.prefix = prefix
+        self.requests = {'Query': 0, 'BatchGetItem': 0, 'Scan': 0}
+        self._indexes = {}
+        self._synced = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def _count(self, operation):
+        with self._lock:
+            self.requests[operation] += 1
+
+    def _map(self, function, tasks):
+        tasks = list(tasks)
+        if len(tasks) <= 1:
+            return [function(task) for task in tasks]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(tasks)))) as pool:
+            return list(pool.map(function, tasks))
+
+    def sync(self, force=False):
+        """Drop the cached items of the order dates a run rewrote since the last check.
+
+        Returns:
+            int: The number of cache entries dropped.
+        """
+        if self.s3 is None or self.bucket is None:
+            return 0
+        with self._sync_lock:
+            now = time.monotonic()
+            if not force and self._synced is not None and now - self._synced < self.sync_interval:
+                return 0
+            self._synced = now
+            return sum(self._sync_table(table) for table in self.tables)
+
+    def _sync_table(self, table):
+        """Re-read the partition index of one table and drop the cached items of its rewritten dates."""
+        known = self._indexes.get(table, {'etag': None, 'runs': {}})
+        kwargs = {'IfNoneMatch': known['etag']} if known['etag'] else {}
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=index_key(table, self.prefix), **kwargs)
+        except self.s3.exceptions.NoSuchKey:
+            return 0
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('304', 'NotModified'):
+                return 0
+            raise
+        partitions = json.loads(response['Body'].read())['partitions']
+        runs = {day: partition['run_id'] for day, partition in partitions.items()}
+        self._indexes[table] = {'etag': response['ETag'], 'runs': runs}
+        rewritten = {day for day, run_id in runs.items() if known['runs'].get(day) != run_id}
+        if not rewritten:
+            return 0
+        return self.cache.invalidate(lambda key: key[0] == table and key[-1] in rewritten)
+
+    def category_kpis(self, start, end, categories=None):
+        """Return the category KPIs between two order dates, inclusive.
+
+        Args:
+            start: The first order date (a date or an ISO 8601 string).
+            end: The last order date, likewise.
+            categories (list): The categories to read. Defaults to every category, see ``categories``.
+
+        Returns:
+            pandas.DataFrame: The KPIs, sorted by category and order date.
+        """
+        self.sync()
+        days = _dates(start, end)
+        categories = self.categories() if categories is None else list(categories)
+        keys = [('category_kpi', category, day) for category in categories for day in days]
+        found, missing = self.cache.get_many(keys)
+
+        # Fetch each category's missing dates as segments of consecutive dates
+        segments = []
+        for category in categories:
+            missing_days = [key[2] for key in missing if key[1] == category]
+            for first in range(0, len(missing_days), self.segment_days):
+                chunk = missing_days[first:first + self.segment_days]
+                segments.append((category, chunk[0], chunk[-1]))
+        for fetched in self._map(self._query_segment, segments):
+            found.update(fetched)
+            self.cache.put_many(fetched)
+
+        items = [found[key] for key in keys if found[key] is not ABSENT]
+        return _frame(items, 'category_kpi')
+
+    def _query_segment(self, segment):
+        """Query one category between two dates, and mark the dates without an item as absent."""
+        category, first, last = segment
+        fetched = {('category_kpi', category, day): ABSENT for day in _dates(first, last)}
+        kwargs = {
+            'TableName': self.tables['category_kpi'],
+            'KeyConditionExpression': '#category = :category AND #order_date BETWEEN :first AND :last',
+            'ProjectionExpression': ', '.join(f"#{name}" for name in ATTRIBUTES['category_kpi']),
+            'ExpressionAttributeNames': {f"#{name}": name for name in ATTRIBUTES['category_kpi']},
+            'ExpressionAttributeValues': {':category': category, ':first': first, ':last': last},
+        }
+        while True:
+            response = self.client.query(**kwargs)
+            self._count('Query')
+            for item in response['Items']:
+                fetched[('category_kpi', category, item['order_date'])] = item
+            if 'LastEvaluatedKey' not in response:
+                return fetched
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def order_kpis(self, start, end):
+        """Return the order KPIs between two order dates, inclusive, sorted by order date."""
+        self.sync()
+        keys = [('order_kpi', day) for day in _dates(start, end)]
+        found, missing = self.cache.get_many(keys)
+
+        batches = [missing[first:first + BATCH_GET_SIZE] for first in range(0, len(missing), BATCH_GET_SIZE)]
+        for fetched in self._map(self._batch_get, batches):
+            found.update(fetched)
+            self.cache.put_many(fetched)
+
+        items = [found[key] for key in keys if found[key] is not ABSENT]
+        return _frame(items, 'order_kpi')
+
+    def _batch_get(self, keys, max_retries=8, base_delay=0.05):
+        """Get up to 100 OrderKPI items, retrying the unprocessed keys, and mark the missing dates as absent."""
+        table = self.tables['order_kpi']
+        fetched = {key: ABSENT for key in keys}
+        pending = {table: {
+            'Keys': [{'order_date': key[1]} for key in keys],
+            'ProjectionExpression': ', '.join(f"#{name}" for name in ATTRIBUTES['order_kpi']),
+            'ExpressionAttributeNames': {f"#{name}": name for name in ATTRIBUTES['order_kpi']},
+        }}
+        for attempt in range(max_retries + 1):
+            started = time.monotonic()
+            response = self.client.batch_get_item(RequestItems=pending)
+            self._count('BatchGetItem')
+            for item in response['Responses'].get(table, []):
+                fetched[('order_kpi', item['order_date'])] = item
+            pending = response.get('UnprocessedKeys') or {}
+            if not pending:
+                return fetched
+            record_throttle('dynamodb', started)
+            if attempt < max_retries:
+                # Full jitter exponential backoff, capped at a few seconds
+                time.sleep(random.uniform(0, min(5.0, base_delay * 2 ** attempt)))
+        raise RuntimeError(f"Failed to read {len(keys)} keys from {table} after {max_retries} retries")
+
+    def categories(self, segments=4):
+        """List the categories in the CategoryKPI table.
+
+        The list is discovered with a parallel scan of the key attribute alone,
+        in ``segments`` segments, and cached like the items. Pass ``categories``
+        to ``category_kpis`` to avoid the scan. A category that a run adds
+        appears once the cached list expires.
+        """
+        found, _ = self.cache.get_many([('categories',)])
+        if found:
+            return found[('categories',)]
+
+        def scan(segment):
+            names = set()
+            kwargs = {
+                'TableName': self.tables['category_kpi'],
+                'ProjectionExpression': '#category',
+                'ExpressionAttributeNames': {'#category': 'category'},
+                'Segment': segment,
+                'TotalSegments': segments,
+            }
+            while True:
+                response = self.client.scan(**kwargs)
+                self._count('Scan')
+                names.update(item['category'] for item in response['Items'])
+                if 'LastEvaluatedKey' not in response:
+                    return names
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        categories = sorted(set().union(*self._map(scan, range(segments))))
+        self.cache.put_many({('categories',): categories})
+        return categories
+
+    def dashboard(self, start, end, categories=None):
+        """Load the order KPIs and the category KPIs of a date range at once."""
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            orders = pool.submit(self.order_kpis, start, end)
+            by_category = pool.submit(self.category_kpis, start, end, categories)
+            return orders.result(), by_category.result()
@@ -0,0 +1,57 @@
+"""## Deferred imports for the task modules
+
+pandas, numpy and pyarrow take a large share of a task's start-up time. The
+modules that use them bind them with ``lazy_import`` instead of ``import``, so
+importing a task module does not import them; they are imported the first
+time one of their attributes is used, through the regular (thread-safe)
+import system.
+
+``preload`` imports them on a background thread, so the import overlaps with
+the first S3 requests of a run instead of delaying them.
+"""
+
+import importlib
+import threading
+import types
+
+
+class LazyModule(types.ModuleType):
+    """A stand-in for a module that imports it on first attribute access."""
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self.__name__), attr)
+
+    def __dir__(self):
+        return dir(importlib.import_module(self.__name__))
+
+
+def lazy_import(name):
+    """Return a stand-in for the module ``name`` that imports it when first used.
+
+    Args:
+        name (str): The module to import, e.g. ``pandas``.
+
+    Returns:
+        LazyModule: The stand-in. Its attributes are those of the real module.
+    """
+    return LazyModule(name)
+
+
+def preload(*names):
+    """Import modules on a daemon thread, ahead of their first use.
+
+    Import errors are left for the first real use to raise.
+
+    Returns:
+        threading.Thread: The started thread.
+    """
+    def load():
+        for name in names:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass
+
+    thread = threading.Thread(target=load, name='preload', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,311 @@
+"""## Per-stage metrics and opt-in profiling
+
+A run is split into named stages. When a stage ends, one JSON line is printed
+with its duration, rows in and out, S3 bytes read and written, AWS API calls
+per operation (count, errors, total and slowest latency), event counters such
+as cache hits, and the process's peak memory. Every line is printed as soon as its stage ends, so a run that
+hits the Step Function timeout still logs the stages it finished. The summary
+line of the run adds the calls, throttles, retries and concurrency limit of
+each AWS service, see ``common.aws_io``.
+
+    with RunMetrics('validation'):
+        with stage('read') as s:
+            df = ...
+            s.rows_out = len(df)
+
+Clients passed to ``instrument`` record their calls in the current stage of
+the active run. Outside a run, ``stage`` is a no-op, so the task functions can
+also be called from other code.
+
+Profiling is off by default. ``PROFILE=cpu`` runs the whole run under cProfile
+and ``PROFILE=memory`` traces allocations with tracemalloc (``PROFILE=cpu,memory``
+does both). Profiles are written to ``PROFILE_DIR`` when the run ends, either a
+local directory or an ``s3://bucket/prefix/`` location.
+"""
+
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+METRICS_ENABLED = os.environ.get('METRICS', 'true').lower() in ('1', 'true', 'yes')
+PROFILE = {mode.strip() for mode in os.environ.get('PROFILE', '').lower().split(',') if mode.strip()}
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'profiles'))
+
+MIB = 1024 * 1024
+
+# Operations whose request body or response length count as S3 bytes moved
+READ_OPERATIONS = {'GetObject'}
+WRITE_OPERATIONS = {'PutObject', 'UploadPart'}
+
+# Number of allocation sites kept in the tracemalloc report
+TOP_ALLOCATIONS = 50
+
+_active = []
+
+
+def _peak_rss_mib():
+    """Return the process's peak resident set size so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    return round(peak / (MIB if sys.platform == 'darwin' else 1024), 1)
+
+
+def _body_length(body):
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    try:
+        position = body.tell()
+        length = body.seek(0, os.SEEK_END) - position
+        body.seek(position)
+        return length
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+class Stage:
+    """The metrics of one stage. Set ``rows_in`` and ``rows_out`` from the stage body."""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows_in = None
+        self.rows_out = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.calls = {}
+        self.counters = {}
+        self.status = 'ok'
+        self.started = time.perf_counter()
+        self.duration = None
+        self._lock = threading.Lock()
+
+    def record_call(self, operation, elapsed, error=False, bytes_read=0, bytes_written=0):
+        """Add one AWS API call to the stage, from any thread."""
+        with self._lock:
+            call = self.calls.setdefault(operation, {'calls': 0, 'errors': 0, 'total_s': 0.0, 'max_s': 0.0})
+            call['calls'] += 1
+            call['errors'] += int(error)
+            call['total_s'] += elapsed
+            call['max_s'] = max(call['max_s'], elapsed)
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+    def count(self, name, n=1):
+        """Add ``n`` to the stage's counter ``name``, from any thread."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def finish(self, status='ok'):
+        self.duration = time.perf_counter() - self.started
+        self.status = status
+
+    def to_dict(self):
+        return {
+            'stage': self.name,
+            'status': self.status,
+            'duration_s': round(self.duration, 4),
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'aws_calls': {
+                operation: {**call, 'total_s': round(call['total_s'], 4), 'max_s': round(call['max_s'], 4)}
+                for operation, call in sorted(self.calls.items())
+            },
+            'counters': dict(sorted(self.counters.items())),
+        }
+
+
+class RunMetrics:
+    """Collects the stage metrics of one task run, and profiles it if ``PROFILE`` is set.
+
+    Args:
+        task (str): The task name included in every metrics line.
+        clients (list): boto3 clients whose calls are recorded; see ``instrument``.
+        profile (set): The profilers to run, ``cpu`` and/or ``memory``. Defaults to ``PROFILE``.
+        profile_dir (str): Where profiles are written. Defaults to ``PROFILE_DIR``.
+    """
+
+    def __init__(self, task, clients=(), profile=None, profile_dir=None):
+        self.task = task
+        self.run_id = datetime.utcnow().strftime('%Y-%m-%d-T-%H-%M-%S') + '-' + uuid.uuid4().hex[:8]
+        self.profile = PROFILE if profile is None else set(profile)
+        self.profile_dir = profile_dir or PROFILE_DIR
+        self.stages = []
+        self.current = None
+        self.started = None
+        self._profiler = None
+        self._services = None
+        for client in clients:
+            instrument(client)
+
+    def __enter__(self):
+        from common.aws_io import service_stats
+
+        self.started = time.perf_counter()
+        self._services = service_stats()
+        if 'memory' in self.profile and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if 'cpu' in self.profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        _active.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        from common.aws_io import service_stats
+
+        _active.remove(self)
+        if self._profiler is not None:
+            self._profiler.disable()
+        self.emit({
+            'event': 'run',
+            'status': 'ok' if exc_type is None else 'error',
+            'duration_s': round(time.perf_counter() - self.started, 4),
+            'stages': len(self.stages),
+            'aws_calls': sum(call['calls'] for stage in self.stages for call in stage.calls.values()),
+            'bytes_read': sum(stage.bytes_read for stage in self.stages),
+            'bytes_written': sum(stage.bytes_written for stage in self.stages),
+            'peak_rss_mib': _peak_rss_mib(),
+            'aws_services': service_stats(since=self._services),
+        })
+        self.dump_profiles()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a stage and print its metrics line when it ends."""
+        stage, parent = Stage(name), self.current
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self.current = stage
+        try:
+            yield stage
+        except BaseException:
+            stage.finish('error')
+            raise
+        else:
+            stage.finish()
+        finally:
+            self.current = parent
+            self.stages.append(stage)
+            record = {'event': 'stage', **stage.to_dict(), 'peak_rss_mib': _peak_rss_mib()}
+            if tracemalloc.is_tracing():
+                record['traced_peak_mib'] = round(tracemalloc.get_traced_memory()[1] / MIB, 1)
+            self.emit(record)
+
+    def emit(self, record):
+        if METRICS_ENABLED:
+            print(json.dumps({'metric': 'etl', 'task': self.task, 'run_id': self.run_id, **record}), flush=True)
+
+    def dump_profiles(self):
+        """Write the cProfile stats and the tracemalloc report, if profiling was on."""
+        outputs = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            if self._profiler is not None:
+                path = os.path.join(tmp, f"{self.task}-{self.run_id}.prof")
+                self._profiler.dump_stats(path)
+                outputs[path] = None
+            if 'memory' in self.profile and tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                path = os.path.join(tmp, f"{self.task}-{self.run_id}-memory.txt")
+                with open(path, 'w') as f:
+                    for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                        f.write(f"{stat}\n")
+                outputs[path] = None
+
+            for path in outputs:
+                outputs[path] = _store_profile(path, self.profile_dir)
+        if outputs:
+            self.emit({'event': 'profiles', 'paths': list(outputs.values())})
+
+
+def _store_profile(path, profile_dir):
+    """Copy a profile file to a local directory or an ``s3://`` location and return where it went."""
+    name = os.path.basename(path)
+    if profile_dir.startswith('s3://'):
+        from common.aws_io import client
+
+        bucket, _, prefix = profile_dir[len('s3://'):].partition('/')
+        key = f"{prefix.rstrip('/')}/{name}" if prefix else name
+        client('s3').upload_file(path, bucket, key)
+        return f"s3://{bucket}/{key}"
+
+    os.makedirs(profile_dir, exist_ok=True)
+    target = os.path.join(profile_dir, name)
+    with open(path, 'rb') as src, open(target, 'wb') as dst:
+        dst.write(src.read())
+    return target
+
+
+def current_stage():
+    """Return the current stage of the innermost active run, if any."""
+    return _active[-1].current if _active else None
+
+
+def count(name, n=1):
+    """Add ``n`` to the counter ``name`` of the current stage, if a run is active."""
+    current = current_stage()
+    if current is not None:
+        current.count(name, n)
+
+
+def stage(name):
+    """Time a stage of the innermost active run, or do nothing outside a run.
+
+    Yields:
+        Stage: The stage, whose ``rows_in`` and ``rows_out`` the caller may set.
+    """
+    if _active:
+        return _active[-1].stage(name)
+    return contextlib.nullcontext(Stage(name))
+
+
+def _before_call(model, params, context, **kwargs):
+    context['metrics_stage'] = current_stage()
+    context['metrics_started'] = time.perf_counter()
+    if model.name in WRITE_OPERATIONS:
+        context['metrics_bytes_written'] = _body_length(params.get('body', b''))
+
+
+def _after_call(model, context, parsed=None, exception=None, **kwargs):
+    stage = context.get('metrics_stage')
+    if stage is None:
+        return
+    bytes_read = 0
+    if model.name in READ_OPERATIONS and parsed:
+        bytes_read = parsed.get('ContentLength') or 0
+    stage.record_call(
+        f"{model.service_model.service_name}.{model.name}",
+        time.perf_counter() - context['metrics_started'],
+        error=exception is not None or bool(parsed and 'Error' in parsed),
+        bytes_read=bytes_read,
+        bytes_written=context.get('metrics_bytes_written', 0),
+    )
+
+
+def instrument(client):
+    """Record the API calls made through a boto3 client in the current stage.
+
+    The hooks are registered once per client, so long-lived clients, such as
+    the ones a warm Lambda reuses, can be passed to every run.
+
+    Returns:
+        The same client.
+    """
+    if not getattr(client, '_metrics_instrumented', False):
+        client.meta.events.register('before-call', _before_call)
+        client.meta.events.register('after-call', _after_call)
+        client.meta.events.register('after-call-error', _after_call)
+        client._metrics_instrumented = True
+    return client
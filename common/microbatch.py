@@ -0,0 +1,473 @@
+"""## Real-time micro-batches: per-file KPI updates with atomic counters
+
+Each uploaded orders or order_items part is validated on its own as soon as its
+S3 event arrives, and its contribution is added to the CategoryKPI and OrderKPI
+items with ``UpdateItem``, so the KPIs of its order dates are fresh within
+seconds instead of at the end of the batch.
+
+An order item only counts once its order is known, and the two parts can
+arrive in either order. Every part is therefore first saved under
+``microbatch/``: orders as an index of ``order_id``, ``order_date`` and
+``returned_at``, order items whole. It is then joined with every saved part of
+the other kind. Since both sides save before they read, at least one of them
+sees the other, and each (orders part, order items part) pair is applied by
+whichever does. Every update carries a marker of its pair and is conditional
+on the marker not being in the item yet, so a pair is applied exactly once,
+also when both sides see it or a Lambda is retried.
+
+The items keep the counters the KPIs are derived from:
+
+- ``revenue_cents``, ``items`` (OrderKPI only) and ``returned_items``, added with ``ADD``;
+- ``order_ids`` and ``customer_ids`` (OrderKPI only), number sets the pair's ids
+  are added to, since a distinct count cannot be summed;
+- ``mb_applied``, the markers of the applied pairs, and ``mb_version``, which
+  every update increments.
+
+The counter update returns the new item, the ratios are recomputed from it with
+``kpis_from_counts``, and they are written with a second update conditional on
+``mb_version`` being unchanged, so KPIs computed from older counters never
+overwrite newer ones. A DynamoDB item is limited to 400 KB, which bounds the
+id sets to a few tens of thousands of orders per day.
+
+Items a batch run has written whole, without counters, are left to the batch
+runs, which reconcile every order date of their drop anyway. For the same
+reason, the saved parts are deleted once the batch run has archived their raw
+part (see ``expire_saved``), so the saved parts stay those of the current drop.
+"""
+
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from io import BytesIO
+
+from botocore.exceptions import ClientError
+
+from common.handoff import ParquetFormat
+from common.incremental import compute_partials, kpis_from_counts
+from common.lazy import lazy_import
+from common.products_cache import LOOKUP_FILE, ProductsCache
+from common.rules import IdSet, validate
+from common.schemas import RAW_SCHEMAS
+
+pd = lazy_import('pandas')
+
+MICROBATCH_PREFIX = 'microbatch/'
+PRODUCTS_KEY = 'raw-data/products.csv'
+RAW_FOLDERS = {
+    'orders': 'raw-data/orders/',
+    'order_items': 'raw-data/order_items/',
+}
+OTHER_KIND = {'orders': 'order_items', 'order_items': 'orders'}
+
+# The columns of a saved orders index, as compute_partials reads them
+ORDERS_INDEX_COLUMNS = ['order_id', 'order_date', 'returned_at']
+
+# KPI attributes stored as integers, and those rounded to two decimals, as in the batch writer
+COUNTS = ('total_orders', 'total_items_sold', 'unique_customers')
+RATES = ('avg_return_rate', 'return_rate')
+
+
+class MicroBatchStats:
+    """Counters for the micro-batch of one uploaded part."""
+
+    def __init__(self, key):
+        self.key = key
+        self.rows = 0
+        self.pairs = 0
+        self.applied = 0
+        self.applied_before = 0
+        self.batch_owned = 0
+        self.kpis_written = 0
+        self.kpis_superseded = 0
+
+    def count(self, outcomes):
+        for outcome in outcomes:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def report(self):
+        """Print a one-line summary of the micro-batch."""
+        print(
+            f"{self.key}: {self.rows} valid rows joined in {self.pairs} pair(s), "
+            f"{self.applied} counter updates ({self.applied_before} applied before, "
+            f"{self.batch_owned} left to the batch run), {self.kpis_written} KPI items written "
+            f"({self.kpis_superseded} superseded)"
+        )
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+def saved_key(kind, key, prefix=MICROBATCH_PREFIX):
+    """Build the key a raw part is saved under, e.g. ``microbatch/orders/orders_part1.parquet``."""
+    name = key[len(RAW_FOLDERS[kind]):]
+    if name.endswith('.csv'):
+        name = name[:-len('.csv')]
+    return f"{prefix}{kind}/{name}.parquet"
+
+
+def expire_saved(s3, bucket, keys, prefix=MICROBATCH_PREFIX):
+    """Delete the saved parts of raw parts the batch run has processed.
+
+    Args:
+        s3: A boto3 S3 client.
+        bucket (str): The bucket the parts were saved in.
+        keys (list): The raw keys, e.g. as archived. Keys outside the orders and
+            order_items folders are ignored.
+        prefix (str): The S3 prefix the parts are saved under.
+
+    Returns:
+        int: The number of saved keys deleted, whether or not they still existed.
+    """
+    saved = [
+        saved_key(kind, key, prefix)
+        for key in keys
+        for kind, folder in RAW_FOLDERS.items()
+        if key.startswith(folder)
+    ]
+    # DeleteObjects accepts at most 1000 keys per call
+    for i in range(0, len(saved), 1000):
+        s3.delete_objects(
+            Bucket=bucket, Delete={'Objects': [{'Key': key} for key in saved[i:i + 1000]], 'Quiet': True},
+        )
+    return len(saved)
+
+
+def pair_marker(orders_key, order_items_key):
+    """Identify a pair of saved parts, compactly, in the ``mb_applied`` sets."""
+    return hashlib.sha1(f"{orders_key}\n{order_items_key}".encode('utf-8')).hexdigest()[:16]
+
+
+def validate_part(kind, df, products=None):
+    """Check a single part against the rules the Validation Task applies (see ``common.rules``).
+
+    The order items' references to orders are checked by the join with the saved
+    orders instead. Rejected rows are left to the batch run to quarantine.
+    """
+    if kind == 'orders':
+        valid = validate(df, 'orders').valid
+        valid = valid.assign(order_date=pd.to_datetime(valid['created_at']).dt.date)
+        return valid[ORDERS_INDEX_COLUMNS].reset_index(drop=True)
+    valid = validate(df, 'order_items', {'products': IdSet(products['id'])}).valid
+    return valid.reset_index(drop=True)
+
+
+def _read_csv(s3, bucket, key, name):
+    body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    return RAW_SCHEMAS[name].read(BytesIO(body), stage='validation')
+
+
+def _load_saved(s3, bucket, kind, prefix, fmt, max_workers):
+    """Load every saved part of a kind, as a dict of saved key to DataFrame."""
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}{kind}/"):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+
+    def load(key):
+        try:
+            return key, fmt.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read(), kind)
+        except s3.exceptions.NoSuchKey:
+            # Deleted since the listing, once all of its items were applied
+            return key, None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(keys) or 1))) as pool:
+        return {key: df for key, df in pool.map(load, keys) if df is not None}
+
+
+def _id_sets(df, keys, column):
+    return df.groupby(keys)[column].agg(lambda ids: {int(i) for i in ids})
+
+
+def pair_updates(partials, marker):
+    """Turn the partial aggregates of one pair into counter additions per KPI item.
+
+    Returns:
+        tuple: Two dicts, for CategoryKPI and OrderKPI, mapping each item key
+        (a tuple of its key attributes) to ``(marker, additions)``.
+    """
+    cat = partials['cat_sums'].set_index(['category', 'order_date'])
+    cat_orders = _id_sets(partials['cat_orders'], ['category', 'order_date'], 'order_id')
+    day = partials['day_sums'].set_index('order_date')
+    day_orders = _id_sets(partials['day_orders'], 'order_date', 'order_id')
+    day_customers = _id_sets(partials['day_customers'].dropna(), 'order_date', 'user_id')
+
+    cat_updates = {
+        (category, order_date.isoformat()): (marker, {
+            'revenue_cents': int(row.revenue_cents),
+            'returned_items': int(row.returned_items),
+            'order_ids': cat_orders[(category, order_date)],
+        })
+        for (category, order_date), row in zip(cat.index, cat.itertuples(index=False))
+    }
+    day_updates = {}
+    for order_date, row in zip(day.index, day.itertuples(index=False)):
+        additions = {
+            'revenue_cents': int(row.revenue_cents),
+            'items': int(row.items),
+            'returned_items': int(row.returned_items),
+            'order_ids': day_orders[order_date],
+        }
+        if order_date in day_customers.index:
+            additions['customer_ids'] = day_customers[order_date]
+        day_updates[(order_date.isoformat(),)] = (marker, additions)
+    return cat_updates, day_updates
+
+
+def _combine(contributions):
+    """Sum the additions of several pairs to one item into a single update."""
+    markers, combined = [], {}
+    for marker, additions in contributions:
+        markers.append(marker)
+        for name, value in additions.items():
+            if name not in combined:
+                combined[name] = value
+            elif isinstance(value, set):
+                combined[name] = combined[name] | value
+            else:
+                combined[name] += value
+    return markers, combined
+
+
+class KpiTable:
+    """The counter and KPI updates of one KPI table.
+
+    Args:
+        client: The client of a boto3 DynamoDB resource (``ddb.meta.client``).
+        name (str): The table name.
+        key_names (tuple): The key attributes, in the order of the item key tuples.
+        guard (str): A KPI attribute every batch-written item has.
+    """
+
+    def __init__(self, client, name, key_names, guard):
+        self.client = client
+        self.name = name
+        self.key_names = key_names
+        self.guard = guard
+
+    def _key(self, key):
+        return dict(zip(self.key_names, key))
+
+    def add_counters(self, key, markers, additions):
+        """Add the counters of one or more pairs to an item.
+
+        Returns:
+            tuple: The outcome, and the item after the update (None if it is left to
+            the batch run). The outcome is ``applied``, ``applied_before``,
+            ``batch_owned``, or ``conflict`` when some but not all of several pairs
+            were applied before.
+        """
+        attributes = dict(additions, mb_applied=set(markers), mb_version=1)
+        names = {f"#a{i}": name for i, name in enumerate(attributes)}
+        values = {f":a{i}": value for i, value in enumerate(attributes.values())}
+        values.update({f":m{i}": marker for i, marker in enumerate(markers)})
+        conditions = [f"NOT contains(mb_applied, :m{i})" for i in range(len(markers))]
+        conditions.append(f"(attribute_exists(mb_version) OR attribute_not_exists({self.guard}))")
+        try:
+            response = self.client.update_item(
+                TableName=self.name,
+                Key=self._key(key),
+                UpdateExpression='ADD ' + ', '.join(f"{name} {value}" for name, value in zip(names, values)),
+                ConditionExpression=' AND '.join(conditions),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                ReturnValues='ALL_NEW',
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+        else:
+            return 'applied', response['Attributes']
+
+        item = self.client.get_item(TableName=self.name, Key=self._key(key), ConsistentRead=True).get('Item', {})
+        if 'mb_version' not in item:
+            return 'batch_owned', None
+        if len(markers) > 1:
+            return 'conflict', item
+        # Applied before, e.g. by a retry; the KPIs are still refreshed from it
+        return 'applied_before', item
+
+    def write_kpis(self, key, version, kpis):
+        """Set the KPI attributes of an item, unless its counters changed since ``version``.
+
+        Returns:
+            bool: True if written, False if a later update has written KPIs from newer counters.
+        """
+        names = {f"#k{i}": name for i, name in enumerate(kpis)}
+        values = {f":k{i}": value for i, value in enumerate(kpis.values())}
+        values[':version'] = version
+        try:
+            self.client.update_item(
+                TableName=self.name,
+                Key=self._key(key),
+                UpdateExpression='SET ' + ', '.join(f"{name} = {value}" for name, value in zip(names, values)),
+                ConditionExpression='mb_version = :version',
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return False
+        return True
+
+
+def _apply(table, updates, stats, max_workers):
+    """Apply the pair contributions to each item of a table.
+
+    Returns:
+        dict: The newest state of each updated item, by key.
+    """
+    def apply(entry):
+        key, contributions = entry
+        outcome, item = table.add_counters(key, *_combine(contributions))
+        if outcome != 'conflict':
+            return key, item, [outcome]
+        # Some of the pairs were applied before: apply the others one by one
+        outcomes = []
+        for marker, additions in contributions:
+            outcome, item = table.add_counters(key, [marker], additions)
+            outcomes.append(outcome)
+        return key, item, outcomes
+
+    items = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        for key, item, outcomes in pool.map(apply, updates.items()):
+            stats.count(outcomes)
+            if item is not None:
+                items[key] = item
+    return items
+
+
+def _kpi_attributes(row, columns):
+    attributes = {}
+    for column in columns:
+        if column in COUNTS:
+            attributes[column] = int(row[column])
+        elif column in RATES:
+            attributes[column] = Decimal(str(round(float(row[column]), 2)))
+        else:
+            attributes[column] = Decimal(str(float(row[column])))
+    return attributes
+
+
+def _recompute(cat_items, day_items):
+    """Recompute the KPIs of the updated items from their stored counters."""
+    cat_counts = pd.DataFrame(
+        [
+            {
+                'category': category, 'order_date': order_date,
+                'revenue_cents': int(item['revenue_cents']),
+                'returned_items': int(item['returned_items']),
+                'order_count': len(item['order_ids']),
+            }
+            for (category, order_date), item in cat_items.items()
+        ],
+        columns=['category', 'order_date', 'revenue_cents', 'returned_items', 'order_count'],
+    )
+    day_counts = pd.DataFrame(
+        [
+            {
+                'order_date': order_date,
+                'revenue_cents': int(item['revenue_cents']),
+                'items': int(item['items']),
+                'returned_items': int(item['returned_items']),
+                'total_orders': len(item['order_ids']),
+                'unique_customers': len(item.get('customer_ids', ())),
+            }
+            for (order_date,), item in day_items.items()
+        ],
+        columns=['order_date', 'revenue_cents', 'items', 'returned_items', 'total_orders', 'unique_customers'],
+    )
+    return kpis_from_counts(cat_counts, day_counts)
+
+
+def apply_part(s3, client, bucket, kind, key, category_table, order_table, prefix=MICROBATCH_PREFIX,
+               products_key=PRODUCTS_KEY, max_workers=8, products_cache=None):
+    """Validate one uploaded part and apply its contributions to the KPI tables.
+
+    Args:
+        s3: A boto3 S3 client.
+        client: The client of a boto3 DynamoDB resource (``ddb.meta.client``), which
+            serializes plain Python values.
+        bucket (str): The bucket the part was uploaded to.
+        kind (str): ``orders`` or ``order_items``.
+        key (str): The key of the uploaded part.
+        category_table (str): The CategoryKPI table name.
+        order_table (str): The OrderKPI table name.
+        prefix (str): The S3 prefix the parts are saved under.
+        products_key (str): The key of the products file, for the categories.
+        max_workers (int): The number of S3 reads and DynamoDB updates in flight at once.
+        products_cache (ProductsCache): The cache the products' id -> category lookup is
+            loaded from. Defaults to a new ``ProductsCache`` with the default settings.
+
+    Returns:
+        MicroBatchStats: The counters of the micro-batch.
+    """
+    fmt = ParquetFormat()
+    stats = MicroBatchStats(key)
+    products_cache = products_cache or ProductsCache(s3, bucket)
+
+    def load_products():
+        return products_cache.load(products_key, parts=(LOOKUP_FILE,)).lookup
+
+    products = load_products() if kind == 'order_items' else None
+    part = validate_part(kind, _read_csv(s3, bucket, key, kind), products)
+    stats.rows = len(part)
+    own_key = saved_key(kind, key, prefix)
+    s3.put_object(Bucket=bucket, Key=own_key, Body=fmt.dumps(part, kind))
+
+    # Join with the saved parts of the other kind that share order ids with this one
+    others = _load_saved(s3, bucket, OTHER_KIND[kind], prefix, fmt, max_workers)
+    pairs = []
+    for other_key, other in others.items():
+        matched = other[other['order_id'].isin(part['order_id'])]
+        if len(matched):
+            orders, order_items = (part, matched) if kind == 'orders' else (matched, part)
+            orders = orders[orders['order_id'].isin(order_items['order_id'])]
+            keys = (own_key, other_key) if kind == 'orders' else (other_key, own_key)
+            pairs.append((pair_marker(*keys), orders, order_items))
+    stats.pairs = len(pairs)
+
+    cat_updates, day_updates = {}, {}
+    if pairs:
+        if products is None:
+            products = load_products()
+        for marker, orders, order_items in pairs:
+            cat, day = pair_updates(compute_partials(products, orders, order_items), marker)
+            for item_key, contribution in cat.items():
+                cat_updates.setdefault(item_key, []).append(contribution)
+            for item_key, contribution in day.items():
+                day_updates.setdefault(item_key, []).append(contribution)
+
+    tables = (
+        KpiTable(client, category_table, ('category', 'order_date'), 'daily_revenue'),
+        KpiTable(client, order_table, ('order_date',), 'total_orders'),
+    )
+    cat_items = _apply(tables[0], cat_updates, stats, max_workers)
+    day_items = _apply(tables[1], day_updates, stats, max_workers)
+
+    cat_kpi, order_kpi = _recompute(cat_items, day_items)
+    writes = [
+        (tables[0], (row['category'], row['order_date']), cat_items, row, cat_kpi.columns[2:])
+        for row in cat_kpi.to_dict('records')
+    ] + [
+        (tables[1], (row['order_date'],), day_items, row, order_kpi.columns[1:])
+        for row in order_kpi.to_dict('records')
+    ]
+
+    def write(args):
+        table, item_key, items, row, columns = args
+        return table.write_kpis(item_key, items[item_key]['mb_version'], _kpi_attributes(row, columns))
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        written = list(pool.map(write, writes))
+    stats.kpis_written = sum(written)
+    stats.kpis_superseded = len(written) - stats.kpis_written
+
+    if kind == 'order_items':
+        found = [orders['order_id'] for _, orders, _ in pairs]
+        if not len(part) or found and part['order_id'].isin(pd.concat(found)).all():
+            # Every item found its order, so later orders parts have nothing to join it with
+            s3.delete_object(Bucket=bucket, Key=own_key)
+
+    return stats
@@ -0,0 +1,155 @@
+"""## Date-partitioned KPI output under processed/
+
+Each KPI table is stored as one compressed Parquet file per order date:
+
+    processed/<table>/order_date=YYYY-MM-DD/part-0.parquet
+
+The ``order_date`` column is carried by the path, Hive-style, so query engines
+such as Athena can prune partitions by date. A run upserts its KPIs into the
+partitions it touches by the table's key, like the PutItem writes to
+DynamoDB: rows with other keys in the same partition are kept. Partitions are
+written concurrently.
+
+``processed/<table>/_index.json`` lists every partition of a table with its
+key, row count, size and the run that last wrote it, so readers find the
+partitions of a date range with one GET instead of a listing. Every run also
+writes ``processed/_runs/<run_id>.json`` with the partitions it wrote. The
+index is read, updated and rewritten by the run, so only one run may write a
+table at a time, which the trigger guarantees.
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from common.handoff import ParquetFormat
+from common.lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+PROCESSED_PREFIX = 'processed/'
+PARTITION_COLUMN = 'order_date'
+INDEX_NAME = '_index.json'
+RUNS_PREFIX = '_runs/'
+
+# The columns that identify a row within an order date partition
+TABLE_KEYS = {
+    'category_kpi': ['category'],
+    'order_kpi': [],
+    'rolling_category_kpi': ['category'],
+}
+
+
+def partition_key(table, day, prefix=PROCESSED_PREFIX):
+    """Build the S3 key of the file holding one order date of a table."""
+    return f"{prefix}{table}/{PARTITION_COLUMN}={day}/part-0.parquet"
+
+
+def index_key(table, prefix=PROCESSED_PREFIX):
+    return f"{prefix}{table}/{INDEX_NAME}"
+
+
+def load_index(s3, bucket, table, prefix=PROCESSED_PREFIX):
+    """Load the partition index of a table, or an empty one if nothing was written yet."""
+    try:
+        response = s3.get_object(Bucket=bucket, Key=index_key(table, prefix))
+    except s3.exceptions.NoSuchKey:
+        return {'table': table, 'partitions': {}}
+    return json.loads(response['Body'].read())
+
+
+def _upsert(existing, part, keys):
+    """Replace the rows of ``existing`` that share a key with ``part``, and add the new ones."""
+    if not keys:
+        return part
+    replaced = pd.MultiIndex.from_frame(existing[keys]).isin(pd.MultiIndex.from_frame(part[keys]))
+    merged = pd.concat([existing[~replaced], part], ignore_index=True)
+    return merged.sort_values(keys, ignore_index=True)
+
+
+def write_partitions(s3, bucket, tables, run_id, prefix=PROCESSED_PREFIX, max_workers=16, fmt=None):
+    """Upsert KPI tables into their order date partitions and record the run.
+
+    Args:
+        s3: A boto3 S3 client.
+        bucket (str): The bucket to write to.
+        tables (dict): The KPI DataFrames by table name, each with an ``order_date`` column.
+        run_id (str): Identifies the run in the indexes and names its manifest.
+        prefix (str): The S3 prefix to write under.
+        max_workers (int): The number of partitions written at once.
+        fmt: The Parquet format to write with. Defaults to ``ParquetFormat()``.
+
+    Returns:
+        str: The S3 key of the run manifest.
+    """
+    fmt = fmt or ParquetFormat()
+    manifest = {'run_id': run_id, 'tables': {}}
+
+    for table, df in tables.items():
+        index = load_index(s3, bucket, table, prefix)
+        keys = TABLE_KEYS[table]
+        days = pd.to_datetime(df[PARTITION_COLUMN]).dt.strftime('%Y-%m-%d').to_numpy()
+        parts = df.drop(columns=PARTITION_COLUMN).groupby(days, sort=True)
+
+        def write(item):
+            day, part = item
+            key = partition_key(table, day, prefix)
+            part = part.reset_index(drop=True)
+            if day in index['partitions']:
+                response = s3.get_object(Bucket=bucket, Key=key)
+                part = _upsert(fmt.loads(response['Body'].read(), table), part, keys)
+            body = fmt.dumps(part, table)
+            s3.put_object(Bucket=bucket, Key=key, Body=body)
+            return day, {'key': key, 'rows': len(part), 'bytes': len(body), 'run_id': run_id}
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            written = dict(pool.map(write, parts))
+
+        index['partitions'].update(written)
+        index['partitions'] = dict(sorted(index['partitions'].items()))
+        index['updated_by'] = run_id
+        s3.put_object(Bucket=bucket, Key=index_key(table, prefix), Body=json.dumps(index).encode('utf-8'))
+        manifest['tables'][table] = {
+            'min_date': min(written, default=None),
+            'max_date': max(written, default=None),
+            'partitions': written,
+        }
+
+    manifest_key = f"{prefix}{RUNS_PREFIX}{run_id}.json"
+    s3.put_object(Bucket=bucket, Key=manifest_key, Body=json.dumps(manifest).encode('utf-8'))
+    return manifest_key
+
+
+def read_partitions(s3, bucket, table, start=None, end=None, prefix=PROCESSED_PREFIX, max_workers=16, fmt=None):
+    """Load the partitions of a table between two order dates, inclusive.
+
+    Only the index and the matching partition files are read.
+
+    Args:
+        s3: A boto3 S3 client.
+        bucket (str): The bucket to read from.
+        table (str): The table name, e.g. ``order_kpi``.
+        start: The first order date (a date or an ISO 8601 string). Defaults to the first partition.
+        end: The last order date, likewise. Defaults to the last partition.
+        prefix (str): The S3 prefix the table was written under.
+        max_workers (int): The number of partitions read at once.
+        fmt: The Parquet format to read with. Defaults to ``ParquetFormat()``.
+
+    Returns:
+        pandas.DataFrame: The rows of the partitions, with ``order_date`` restored as dates.
+    """
+    fmt = fmt or ParquetFormat()
+    index = load_index(s3, bucket, table, prefix)
+    days = [
+        day for day in index['partitions']
+        if (start is None or day >= str(start)) and (end is None or day <= str(end))
+    ]
+
+    def read(day):
+        response = s3.get_object(Bucket=bucket, Key=index['partitions'][day]['key'])
+        part = fmt.loads(response['Body'].read(), table)
+        part.insert(len(TABLE_KEYS[table]), PARTITION_COLUMN, pd.Timestamp(day).date())
+        return part
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        parts = list(pool.map(read, days))
+    return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
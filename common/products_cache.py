@@ -0,0 +1,316 @@
+"""## Content-addressed cache of the validated products dimension
+
+products.csv rarely changes between drops, yet every run downloaded, parsed
+and validated it again. The cache keeps the result under the file's ETag,
+S3's hash of its content, and a version of the code that parses and
+validates it, so a change of either is a new entry:
+
+    cache/products/<etag>-<version>/products.parquet  every row, with the reasons rejected rows failed
+    cache/products/<etag>-<version>/lookup.parquet    one id -> category row per product, sorted by id
+
+An entry is looked up in a local disk tier (``PRODUCTS_CACHE_DIR``) first, then
+in S3 under ``PRODUCTS_CACHE_PREFIX``, and a hit in S3 is copied to the local
+tier. Only on a miss in both is products.csv downloaded, parsed and validated,
+and the entry written to both tiers. An unchanged file therefore costs a HEAD
+request, and no S3 request at all when its ETag is already known, e.g. from a
+listing.
+
+The local tier evicts the least recently used entries beyond
+``PRODUCTS_CACHE_MAX_MB`` or ``PRODUCTS_CACHE_ENTRIES``. The S3 tier keeps the
+``PRODUCTS_CACHE_ENTRIES`` most recently written entries. Hits, misses and
+evictions are counted in ``CacheStats`` and in the current metrics stage.
+``PRODUCTS_CACHE=false`` bypasses the cache.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from io import BytesIO
+
+from common.lazy import lazy_import
+from common.metrics import count
+from common.rules import REASONS_COLUMN, RULES, ValidationResult, validate
+from common.schemas import RAW_SCHEMAS
+
+pd = lazy_import('pandas')
+
+PRODUCTS_CACHE = os.environ.get('PRODUCTS_CACHE', 'true').lower() in ('1', 'true', 'yes')
+CACHE_PREFIX = os.environ.get('PRODUCTS_CACHE_PREFIX', 'cache/products/')
+CACHE_DIR = os.environ.get('PRODUCTS_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'products-cache'))
+CACHE_MAX_MB = float(os.environ.get('PRODUCTS_CACHE_MAX_MB', '256'))
+CACHE_ENTRIES = int(os.environ.get('PRODUCTS_CACHE_ENTRIES', '4'))
+
+# Bumped when the layout of an entry changes
+CACHE_FORMAT = 1
+
+PRODUCTS_FILE = 'products.parquet'
+LOOKUP_FILE = 'lookup.parquet'
+PARTS = (PRODUCTS_FILE, LOOKUP_FILE)
+
+MIB = 1024 * 1024
+
+
+def cache_version():
+    """Return a short digest of the entry layout, the parsed columns and dtypes, and the products rules."""
+    schema = RAW_SCHEMAS['products']
+    spec = {
+        'format': CACHE_FORMAT,
+        'columns': {column: schema.dtypes[column] for column in schema.usecols('validation')},
+        'rules': [[rule.code, list(rule.columns)] for rule in RULES['products']],
+    }
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+
+
+def entry_name(etag):
+    """Name the cache entry of the products file with the given ETag."""
+    return f"{etag.strip(chr(34))}-{cache_version()}"
+
+
+def category_lookup(products):
+    """Reduce validated products to one ``id``, ``category`` row per product id, sorted by id.
+
+    The last row wins for duplicated ids, as in a dict built from the rows.
+    """
+    lookup = products[['id', 'category']].drop_duplicates('id', keep='last')
+    return lookup.sort_values('id', ignore_index=True)
+
+
+def _dumps(df):
+    """Serialize a frame to Parquet with its pandas metadata, so it loads with the same dtypes."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    buffer = BytesIO()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), buffer, compression='zstd')
+    return buffer.getvalue()
+
+
+def _loads(body):
+    import pyarrow.parquet as pq
+
+    return pq.read_table(BytesIO(body)).to_pandas()
+
+
+class CacheStats:
+    """Counts the cache's hits per tier, misses and evictions, from any thread."""
+
+    EVENTS = ('local_hits', 's3_hits', 'misses', 'local_evictions', 's3_evictions')
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.EVENTS, 0)
+        self._lock = threading.Lock()
+
+    def record(self, event, n=1):
+        with self._lock:
+            self.counts[event] += n
+        count(f"products_cache.{event}", n)
+
+    @property
+    def hit_rate(self):
+        lookups = self.counts['local_hits'] + self.counts['s3_hits'] + self.counts['misses']
+        return (self.counts['local_hits'] + self.counts['s3_hits']) / lookups if lookups else 0.0
+
+    def to_dict(self):
+        return {**self.counts, 'hit_rate': round(self.hit_rate, 4)}
+
+
+class ProductsEntry:
+    """The cached products of one products file.
+
+    Attributes:
+        name (str): The entry name, see ``entry_name``.
+        source (str): Where the entry came from: ``local``, ``s3`` or ``source`` on a miss.
+        products (pandas.DataFrame): Every row with a ``reasons`` column, empty for
+            the valid rows. None if it was not requested.
+        lookup (pandas.DataFrame): The id -> category lookup, see ``category_lookup``.
+    """
+
+    def __init__(self, name, source, products, lookup):
+        self.name = name
+        self.source = source
+        self.products = products
+        self.lookup = lookup
+
+    @property
+    def result(self):
+        """The products' ``ValidationResult``, as if the file had just been validated."""
+        rejected = self.products[REASONS_COLUMN] != ''
+        valid = self.products[~rejected].drop(columns=REASONS_COLUMN).reset_index(drop=True)
+        return ValidationResult.from_frames(valid, self.products[rejected].reset_index(drop=True), 'products')
+
+
+class ProductsCache:
+    """The two-tier cache of validated products, see the module docstring.
+
+    Args:
+        s3: A boto3 S3 client.
+        bucket (str): The bucket holding products.csv and the S3 tier.
+        prefix (str): The S3 prefix of the S3 tier.
+        directory (str): The directory of the local tier, or None for no local tier.
+        max_mb (float): The size the local tier is kept under.
+        max_entries (int): The number of entries each tier keeps.
+    """
+
+    def __init__(self, s3, bucket, prefix=CACHE_PREFIX, directory=CACHE_DIR, max_mb=CACHE_MAX_MB,
+                 max_entries=CACHE_ENTRIES):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.directory = directory
+        self.max_bytes = max_mb * MIB
+        self.max_entries = max_entries
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+
+    def load(self, key, etag=None, parts=PARTS):
+        """Return the validated products of the file at ``key``, from the cache if possible.
+
+        Args:
+            key (str): The key of products.csv.
+            etag (str): The file's current ETag, if known, e.g. from a listing. Looked up with HEAD otherwise.
+            parts (tuple): The files of the entry to load, ``PRODUCTS_FILE`` and/or ``LOOKUP_FILE``.
+
+        Returns:
+            ProductsEntry: The entry. Parts that were not requested are None, unless it was a miss.
+        """
+        if not PRODUCTS_CACHE:
+            return self._build(key)
+        if etag is None:
+            etag = self.s3.head_object(Bucket=self.bucket, Key=key)['ETag']
+        name = entry_name(etag)
+
+        frames = self._read_local(name, parts)
+        if frames is not None:
+            self.stats.record('local_hits')
+            return ProductsEntry(name, 'local', *frames)
+        frames = self._read_s3(name, parts)
+        if frames is not None:
+            self.stats.record('s3_hits')
+            return ProductsEntry(name, 's3', *frames)
+
+        self.stats.record('misses')
+        entry = self._build(key)
+        bodies = {PRODUCTS_FILE: _dumps(entry.products), LOOKUP_FILE: _dumps(entry.lookup)}
+        for part, body in bodies.items():
+            self.s3.put_object(Bucket=self.bucket, Key=f"{self.prefix}{entry.name}/{part}", Body=body)
+        self._write_local(entry.name, bodies)
+        self._evict_s3(keep=entry.name)
+        return entry
+
+    def _build(self, key):
+        """Download, parse and validate the products file."""
+        response = self.s3.get_object(Bucket=self.bucket, Key=key)
+        df = RAW_SCHEMAS['products'].read(BytesIO(response['Body'].read()), stage='validation')
+        result = validate(df, 'products')
+        products = pd.concat([result.valid.assign(**{REASONS_COLUMN: ''}), result.rejected], ignore_index=True)
+        # The entry is named after the ETag of the bytes that were parsed, even if the file changed since a HEAD
+        return ProductsEntry(entry_name(response['ETag']), 'source', products, category_lookup(result.valid))
+
+    def _frames(self, read, parts):
+        """Load the requested parts with ``read(part)``, or return None if any is missing."""
+        bodies = {}
+        for part in parts:
+            body = read(part)
+            if body is None:
+                return None
+            bodies[part] = body
+        return tuple(_loads(bodies[part]) if part in bodies else None for part in PARTS)
+
+    def _read_local(self, name, parts):
+        if self.directory is None:
+            return None
+        path = os.path.join(self.directory, name)
+
+        def read(part):
+            try:
+                with open(os.path.join(path, part), 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+
+        frames = self._frames(read, parts)
+        if frames is not None:
+            # Mark the entry as recently used
+            with self._lock:
+                if os.path.isdir(path):
+                    os.utime(path)
+        return frames
+
+    def _read_s3(self, name, parts):
+        bodies = {}
+
+        def read(part):
+            try:
+                response = self.s3.get_object(Bucket=self.bucket, Key=f"{self.prefix}{name}/{part}")
+            except self.s3.exceptions.NoSuchKey:
+                return None
+            bodies[part] = response['Body'].read()
+            return bodies[part]
+
+        frames = self._frames(read, parts)
+        if frames is not None:
+            self._write_local(name, bodies)
+        return frames
+
+    def _write_local(self, name, bodies):
+        """Add files to a local entry, each written to a temporary file first so readers never see part of one."""
+        if self.directory is None:
+            return
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            os.makedirs(path, exist_ok=True)
+            for part, body in bodies.items():
+                temporary = os.path.join(path, f".{part}.{uuid.uuid4().hex}")
+                with open(temporary, 'wb') as f:
+                    f.write(body)
+                os.replace(temporary, os.path.join(path, part))
+            os.utime(path)
+            self._evict_local(keep=name)
+
+    def _evict_local(self, keep):
+        """Remove the least recently used local entries until the tier is within its limits."""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path):
+                size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+                entries.append((os.stat(path).st_mtime, name, size))
+        entries.sort()
+        total, remaining = sum(size for _, _, size in entries), len(entries)
+        for _, name, size in entries:
+            if remaining <= self.max_entries and total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            total, remaining = total - size, remaining - 1
+            self.stats.record('local_evictions')
+
+    def _evict_s3(self, keep):
+        """Delete the S3 entries beyond the ``max_entries`` most recently written, keeping ``keep``."""
+        written = {}
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                name = obj['Key'][len(self.prefix):].split('/', 1)[0]
+                written.setdefault(name, []).append(obj)
+        # LastModified has a resolution of a second, so the entry just written may tie with older ones
+        by_age = sorted(
+            written, key=lambda name: (name == keep, max(obj['LastModified'] for obj in written[name])), reverse=True,
+        )
+        stale = [obj['Key'] for name in by_age[self.max_entries:] for obj in written[name]]
+        for start in range(0, len(stale), 1000):
+            self.s3.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': key} for key in stale[start:start + 1000]], 'Quiet': True},
+            )
+        if stale:
+            self.stats.record('s3_evictions', len(by_age) - self.max_entries)
+
+    def report(self):
+        """Print the hit and miss counts."""
+        print(f"Products cache: {json.dumps(self.stats.to_dict())}")
@@ -0,0 +1,281 @@
+"""## Declarative row validation rules for the raw datasets
+
+Each dataset declares its rules in ``RULES``: required columns, value ranges,
+allowed values, foreign keys into another dataset, and timestamp ordering.
+``validate`` evaluates every rule column-wise over the whole frame and records
+the rules each row fails as bits of one mask, then splits the frame once into
+the valid rows and the rejected rows. Each rejected row carries the reason
+codes of all the rules it failed, so the rejects can be quarantined and
+counted instead of silently dropped. The cost is one vectorized pass per rule,
+and the frame is copied once however many rules there are.
+"""
+
+import json
+
+from common.lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+REASONS_COLUMN = 'reasons'
+
+# Order and order item statuses through the order lifecycle
+STATUSES = ('processing', 'shipped', 'delivered', 'returned', 'cancelled')
+
+
+class Rule:
+    """A row rule. ``failures`` returns a boolean array that is True for the rows breaking it.
+
+    Args:
+        code (str): The reason code recorded for the rows that break the rule.
+        columns (tuple): The columns the rule reads.
+    """
+
+    def __init__(self, code, columns):
+        self.code = code
+        self.columns = columns
+
+    def failures(self, df, references):
+        raise NotImplementedError
+
+
+class NotNull(Rule):
+    """The column must have a value."""
+
+    def __init__(self, column, code=None):
+        super().__init__(code or f"missing_{column}", (column,))
+        self.column = column
+
+    def failures(self, df, references):
+        return df[self.column].isna().to_numpy()
+
+
+class Range(Rule):
+    """Values must lie between ``low`` and ``high``. Missing values pass; see ``NotNull``."""
+
+    def __init__(self, column, low=None, high=None, inclusive=True, code=None):
+        super().__init__(code or f"{column}_out_of_range", (column,))
+        self.column = column
+        self.low = low
+        self.high = high
+        self.inclusive = inclusive
+
+    def failures(self, df, references):
+        values = df[self.column]
+        failed = np.zeros(len(df), dtype=bool)
+        if self.low is not None:
+            below = values < self.low if self.inclusive else values <= self.low
+            failed |= below.to_numpy(dtype=bool, na_value=False)
+        if self.high is not None:
+            above = values > self.high if self.inclusive else values >= self.high
+            failed |= above.to_numpy(dtype=bool, na_value=False)
+        return failed
+
+
+class OneOf(Rule):
+    """Values must be one of ``values``. Missing values pass; see ``NotNull``."""
+
+    def __init__(self, column, values, code=None):
+        super().__init__(code or f"unknown_{column}", (column,))
+        self.column = column
+        self.values = list(values)
+
+    def failures(self, df, references):
+        values = df[self.column]
+        return (values.notna() & ~values.isin(self.values)).to_numpy()
+
+
+class ForeignKey(Rule):
+    """Values must be ids of the ``dataset`` given in the references. Missing values fail.
+
+    The rule is skipped when the references do not include ``dataset``.
+    """
+
+    def __init__(self, column, dataset, code=None):
+        super().__init__(code or f"unknown_{column}", (column,))
+        self.column = column
+        self.dataset = dataset
+
+    def failures(self, df, references):
+        if self.dataset not in references:
+            return None
+        return ~references[self.dataset].contains(df[self.column])
+
+
+class Ordered(Rule):
+    """The ``later`` timestamp must not precede the ``earlier`` one. Rows missing either pass."""
+
+    def __init__(self, earlier, later, code=None):
+        super().__init__(code or f"{later}_before_{earlier}", (earlier, later))
+        self.earlier = earlier
+        self.later = later
+
+    def failures(self, df, references):
+        return (df[self.later] < df[self.earlier]).to_numpy(dtype=bool, na_value=False)
+
+
+class IdSet:
+    """The ids of a referenced dataset, for ``ForeignKey`` rules."""
+
+    def __init__(self, ids):
+        self.ids = pd.Index(pd.Series(ids).dropna().unique())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def contains(self, ids):
+        """Return a boolean mask of which ids are in the set. Missing ids never are."""
+        return pd.Series(ids).isin(self.ids).to_numpy()
+
+
+RULES = {
+    'products': [
+        NotNull('id'),
+    ],
+    'orders': [
+        NotNull('order_id'),
+        NotNull('user_id'),
+        NotNull('created_at'),
+        OneOf('status', STATUSES),
+        Ordered('created_at', 'shipped_at'),
+        Ordered('shipped_at', 'delivered_at'),
+        Ordered('created_at', 'returned_at'),
+    ],
+    'order_items': [
+        NotNull('id'),
+        NotNull('order_id'),
+        NotNull('product_id'),
+        NotNull('sale_price'),
+        Range('sale_price', low=0, inclusive=False, code='non_positive_sale_price'),
+        OneOf('status', STATUSES),
+        ForeignKey('order_id', 'orders', code='unknown_order'),
+        ForeignKey('product_id', 'products', code='unknown_product'),
+    ],
+}
+# Order items parked for a later run are checked again like new ones
+RULES['pending_items'] = RULES['order_items']
+
+
+def rule_columns(name):
+    """Return the columns the rules of a dataset read."""
+    return sorted({column for rule in RULES[name] for column in rule.columns})
+
+
+class ValidationResult:
+    """The outcome of ``validate``: the valid rows, and the rejected rows with their reasons.
+
+    Attributes:
+        valid (pandas.DataFrame): The rows that pass every rule.
+        rejected (pandas.DataFrame): The other rows, with a ``reasons`` column of
+            comma-separated reason codes.
+        counts (dict): The number of rows failing each rule, by reason code.
+    """
+
+    def __init__(self, valid, rejected, counts, failed, rules):
+        self.valid = valid
+        self.rejected = rejected
+        self.counts = counts
+        self._failed = failed
+        self._rules = rules
+
+    @classmethod
+    def from_frames(cls, valid, rejected, name, rules=None):
+        """Rebuild the result of validating a dataset from its valid and rejected rows, e.g. cached ones.
+
+        The failed rules of each rejected row and the counts are decoded from its ``reasons``.
+        """
+        rules = RULES[name] if rules is None else rules
+        bits = {rule.code: np.uint64(1) << np.uint64(bit) for bit, rule in enumerate(rules)}
+        counts = dict.fromkeys(bits, 0)
+        reasons, inverse = np.unique(rejected[REASONS_COLUMN].to_numpy(dtype=object), return_inverse=True)
+        masks = np.zeros(len(reasons), dtype='uint64')
+        for position, (value, rows) in enumerate(zip(reasons, np.bincount(inverse, minlength=len(reasons)))):
+            for code in value.split(','):
+                masks[position] |= bits[code]
+                counts[code] += int(rows)
+        return cls(valid, rejected, counts, masks[inverse], rules)
+
+    def failed_only(self, code):
+        """Split the rejected rows into those that fail only the rule ``code`` and the rest.
+
+        Returns:
+            tuple: The rows failing only that rule, without ``reasons``, and the other rejected rows.
+        """
+        bit = np.uint64(1) << np.uint64([rule.code for rule in self._rules].index(code))
+        only = self._failed == bit
+        return self.rejected[only].drop(columns=REASONS_COLUMN), self.rejected[~only]
+
+
+def validate(df, name, references=None, rules=None):
+    """Evaluate the rules of a dataset over a frame in one vectorized pass.
+
+    Args:
+        df (pandas.DataFrame): The rows to validate.
+        name (str): The dataset name, for its rules in ``RULES``.
+        references (dict): The ids of the datasets the foreign keys point to, as
+            objects with a ``contains(ids)`` method, e.g. ``IdSet``. Foreign keys
+            into datasets that are not given are not checked.
+        rules (list): Rules to evaluate instead of the declared ones.
+
+    Returns:
+        ValidationResult: The valid and rejected rows.
+    """
+    rules = RULES[name] if rules is None else rules
+    references = references or {}
+    if len(rules) > 64:
+        raise ValueError(f"At most 64 rules per dataset are supported, {name} has {len(rules)}")
+
+    failed = np.zeros(len(df), dtype='uint64')
+    counts = {}
+    for bit, rule in enumerate(rules):
+        failures = rule.failures(df, references)
+        if failures is None:
+            continue
+        counts[rule.code] = int(failures.sum())
+        if counts[rule.code]:
+            failed |= failures.astype('uint64') << np.uint64(bit)
+
+    keep = failed == 0
+    if keep.all():
+        return ValidationResult(df, df.iloc[:0].assign(**{REASONS_COLUMN: ''}), counts, failed[:0], rules)
+
+    rejected_failed = failed[~keep]
+    # Decode each distinct combination of failed rules once
+    reasons = {
+        value: ','.join(rule.code for bit, rule in enumerate(rules) if value >> bit & 1)
+        for value in pd.unique(rejected_failed).tolist()
+    }
+    rejected = df[~keep].assign(**{REASONS_COLUMN: [reasons[value] for value in rejected_failed.tolist()]})
+    return ValidationResult(df[keep], rejected, counts, rejected_failed, rules)
+
+
+class ValidationReport:
+    """Reject counts per dataset and reason, accumulated over the validated frames or chunks.
+
+    Rows set aside for a later run, such as order items waiting for their order,
+    are counted as parked rather than rejected, though their reasons are still counted.
+    """
+
+    def __init__(self):
+        self.datasets = {}
+
+    def add(self, name, result, parked=0):
+        """Add the counts of a ``ValidationResult``, of which ``parked`` rejected rows were parked."""
+        totals = self.datasets.setdefault(name, {'rows': 0, 'rejected': 0, 'parked': 0, 'reasons': {}})
+        totals['rows'] += len(result.valid) + len(result.rejected)
+        totals['rejected'] += len(result.rejected) - parked
+        totals['parked'] += parked
+        for code, count in result.counts.items():
+            totals['reasons'][code] = totals['reasons'].get(code, 0) + count
+
+    def report(self):
+        """Print the reject rate of each dataset and the rows failing each rule."""
+        for name, totals in self.datasets.items():
+            rate = totals['rejected'] / totals['rows'] if totals['rows'] else 0.0
+            reasons = ', '.join(f"{code}={count}" for code, count in totals['reasons'].items() if count)
+            parked = f", parked {totals['parked']}" if totals['parked'] else ""
+            print(f"{name}: rejected {totals['rejected']} of {totals['rows']} rows ({rate:.2%}){parked}"
+                  + (f": {reasons}" if reasons else ""))
+
+    def to_json(self):
+        return json.dumps(self.datasets, indent=2)
@@ -0,0 +1,177 @@
+"""## Typed schemas for the raw CSV inputs
+
+Declares the column types of products, orders and order_items, which columns
+hold timestamps, and which columns each stage needs, so the part files are
+parsed straight into compact dtypes instead of inferred object columns:
+
+- ids are nullable ``Int64``, so a missing id stays an integer column;
+- low-cardinality strings (status, category, brand, department) are categoricals;
+- timestamps are parsed once, as ISO 8601, to ``datetime64``;
+- columns no stage uses (``sku``, ``name``, ``num_of_item``, ...) are not parsed at all.
+
+``HANDOFF_COLUMNS=all`` keeps every column in the validated/ hand-off instead
+of only the ones the transformation needs. ``PARSE_ENGINE=pyarrow`` parses
+whole files with the multithreaded pyarrow CSV reader; chunked reads always
+use the C parser, which is the only one that supports them.
+"""
+
+import os
+
+from common.lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+PARSE_ENGINE = os.environ.get('PARSE_ENGINE', 'c')
+HANDOFF_COLUMNS = os.environ.get('HANDOFF_COLUMNS', 'needed')
+
+
+class CsvSchema:
+    """The declared columns of one raw CSV dataset.
+
+    Args:
+        dtypes (dict): The pandas dtype of every column, in file order. Timestamp
+            columns are declared as ``datetime64[us]``.
+        stages (dict): The columns each stage reads, by stage name.
+    """
+
+    def __init__(self, dtypes, stages):
+        self.dtypes = dtypes
+        self.stages = stages
+
+    @property
+    def columns(self):
+        return list(self.dtypes)
+
+    @property
+    def timestamps(self):
+        return [column for column, dtype in self.dtypes.items() if dtype.startswith('datetime64')]
+
+    def usecols(self, stage=None):
+        """Return the columns to parse for a stage, in file order. All columns if ``stage`` is None."""
+        if stage is None or HANDOFF_COLUMNS == 'all':
+            return self.columns
+        wanted = set(self.stages[stage])
+        return [column for column in self.dtypes if column in wanted]
+
+    def read_csv_kwargs(self, usecols, engine='c'):
+        """Keyword arguments for ``pd.read_csv``.
+
+        The pyarrow reader converts every declared dtype natively. The C parser is
+        much slower at nullable integers and timestamps than at plain columns, so
+        those are left to ``convert`` instead.
+        """
+        if engine == 'pyarrow':
+            dtype = {column: self.dtypes[column] for column in usecols}
+        else:
+            dtype = {
+                column: self.dtypes[column] for column in usecols
+                if column not in self.timestamps and self.dtypes[column] != 'Int64'
+            }
+        return {'usecols': usecols, 'dtype': dtype}
+
+    def convert(self, df):
+        """Convert the columns of a parsed frame that are not in their declared dtype yet, in place."""
+        for column in df.columns:
+            dtype = self.dtypes.get(column)
+            if dtype is None or df[column].dtype == dtype:
+                continue
+            if column in self.timestamps:
+                df[column] = pd.to_datetime(df[column], format='ISO8601').astype(dtype)
+            else:
+                df[column] = df[column].astype(dtype)
+        return df
+
+    def read(self, source, stage=None, engine=None):
+        """Parse a whole CSV file into the declared dtypes.
+
+        Args:
+            source: A path or a binary file object.
+            stage (str): The stage the columns are read for. Defaults to all columns.
+            engine (str): The ``pd.read_csv`` engine. Defaults to ``PARSE_ENGINE``.
+
+        Returns:
+            pandas.DataFrame: The parsed columns, in file order.
+        """
+        usecols = self.usecols(stage)
+        engine = engine or PARSE_ENGINE
+        df = pd.read_csv(source, engine=engine, **self.read_csv_kwargs(usecols, engine))
+        return self.convert(df[usecols])
+
+    def read_chunks(self, source, chunk_rows, stage=None):
+        """Parse a CSV file in chunks of at most ``chunk_rows`` rows, with the C parser.
+
+        Yields:
+            pandas.DataFrame: Each chunk, parsed like ``read``.
+        """
+        usecols = self.usecols(stage)
+        with pd.read_csv(source, chunksize=chunk_rows, **self.read_csv_kwargs(usecols)) as reader:
+            for chunk in reader:
+                yield self.convert(chunk[usecols])
+
+    def empty(self, stage=None):
+        """Return an empty frame with the stage's columns and dtypes."""
+        usecols = self.usecols(stage)
+        return pd.DataFrame({column: pd.Series(dtype=self.dtypes[column]) for column in usecols})
+
+
+RAW_SCHEMAS = {
+    'products': CsvSchema(
+        {
+            'id': 'Int64',
+            'sku': 'str',
+            'cost': 'float64',
+            'category': 'category',
+            'name': 'str',
+            'brand': 'category',
+            'retail_price': 'float64',
+            'department': 'category',
+        },
+        stages={
+            'validation': ['id', 'category'],
+            'transformation': ['id', 'category'],
+        },
+    ),
+    'orders': CsvSchema(
+        {
+            'order_id': 'Int64',
+            'user_id': 'Int64',
+            'status': 'category',
+            'created_at': 'datetime64[us]',
+            'returned_at': 'datetime64[us]',
+            'shipped_at': 'datetime64[us]',
+            'delivered_at': 'datetime64[us]',
+            'num_of_item': 'Int64',
+        },
+        stages={
+            # The columns the validation rules read (see common.rules); returned_at also marks returned orders
+            'validation': ['order_id', 'user_id', 'status', 'created_at', 'returned_at', 'shipped_at', 'delivered_at'],
+            'transformation': ['order_id', 'order_date', 'returned_at'],
+        },
+    ),
+    'order_items': CsvSchema(
+        {
+            'id': 'Int64',
+            'order_id': 'Int64',
+            'user_id': 'Int64',
+            'product_id': 'Int64',
+            'status': 'category',
+            'created_at': 'datetime64[us]',
+            'shipped_at': 'datetime64[us]',
+            'delivered_at': 'datetime64[us]',
+            'returned_at': 'datetime64[us]',
+            'sale_price': 'float64',
+        },
+        stages={
+            'validation': ['id', 'order_id', 'user_id', 'product_id', 'status', 'sale_price'],
+            'transformation': ['id', 'order_id', 'user_id', 'product_id', 'sale_price'],
+        },
+    ),
+}
+
+
+def transformation_columns(name):
+    """Return the validated columns the transformation reads for a dataset, or None for all."""
+    schema = RAW_SCHEMAS.get(name)
+    if schema is None or HANDOFF_COLUMNS == 'all':
+        return None
+    return schema.stages['transformation']
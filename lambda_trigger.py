@@ -1,77 +1,231 @@
-import boto3
 import json
 import os
+from functools import lru_cache
+from urllib.parse import unquote_plus
+
+from botocore.exceptions import ClientError
+
+from common import aws_io
+from common.metrics import RunMetrics, instrument, stage
+from common.microbatch import apply_part
+from common.products_cache import ProductsCache
+
+RAW_PREFIX = 'raw-data/'
+PRODUCTS_KEY = f"{RAW_PREFIX}products.csv"
+STATUS_KEY = 'status/execution_started.txt'
+READY_PREFIX = 'status/ready/'
+
+# Inputs the pipeline waits for, and the raw-data/ folder each one arrives in
+REQUIRED_INPUTS = ('products', 'orders', 'order_items')
+INPUT_FOLDERS = {
+    'orders': f"{RAW_PREFIX}orders/",
+    'order_items': f"{RAW_PREFIX}order_items/",
+}
+
+# Apply each orders and order_items part to the KPI tables as soon as it arrives
+MICROBATCH = os.environ.get('MICROBATCH', 'false').lower() in ('1', 'true', 'yes')
+MICROBATCH_WORKERS = int(os.environ.get('MICROBATCH_WORKERS', '8'))
+
+
+@lru_cache(maxsize=None)
+def get_client(service):
+    """Create a boto3 client on first use and reuse it across warm invocations."""
+    return aws_io.client(service, MICROBATCH_WORKERS)
+
+
+@lru_cache(maxsize=None)
+def get_table_client():
+    """Create a DynamoDB client that serializes plain Python values, like the tasks use."""
+    return aws_io.resource('dynamodb', MICROBATCH_WORKERS).meta.client
+
+
+def input_kind(key):
+    """Return which required input an uploaded object key belongs to, if any."""
+    if key == PRODUCTS_KEY:
+        return 'products'
+    for kind, folder in INPUT_FOLDERS.items():
+        if key.startswith(folder) and not key.endswith('/'):
+            return kind
+    return None
+
+
+def object_exists(s3, bucket, key):
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError:
+        return False
+
+
+class ReadinessTracker:
+    """
+    Tracks which required inputs have arrived, from the S3 event records themselves.
+
+    Each uploaded orders/ or order_items/ part leaves a small marker under
+    ``status/ready/``, so later invocations can check for a folder with a single
+    ``head_object`` instead of listing it. products.csv has a fixed key and is
+    checked directly. Task 2 deletes the markers with the status file once the
+    drop is archived.
+    """
+
+    def __init__(self, s3, bucket):
+        self.s3 = s3
+        self.bucket = bucket
+        self.ready = set()
+
+    def record(self, keys):
+        """Mark the inputs of the uploaded keys as ready and leave their markers."""
+        kinds = {input_kind(key) for key in keys} - {None}
+        for kind in kinds - self.ready:
+            if kind in INPUT_FOLDERS:
+                self.s3.put_object(Bucket=self.bucket, Key=READY_PREFIX + kind, Body=b'')
+            self.ready.add(kind)
+
+    def check(self):
+        """Check the inputs not seen in this event and return which ones are present."""
+        for kind in REQUIRED_INPUTS:
+            if kind in self.ready:
+                continue
+            key = PRODUCTS_KEY if kind == 'products' else READY_PREFIX + kind
+            if object_exists(self.s3, self.bucket, key):
+                self.ready.add(kind)
+        return {kind: kind in self.ready for kind in REQUIRED_INPUTS}
+
+
+def claim_execution(s3, bucket):
+    """
+    Atomically create the status file, so exactly one invocation starts the Step Function.
+
+    Returns:
+        bool: True if this invocation created the status file, False if it already existed.
+    """
+    try:
+        s3.put_object(Bucket=bucket, Key=STATUS_KEY, Body='Step Function Triggered', IfNoneMatch='*')
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            return False
+        raise
 
-s3 = boto3.client('s3')
-stepfunctions = boto3.client('stepfunctions')
 
 def lambda_handler(event, context):
     """
     AWS Lambda function to trigger an AWS Step Function based on S3 file events.
 
-    This function is invoked by an S3 event when files are uploaded. It checks for
-    the existence of specific files in an S3 bucket and triggers a Step Function 
-    if all required conditions are met. It ensures that the Step Function is only 
-    triggered once by checking for the existence of a status file.
+    This function is invoked by an S3 event when files are uploaded. It records
+    which required inputs have arrived from the event records, checks for the
+    others, and triggers a Step Function once all of them are present. The
+    status file is created with a conditional write, so the Step Function is
+    triggered exactly once even when uploads land concurrently.
 
     Args:
-        event (dict): The event data from the S3 invocation, containing bucket and 
+        event (dict): The event data from the S3 invocation, containing bucket and
                       object information.
         context (object): The Lambda context object.
 
     Returns:
-        dict: A dictionary with the status of the operation, including whether 
+        dict: A dictionary with the status of the operation, including whether
               the Step Function execution has been triggered or if the function
               is waiting for required files.
     """
 
     bucket_name = event['Records'][0]['s3']['bucket']['name']
     state_machine_arn = os.environ['STATE_MACHINE_ARN']  # Get the Step Function ARN from environment variables
+    s3 = get_client('s3')
+    clients = [s3, get_table_client()] if MICROBATCH else [s3]
+
+    with RunMetrics('lambda_trigger', clients):
+        microbatches = apply_microbatches(event, s3, bucket_name) if MICROBATCH else None
+        result = handle_event(event, s3, bucket_name, state_machine_arn)
+        if microbatches is not None:
+            result['microbatches'] = microbatches
+        return result
+
+
+@lru_cache(maxsize=None)
+def get_products_cache(s3, bucket_name):
+    """Create the products cache on first use, so warm invocations share its local tier and counters."""
+    return ProductsCache(s3, bucket_name)
+
+
+def apply_microbatches(event, s3, bucket_name):
+    """
+    Apply each orders and order_items part in the event to the KPI tables right away.
+
+    Each part is validated on its own, joined with the parts of the other kind
+    that arrived before it, and added to the CategoryKPI and OrderKPI items with
+    atomic counter updates (see ``common.microbatch``). The batch run still
+    follows once all inputs are present.
+
+    A part whose micro-batch fails, e.g. because it was archived in the
+    meantime or is malformed, is left to the batch run: the error is reported
+    and the event's readiness is still recorded.
+
+    Returns:
+        list: The counters of each part's micro-batch, or its key and error if it failed.
+    """
+    results = []
+    for record in event['Records']:
+        key = unquote_plus(record['s3']['object']['key'])
+        kind = input_kind(key)
+        if kind not in INPUT_FOLDERS:
+            continue
+        try:
+            with stage('microbatch') as s:
+                stats = apply_part(
+                    s3, get_table_client(), bucket_name, kind, key,
+                    os.environ['CATEGORY_TABLE'], os.environ['ORDER_TABLE'], max_workers=MICROBATCH_WORKERS,
+                    products_cache=get_products_cache(s3, bucket_name),
+                )
+                s.rows_in = stats.rows
+                s.rows_out = stats.applied
+        except Exception as e:
+            print(f"Micro-batch of {key} failed, leaving it to the batch run: {e}")
+            results.append({'key': key, 'error': f"{type(e).__name__}: {e}"})
+            continue
+        stats.report()
+        results.append(stats.to_dict())
+    return results
+
+
+def handle_event(event, s3, bucket_name, state_machine_arn):
+    """Check readiness for one S3 event and trigger the Step Function once everything is present."""
 
     # Check if a status file exists
-    status_key = 'status/execution_started.txt'
-    try:
-        s3.head_object(Bucket=bucket_name, Key=status_key)
+    with stage('check_status'):
+        triggered = object_exists(s3, bucket_name, STATUS_KEY)
+    if triggered:
         print("Step Function already triggered. Skipping execution.")
         return {
             "status": "Already triggered",
             "message": "Step Function execution has already been triggered."
         }
-    except s3.exceptions.ClientError:
-        # Status file does not exist, proceed with checking files
-        pass
-    
-    # Checking for products.csv
-    try:
-        s3.head_object(Bucket=bucket_name, Key='raw-data/products.csv')
-        has_products = True
-    except s3.exceptions.ClientError:
-        has_products = False
-
-    # Checking for at least one file in orders/
-    orders = s3.list_objects_v2(Bucket=bucket_name, Prefix='raw-data/orders/')
-    has_orders = 'Contents' in orders and any(
-        not obj['Key'].endswith('/') for obj in orders['Contents']
-    )
-
-    # Checking for at least one file in order_items/
-    order_items = s3.list_objects_v2(Bucket=bucket_name, Prefix='raw-data/order_items/')
-    has_order_items = 'Contents' in order_items and any(
-        not obj['Key'].endswith('/') for obj in order_items['Contents']
-    )
 
+    # Record the inputs in this event, then check for the rest
+    with stage('check_inputs') as s:
+        s.rows_in = len(event['Records'])
+        tracker = ReadinessTracker(s3, bucket_name)
+        tracker.record(unquote_plus(record['s3']['object']['key']) for record in event['Records'])
+        present = tracker.check()
 
     # Trigger the Step Function if all required files are present
-    if has_products and has_orders and has_order_items:
-        try:
-            # Create a status file to indicate the Step Function was triggered
-            s3.put_object(Bucket=bucket_name, Key=status_key, Body='Step Function Triggered')
+    if all(present.values()):
+        with stage('claim_execution'):
+            claimed = claim_execution(s3, bucket_name)
+        if not claimed:
+            print("Step Function already triggered. Skipping execution.")
+            return {
+                "status": "Already triggered",
+                "message": "Step Function execution has already been triggered."
+            }
 
+        try:
             # Start the Step Function
-            response = stepfunctions.start_execution(
-                stateMachineArn=state_machine_arn,
-                input=json.dumps({"triggered_by": "S3 Lambda Trigger"})
-            )
+            with stage('start_execution'):
+                response = instrument(get_client('stepfunctions')).start_execution(
+                    stateMachineArn=state_machine_arn,
+                    input=json.dumps({"triggered_by": "S3 Lambda Trigger"})
+                )
             print("Step Function execution started:", response['executionArn'])
             return {
                 "status": "Step Function triggered",
@@ -79,6 +233,8 @@ def lambda_handler(event, context):
             }
         except Exception as e:
             print("Failed to start Step Function:", str(e))
+            # Release the status file so a later upload can retry
+            s3.delete_object(Bucket=bucket_name, Key=STATUS_KEY)
             return {
                 "status": "Error triggering Step Function",
                 "error": str(e)
@@ -87,8 +243,7 @@ def lambda_handler(event, context):
     # If not all required files are present, return waiting status
     return {
         "status": "Waiting for all required files",
-        "has_products": has_products,
-        "has_orders": has_orders,
-        "has_order_items": has_order_items
+        "has_products": present['products'],
+        "has_orders": present['orders'],
+        "has_order_items": present['order_items']
     }
-
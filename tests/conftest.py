@@ -0,0 +1,8 @@
+"""Shared setup: the benchmarks' local AWS stand-ins make the task modules importable."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import local_aws  # noqa: E402,F401
@@ -0,0 +1,125 @@
+"""Batched DynamoDB writes: same tables as the put_item loop they replaced, and unprocessed items retried."""
+
+import glob
+import os
+from decimal import Decimal
+
+import boto3
+import pandas as pd
+import pytest
+from moto import mock_aws
+
+import local_aws
+from dynamo_writer import batch_write, category_kpi_items, order_kpi_items
+from kpi_engine import compute_kpis
+
+CATEGORY_TABLE = os.environ['CATEGORY_TABLE']
+ORDER_TABLE = os.environ['ORDER_TABLE']
+
+
+@pytest.fixture(scope='module')
+def data_kpis():
+    """The KPIs of the Data/ sample."""
+    def read(folder):
+        paths = sorted(glob.glob(os.path.join(local_aws.DATA_DIR, folder, '*.csv')))
+        return pd.concat([pd.read_csv(path) for path in paths], ignore_index=True)
+
+    products = pd.read_csv(os.path.join(local_aws.DATA_DIR, 'products.csv'))
+    orders = read('orders')
+    orders['order_date'] = pd.to_datetime(orders['created_at']).dt.date
+    return compute_kpis(products, orders, read('order_items'))
+
+
+@pytest.fixture
+def ddb():
+    with mock_aws():
+        local_aws.create_tables(boto3.client('dynamodb', region_name=local_aws.REGION))
+        yield boto3.resource('dynamodb', region_name=local_aws.REGION)
+
+
+def put_item_write(ddb, cat_kpi, order_kpi):
+    """The item-at-a-time write ``write_to_dynamodb`` made before batching."""
+    cat_table = ddb.Table(CATEGORY_TABLE)
+    for _, row in cat_kpi.iterrows():
+        cat_table.put_item(Item={
+            'category': row['category'],
+            'order_date': row['order_date'].isoformat(),
+            'daily_revenue': Decimal(str(row['daily_revenue'])),
+            'avg_order_value': Decimal(str(row['avg_order_value'])),
+            'avg_return_rate': Decimal(str(round(row['avg_return_rate'], 2))),
+        })
+    order_table = ddb.Table(ORDER_TABLE)
+    for _, row in order_kpi.iterrows():
+        order_table.put_item(Item={
+            'order_date': row['order_date'].isoformat(),
+            'total_orders': row['total_orders'],
+            'total_revenue': Decimal(str(row['total_revenue'])),
+            'total_items_sold': row['total_items_sold'],
+            'return_rate': Decimal(str(round(row['return_rate'], 2))),
+            'unique_customers': row['unique_customers'],
+        })
+
+
+def scan(ddb, table_name, keys):
+    items = []
+    kwargs = {}
+    while True:
+        page = ddb.Table(table_name).scan(**kwargs)
+        items.extend(page['Items'])
+        if 'LastEvaluatedKey' not in page:
+            return sorted(items, key=lambda item: [item[key] for key in keys])
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def clear(ddb, table_name, keys):
+    with ddb.Table(table_name).batch_writer() as batch:
+        for item in scan(ddb, table_name, keys):
+            batch.delete_item(Key={key: item[key] for key in keys})
+
+
+class UnprocessedOnce:
+    """Wraps a client so the first BatchWriteItem call leaves its last items unprocessed."""
+
+    def __init__(self, client, unprocessed=10):
+        self.client = client
+        self.unprocessed = unprocessed
+        self.calls = 0
+
+    def batch_write_item(self, RequestItems):
+        self.calls += 1
+        if self.calls > 1:
+            return self.client.batch_write_item(RequestItems=RequestItems)
+        (table_name, requests), = RequestItems.items()
+        self.client.batch_write_item(RequestItems={table_name: requests[:-self.unprocessed]})
+        return {'UnprocessedItems': {table_name: requests[-self.unprocessed:]}}
+
+
+def test_batch_write_matches_put_item(ddb, data_kpis):
+    cat_kpi, order_kpi = data_kpis
+    tables = ((CATEGORY_TABLE, ['category', 'order_date']), (ORDER_TABLE, ['order_date']))
+
+    put_item_write(ddb, cat_kpi, order_kpi)
+    expected = [scan(ddb, table_name, keys) for table_name, keys in tables]
+    for table_name, keys in tables:
+        clear(ddb, table_name, keys)
+
+    client = ddb.meta.client
+    batch_write(client, CATEGORY_TABLE, category_kpi_items(cat_kpi))
+    batch_write(client, ORDER_TABLE, order_kpi_items(order_kpi))
+    written = [scan(ddb, table_name, keys) for table_name, keys in tables]
+
+    assert [len(items) for items in expected] == [len(cat_kpi), len(order_kpi)]
+    assert written == expected
+
+
+def test_unprocessed_items_are_retried(ddb, data_kpis):
+    _, order_kpi = data_kpis
+    items = order_kpi_items(order_kpi)
+    client = UnprocessedOnce(ddb.meta.client)
+
+    stats = batch_write(client, ORDER_TABLE, items, max_workers=1, base_delay=0)
+
+    assert stats.unprocessed_retries == 1
+    assert stats.items == len(items)
+    assert client.calls == -(-len(items) // 25) + 1
+    assert len(scan(ddb, ORDER_TABLE, ['order_date'])) == len(items)
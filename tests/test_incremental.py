@@ -0,0 +1,105 @@
+"""Incremental state: a re-uploaded part replaces what it contributed before, and only touched dates are read."""
+
+import boto3
+import pandas as pd
+import pytest
+from moto import mock_aws
+
+import local_aws
+import synthetic
+from common.incremental import STATE_PREFIX, IncrementalState, compute_partials
+from kpi_engine import compute_kpis
+
+ITEMS_PART1 = 'raw-data/order_items/part1.csv'
+ITEMS_PART2 = 'raw-data/order_items/part2.csv'
+ORDERS_PART1 = 'raw-data/orders/part1.csv'
+
+
+@pytest.fixture
+def frames():
+    frames = synthetic.generate(0.2, seed=3, days=10)
+    frames['orders']['order_date'] = pd.to_datetime(frames['orders']['created_at']).dt.date
+    return frames
+
+
+def merge_part(state, products, orders, order_items, files, part=None):
+    if part is not None:
+        order_items = order_items.assign(part=part)
+    partials = compute_partials(products, orders, order_items, state.orders_index)
+    return state.merge(partials, files, pd.DataFrame())
+
+
+def assert_state_matches(state, products, orders, order_items):
+    expected = compute_kpis(products, orders, order_items)
+    dates = sorted(set(state.partitions) | set(state.lines))
+    for got, want in zip(state.kpis(dates), expected):
+        pd.testing.assert_frame_equal(got, want, check_dtype=False, check_exact=False, atol=0.01)
+
+
+def counted_items(state):
+    return sum(int(lines['items'].sum()) for lines in state.lines.values())
+
+
+def test_changed_items_part_replaces_its_contribution(frames):
+    products, orders, items = frames['products'], frames['orders'], frames['order_items']
+    half = len(items) // 2
+    state = IncrementalState()
+    merge_part(state, products, orders, items[:half], {ORDERS_PART1: '"o"', ITEMS_PART1: '"a"'}, ITEMS_PART1)
+    merge_part(state, products, orders.iloc[:0], items[half:], {ITEMS_PART2: '"b"'}, ITEMS_PART2)
+
+    # The first part is uploaded again with other prices for the same item ids, and without some items
+    changed = items[:half].assign(sale_price=items['sale_price'][:half] + 1.25)
+    changed = changed[changed.index % 10 != 0]
+    listed = [{'Key': ITEMS_PART1, 'ETag': '"c"'}, {'Key': ITEMS_PART2, 'ETag': '"b"'}]
+    assert [obj['Key'] for obj in state.new_files(listed)] == [ITEMS_PART1]
+    dates = merge_part(state, products, orders.iloc[:0], changed, {ITEMS_PART1: '"c"'}, ITEMS_PART1)
+
+    by_order = orders.set_index('order_id')['order_date']
+    assert dates == sorted({str(day) for day in by_order.loc[items[:half]['order_id']]})
+    assert state.manifest[ITEMS_PART1]['dates'] == sorted({str(day) for day in by_order.loc[changed['order_id']]})
+    assert counted_items(state) == len(changed) + len(items) - half
+    assert_state_matches(state, products, orders, pd.concat([changed, items[half:]]))
+
+
+def test_changed_orders_part_moves_its_counted_items(frames):
+    products, orders, items = frames['products'], frames['orders'], frames['order_items']
+    state = IncrementalState()
+    merge_part(state, products, orders, items, {ORDERS_PART1: '"a"', ITEMS_PART1: '"a"'}, ITEMS_PART1)
+
+    # A corrected orders part moves some orders a day later and marks others returned
+    changed = orders.copy()
+    later = changed.index % 7 == 0
+    changed.loc[later, 'order_date'] = changed.loc[later, 'order_date'] + pd.Timedelta(days=1)
+    returned = changed.index % 5 == 0
+    changed.loc[returned, 'returned_at'] = changed.loc[returned, 'created_at']
+    merge_part(state, products, changed, items.iloc[:0], {ORDERS_PART1: '"b"'})
+
+    assert counted_items(state) == len(items)
+    assert_state_matches(state, products, changed, items)
+
+
+def test_run_reads_and_rewrites_only_the_dates_it_touches(frames):
+    products, orders, items = frames['products'], frames['orders'], frames['order_items']
+    day = orders['order_date'].max()
+    last_day = items['order_id'].isin(orders.loc[orders['order_date'] == day, 'order_id'])
+
+    with mock_aws():
+        s3 = boto3.client('s3')
+        local_aws.create_bucket(s3)
+        state = IncrementalState()
+        merge_part(state, products, orders, items[~last_day], {ITEMS_PART1: '"a"'}, ITEMS_PART1)
+        state.save(s3, local_aws.BUCKET)
+
+        state = IncrementalState.load(s3, local_aws.BUCKET)
+        assert state.lines == {} and len(state.partitions) == orders['order_date'].nunique() - 1
+        dates = merge_part(state, products, orders.iloc[:0], items[last_day], {ITEMS_PART2: '"b"'}, ITEMS_PART2)
+        assert dates == [str(day)] and list(state.lines) == [str(day)]
+        written = state.save(s3, local_aws.BUCKET)
+        assert [key for key in written if '/order_lines/' in key] == [state.partitions[str(day)]]
+
+        state = IncrementalState.load(s3, local_aws.BUCKET)
+        assert_state_matches(state, products, orders, items)
+        stored = s3.list_objects_v2(Bucket=local_aws.BUCKET, Prefix=STATE_PREFIX)['Contents']
+        assert sorted(obj['Key'] for obj in stored) == sorted(
+            [f"{STATE_PREFIX}CURRENT.json", *state.files.values(), *state.partitions.values()]
+        )
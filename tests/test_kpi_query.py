@@ -0,0 +1,47 @@
+"""Cached KPI reads: a run's partition index invalidates the dates it rewrote."""
+
+import contextlib
+import io
+
+import boto3
+import pandas as pd
+from moto import mock_aws
+
+import local_aws
+import synthetic
+from common.kpi_query import KpiQuery
+from kpi_engine import compute_kpis
+
+
+def test_index_created_after_the_first_sync_invalidates_its_dates(monkeypatch):
+    import task_2
+
+    frames = synthetic.generate(0.1, seed=5, days=5)
+    orders = frames['orders'].assign(order_date=pd.to_datetime(frames['orders']['created_at']).dt.date)
+    cat_kpi, order_kpi = compute_kpis(frames['products'], orders, frames['order_items'])
+    start, end = order_kpi['order_date'].min(), order_kpi['order_date'].max()
+
+    with mock_aws():
+        s3 = boto3.client('s3', region_name=local_aws.REGION)
+        local_aws.create_bucket(s3)
+        local_aws.create_tables(boto3.client('dynamodb', region_name=local_aws.REGION))
+        monkeypatch.setattr(task_2, 'S3_BUCKET_NAME', local_aws.BUCKET)
+        monkeypatch.setattr(task_2, 'SKIP_UNCHANGED', False)
+        task_2.get_s3.cache_clear()
+        task_2.get_ddb.cache_clear()
+
+        client = boto3.resource('dynamodb', region_name=local_aws.REGION).meta.client
+        reader = KpiQuery(client, 'CategoryKPI', 'OrderKPI', s3=s3, bucket=local_aws.BUCKET)
+        # Before the first run there is no index, and every date is cached as absent
+        assert reader.order_kpis(start, end).empty
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            task_2.write_to_dynamodb(cat_kpi, order_kpi)
+            task_2.write_to_s3(cat_kpi, order_kpi)
+        dropped = reader.sync(force=True)
+        loaded = reader.order_kpis(start, end)
+        task_2.get_s3.cache_clear()
+        task_2.get_ddb.cache_clear()
+
+    assert dropped == len(order_kpi)
+    assert len(loaded) == len(order_kpi)
@@ -0,0 +1,151 @@
+"""The S3 trigger starts one execution per drop, and archiving a drop resets its readiness."""
+
+import collections
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import local_aws
+
+
+def s3_event(key):
+    return {'Records': [{'s3': {'bucket': {'name': local_aws.BUCKET}, 'object': {'key': key}}}]}
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    with mock_aws():
+        s3 = boto3.client('s3', region_name=local_aws.REGION)
+        local_aws.create_bucket(s3)
+        sfn = boto3.client('stepfunctions', region_name=local_aws.REGION)
+        arn = sfn.create_state_machine(
+            name='etl', definition=json.dumps({'StartAt': 'Done', 'States': {'Done': {'Type': 'Succeed'}}}),
+            roleArn='arn:aws:iam::123456789012:role/etl',
+        )['stateMachineArn']
+        monkeypatch.setenv('STATE_MACHINE_ARN', arn)
+
+        import lambda_trigger
+        import task_2
+
+        monkeypatch.setattr(task_2, 'S3_BUCKET_NAME', local_aws.BUCKET)
+        lambda_trigger.get_client.cache_clear()
+        task_2.get_s3.cache_clear()
+        yield s3, sfn, arn
+        lambda_trigger.get_client.cache_clear()
+        task_2.get_s3.cache_clear()
+
+
+def upload(s3, keys):
+    """Upload the given keys, invoking the trigger for each, and return the last status."""
+    import lambda_trigger
+
+    for key in keys:
+        s3.put_object(Bucket=local_aws.BUCKET, Key=key, Body=b'id\n1\n')
+        status = lambda_trigger.lambda_handler(s3_event(key), None)['status']
+    return status
+
+
+def count_calls():
+    """Count the API calls the trigger's clients make, by operation."""
+    import lambda_trigger
+
+    calls = collections.Counter()
+    for service in ('s3', 'stepfunctions'):
+        lambda_trigger.get_client(service).meta.events.register(
+            'before-call', lambda model, **kwargs: calls.update([model.name])
+        )
+    return calls
+
+
+def exists(s3, key):
+    return s3.list_objects_v2(Bucket=local_aws.BUCKET, Prefix=key).get('KeyCount', 0) > 0
+
+
+DROP = ['raw-data/orders/orders_part1.csv', 'raw-data/order_items/order_items_part1.csv', 'raw-data/products.csv']
+
+
+def test_archived_drop_does_not_carry_its_readiness_over(aws):
+    import lambda_trigger
+    import task_2
+
+    s3, sfn, arn = aws
+    assert upload(s3, DROP) == 'Step Function triggered'
+
+    task_2.archive_data(task_2.archive_files())
+    assert not exists(s3, lambda_trigger.STATUS_KEY)
+    assert not exists(s3, lambda_trigger.READY_PREFIX)
+
+    # products.csv alone does not start the next drop
+    assert upload(s3, ['raw-data/products.csv']) == 'Waiting for all required files'
+    assert upload(s3, DROP[:2]) == 'Step Function triggered'
+    assert len(sfn.list_executions(stateMachineArn=arn)['executions']) == 2
+
+
+def test_parts_left_by_the_archive_keep_their_marker(aws):
+    import lambda_trigger
+    import task_2
+
+    s3, _, _ = aws
+    upload(s3, DROP)
+    files = task_2.archive_files()
+    # An orders part arrives during the run, so it is not archived with the drop
+    assert upload(s3, ['raw-data/orders/orders_part2.csv']) == 'Already triggered'
+
+    task_2.archive_data(files)
+    assert exists(s3, lambda_trigger.READY_PREFIX + 'orders')
+    assert not exists(s3, lambda_trigger.READY_PREFIX + 'order_items')
+    assert upload(s3, ['raw-data/products.csv']) == 'Waiting for all required files'
+    assert upload(s3, ['raw-data/order_items/order_items_part2.csv']) == 'Step Function triggered'
+
+
+def test_uploads_are_tracked_without_listing(aws):
+    s3, sfn, arn = aws
+    calls = count_calls()
+    parts = [f"raw-data/orders/orders_part{n}.csv" for n in range(1, 4)]
+    parts += [f"raw-data/order_items/order_items_part{n}.csv" for n in range(1, 4)]
+
+    assert upload(s3, parts) == 'Waiting for all required files'
+    assert upload(s3, ['raw-data/products.csv']) == 'Step Function triggered'
+    assert upload(s3, ['raw-data/orders/orders_part4.csv']) == 'Already triggered'
+
+    assert 'ListObjectsV2' not in calls
+    assert calls['StartExecution'] == 1
+    assert len(sfn.list_executions(stateMachineArn=arn)['executions']) == 1
+
+
+def test_concurrent_uploads_start_one_execution(aws):
+    import lambda_trigger
+
+    s3, sfn, arn = aws
+    keys = DROP + [f"raw-data/orders/orders_part{n}.csv" for n in range(2, 7)]
+    for key in keys:
+        s3.put_object(Bucket=local_aws.BUCKET, Key=key, Body=b'id\n1\n')
+    calls = count_calls()
+
+    with ThreadPoolExecutor(max_workers=len(keys)) as pool:
+        statuses = list(pool.map(lambda key: lambda_trigger.lambda_handler(s3_event(key), None)['status'], keys))
+
+    # Invocations that check before the others' markers land wait, but one of them always wins
+    assert statuses.count('Step Function triggered') == 1
+    assert set(statuses) <= {'Step Function triggered', 'Already triggered', 'Waiting for all required files'}
+    assert 'ListObjectsV2' not in calls
+    assert calls['StartExecution'] == 1
+    assert len(sfn.list_executions(stateMachineArn=arn)['executions']) == 1
+
+
+def test_failed_microbatch_still_records_readiness(aws, monkeypatch):
+    import lambda_trigger
+
+    s3, _, _ = aws
+    assert upload(s3, DROP[1:]) == 'Waiting for all required files'
+    monkeypatch.setattr(lambda_trigger, 'MICROBATCH', True)
+
+    # The orders part was archived by a concurrent run before its event was handled
+    result = lambda_trigger.lambda_handler(s3_event(DROP[0]), None)
+
+    assert result['status'] == 'Step Function triggered'
+    assert result['microbatches'] == [{'key': DROP[0], 'error': result['microbatches'][0]['error']}]
+    assert result['microbatches'][0]['error'].startswith('NoSuchKey')
@@ -0,0 +1,149 @@
+"""Micro-batches: per-part counter updates, applied once, and expired once the batch run archives them."""
+
+import os
+
+import boto3
+import pandas as pd
+import pytest
+from moto import mock_aws
+
+import local_aws
+from common.microbatch import apply_part, saved_key, validate_part
+from common.products_cache import ProductsCache
+from dynamo_writer import batch_write, order_kpi_items
+from kpi_engine import compute_kpis
+
+CATEGORY_TABLE = os.environ['CATEGORY_TABLE']
+ORDER_TABLE = os.environ['ORDER_TABLE']
+ORDERS_KEY = 'raw-data/orders/orders_part1.csv'
+ITEMS_KEYS = ['raw-data/order_items/order_items_a.csv', 'raw-data/order_items/order_items_b.csv']
+
+
+@pytest.fixture(scope='module')
+def parts():
+    """The first orders part of the Data/ sample and its order items, split into two parts."""
+    orders = pd.read_csv(os.path.join(local_aws.DATA_DIR, 'orders', 'orders_part1.csv')).head(120)
+    folder = os.path.join(local_aws.DATA_DIR, 'order_items')
+    items = pd.concat([pd.read_csv(os.path.join(folder, name)) for name in sorted(os.listdir(folder))])
+    items = items[items['order_id'].isin(orders['order_id'])].reset_index(drop=True)
+    half = len(items) // 2
+    return {ORDERS_KEY: orders, ITEMS_KEYS[0]: items[:half], ITEMS_KEYS[1]: items[half:]}
+
+
+@pytest.fixture
+def aws(parts, tmp_path):
+    with mock_aws():
+        s3 = boto3.client('s3', region_name=local_aws.REGION)
+        local_aws.create_bucket(s3)
+        local_aws.create_tables(boto3.client('dynamodb', region_name=local_aws.REGION))
+        s3.upload_file(os.path.join(local_aws.DATA_DIR, 'products.csv'), local_aws.BUCKET, 'raw-data/products.csv')
+        for key, df in parts.items():
+            s3.put_object(Bucket=local_aws.BUCKET, Key=key, Body=df.to_csv(index=False).encode('utf-8'))
+        client = boto3.resource('dynamodb', region_name=local_aws.REGION).meta.client
+        cache = ProductsCache(s3, local_aws.BUCKET, directory=str(tmp_path))
+
+        def apply(key):
+            kind = key.split('/')[1]
+            return apply_part(
+                s3, client, local_aws.BUCKET, kind, key, CATEGORY_TABLE, ORDER_TABLE,
+                max_workers=2, products_cache=cache,
+            )
+
+        yield s3, client, apply
+
+
+def scan(client, table_name):
+    items, kwargs = [], {}
+    while True:
+        page = client.scan(TableName=table_name, **kwargs)
+        items.extend(page['Items'])
+        if 'LastEvaluatedKey' not in page:
+            return sorted(items, key=lambda item: (item.get('category', ''), item['order_date']))
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def expected_kpis(parts):
+    """The batch KPIs of the parts, validated as the micro-batches validate them."""
+    products = pd.read_csv(os.path.join(local_aws.DATA_DIR, 'products.csv'))
+    orders = validate_part('orders', parts[ORDERS_KEY])
+    items = pd.concat([validate_part('order_items', parts[key], products) for key in ITEMS_KEYS])
+    return compute_kpis(products, orders, items)
+
+
+def test_items_before_their_orders_are_joined_and_match_the_batch_kpis(aws, parts):
+    s3, client, apply = aws
+    first = apply(ITEMS_KEYS[0])
+    assert (first.pairs, first.applied) == (0, 0)
+    assert s3.head_object(Bucket=local_aws.BUCKET, Key=saved_key('order_items', ITEMS_KEYS[0]))
+
+    joined = apply(ORDERS_KEY)
+    later = apply(ITEMS_KEYS[1])
+    assert joined.pairs == 1 and joined.applied > 0
+    assert later.pairs == 1 and later.applied > 0
+
+    # Revenue is summed in cents, so an average on a rounding boundary may be a cent off
+    cat_kpi, order_kpi = expected_kpis(parts)
+    days = scan(client, ORDER_TABLE)
+    assert [item['order_date'] for item in days] == [day.isoformat() for day in order_kpi['order_date']]
+    for item, row in zip(days, order_kpi.itertuples()):
+        assert int(item['revenue_cents']) == round(row.total_revenue * 100)
+        assert int(item['items']) == row.total_items_sold
+        assert len(item['order_ids']) == row.total_orders
+        assert len(item.get('customer_ids', ())) == row.unique_customers
+        assert abs(float(item['return_rate']) - row.return_rate) <= 0.0101
+
+    categories = scan(client, CATEGORY_TABLE)
+    assert len(categories) == len(cat_kpi)
+    for item, row in zip(categories, cat_kpi.itertuples()):
+        assert (item['category'], item['order_date']) == (row.category, row.order_date.isoformat())
+        assert int(item['revenue_cents']) == round(row.daily_revenue * 100)
+        assert abs(float(item['avg_order_value']) - row.avg_order_value) <= 0.0101
+
+
+def test_replayed_events_leave_the_items_unchanged(aws):
+    _, client, apply = aws
+    for key in [ORDERS_KEY] + ITEMS_KEYS:
+        apply(key)
+    before = [scan(client, table_name) for table_name in (CATEGORY_TABLE, ORDER_TABLE)]
+
+    replays = [apply(key) for key in [ORDERS_KEY] + ITEMS_KEYS]
+
+    assert sum(stats.applied for stats in replays) == 0
+    assert sum(stats.applied_before for stats in replays) > 0
+    assert [scan(client, table_name) for table_name in (CATEGORY_TABLE, ORDER_TABLE)] == before
+
+
+def test_items_written_by_a_batch_run_are_left_alone(aws, parts):
+    _, client, apply = aws
+    _, order_kpi = expected_kpis(parts)
+    batch_write(client, ORDER_TABLE, order_kpi_items(order_kpi))
+    before = scan(client, ORDER_TABLE)
+
+    apply(ORDERS_KEY)
+    stats = apply(ITEMS_KEYS[0])
+
+    assert 0 < stats.batch_owned <= len(before)
+    assert scan(client, ORDER_TABLE) == before
+
+
+def test_archive_expires_saved_parts(monkeypatch):
+    import task_2
+
+    with mock_aws():
+        s3 = boto3.client('s3', region_name=local_aws.REGION)
+        local_aws.create_bucket(s3)
+        monkeypatch.setattr(task_2, 'S3_BUCKET_NAME', local_aws.BUCKET)
+        task_2.get_s3.cache_clear()
+
+        archived = ['raw-data/orders/orders_part1.csv', 'raw-data/order_items/order_items_part1.csv']
+        later = 'raw-data/orders/orders_part2.csv'
+        for key in archived + [later]:
+            s3.put_object(Bucket=local_aws.BUCKET, Key=key, Body=b'id\n1\n')
+            kind = key.split('/')[1]
+            s3.put_object(Bucket=local_aws.BUCKET, Key=saved_key(kind, key), Body=b'')
+
+        task_2.archive_data(archived + ['raw-data/products.csv'])
+        saved = [obj['Key'] for obj in s3.list_objects_v2(Bucket=local_aws.BUCKET, Prefix='microbatch/')['Contents']]
+        task_2.get_s3.cache_clear()
+
+    assert saved == [saved_key('orders', later)]
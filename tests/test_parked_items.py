@@ -0,0 +1,49 @@
+"""Parked order items: only a missing order parks an item, and not for ever."""
+
+from datetime import date
+
+import pandas as pd
+
+from common.incremental import PARKED_ON, park_items
+from common.rules import REASONS_COLUMN, IdSet, validate
+
+
+def items(order_ids, **columns):
+    n = len(order_ids)
+    return pd.DataFrame({
+        'id': range(1, n + 1),
+        'order_id': pd.array(order_ids, dtype='Int64'),
+        'user_id': [7] * n,
+        'product_id': [1] * n,
+        'status': ['delivered'] * n,
+        'sale_price': [9.99] * n,
+        **columns,
+    })
+
+
+def test_item_without_order_id_is_quarantined_not_parked():
+    references = {'orders': IdSet(pd.Series([10])), 'products': IdSet(pd.Series([1]))}
+    result = validate(items([10, 11, None]), 'order_items', references)
+    orphans, failed = result.failed_only('unknown_order')
+
+    assert orphans['id'].tolist() == [2]
+    assert failed['id'].tolist() == [3]
+    assert 'missing_order_id' in failed[REASONS_COLUMN].iloc[0]
+
+
+def test_items_parked_too_long_expire():
+    orphans = items([11, 12, 13], **{PARKED_ON: [None, date(2026, 10, 10), date(2026, 10, 9)]})
+    pending, expired = park_items(orphans, today=date(2026, 10, 17), max_days=7)
+
+    assert pending['id'].tolist() == [1, 2]
+    assert pending[PARKED_ON].tolist() == [date(2026, 10, 17), date(2026, 10, 10)]
+    assert expired['id'].tolist() == [3]
+    assert PARKED_ON not in expired
+    assert expired[REASONS_COLUMN].tolist() == ['unknown_order']
+
+
+def test_new_orphans_are_dated_today():
+    pending, expired = park_items(items([11, 12]), today=date(2026, 10, 17))
+
+    assert pending[PARKED_ON].tolist() == [date(2026, 10, 17)] * 2
+    assert expired.empty